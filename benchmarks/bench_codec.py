@@ -0,0 +1,79 @@
+from typing import List
+
+from harness import Benchmark
+from fixtures import tcp_pair, chat_message, presence
+from codec import BinaryCodec, JsonCodec, ZlibCompression
+from messages import Channel, get_message, send_message
+from variables import *
+
+SAMPLES = {
+    'chat': chat_message('alice', 'bob'),
+    'presence': presence('alice'),
+    'status 200': {RESPONSE: 200},
+    'users 202': {RESPONSE: 202, LIST_INFO: [f'user{i}' for i in range(100)]},
+}
+CODECS = (JsonCodec(), BinaryCodec())
+
+
+def benchmarks() -> List[Benchmark]:
+    result = []
+    for codec in CODECS:
+        for sample, message in SAMPLES.items():
+            payload = codec.encode(message)
+            result.append(Benchmark(f'codec.{codec.name} encode {sample}',
+                                    lambda codec=codec, message=message: codec.encode(message), number=10000))
+            result.append(Benchmark(f'codec.{codec.name} decode {sample}',
+                                    lambda codec=codec, payload=payload: codec.decode(payload), number=10000))
+
+    channels = []
+    for codec in (None,) + CODECS:
+        left, right = tcp_pair()
+        sender, receiver = Channel(left, codec), Channel(right, codec)
+        channels.append(sender)
+        channels.append(receiver)
+        message = SAMPLES['chat']
+
+        def roundtrip(sender=sender, receiver=receiver, message=message):
+            send_message(sender, message)
+            get_message(receiver)
+
+        name = codec.name if codec else 'legacy'
+        result.append(Benchmark(f'channel.{name} send+get chat', roundtrip, number=5000))
+
+    # Большой ответ со списком пользователей - основной кандидат на сжатие
+    users = {RESPONSE: 202, LIST_INFO: [f'user{i}' for i in range(1000)]}
+    for compress in (False, True):
+        left, right = tcp_pair()
+        sender = Channel(left, CODECS[1], ZlibCompression() if compress else None)
+        receiver = Channel(right, CODECS[1], ZlibCompression() if compress else None)
+        channels.extend((sender, receiver))
+
+        def roundtrip_users(sender=sender, receiver=receiver):
+            send_message(sender, users)
+            get_message(receiver)
+
+        name = 'bin1+zlib' if compress else 'bin1'
+        result.append(Benchmark(f'channel.{name} send+get 1000 users', roundtrip_users, number=1000))
+
+    def close():
+        for channel in channels:
+            channel.close()
+
+    result[-1].teardown = close
+    return result
+
+
+def notes() -> List[str]:
+    lines = ['Encoded size, bytes:']
+    for sample, message in SAMPLES.items():
+        sizes = ', '.join(f'{codec.name} {len(codec.encode(message))}' for codec in CODECS)
+        lines.append(f'  {sample:<12} {sizes}')
+    users = {RESPONSE: 202, LIST_INFO: [f'user{i}' for i in range(1000)]}
+    compression = ZlibCompression()
+    for codec in CODECS:
+        payload = codec.encode(users)
+        # Второй кадр того же соединения: словарь zlib уже прогрет первым
+        first = len(compression.compress(payload))
+        second = len(compression.compress(payload))
+        lines.append(f'  1000 users   {codec.name} {len(payload)} -> zlib {first}, repeated frame {second}')
+    return lines
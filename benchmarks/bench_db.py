@@ -0,0 +1,132 @@
+import contextlib
+import io
+import itertools
+import os
+from datetime import date, datetime, timedelta
+from typing import List
+
+from harness import Benchmark
+from fixtures import TempDir
+from db.server_db import ServerDB
+from db.client_db import ClientDB
+
+USERS = 200
+# История входов, на которой видно, пользуются ли запросы индексами: столько строк за HISTORY_DAYS дней
+HISTORY_USERS = 200
+HISTORY_ROWS = 200000
+HISTORY_DAYS = 60
+
+
+def server_db_benchmarks() -> List[Benchmark]:
+    tmp = TempDir()
+    database = ServerDB(os.path.join(tmp.path, 'server_bench.db3'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(USERS):
+            database.user_login(f'user{i}', '127.0.0.1', 10000 + i)
+    for i in range(1, 20):
+        database.add_contact('user0', f'user{i}')
+
+    counter = itertools.count()
+
+    def login_logout():
+        # Активный пользователь может войти только один раз, поэтому меряем пару
+        name = f'user{next(counter) % USERS}'
+        database.user_logout(name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            database.user_login(name, '127.0.0.1', 7777)
+
+    def add_remove_contact():
+        database.add_contact('user1', 'user2')
+        database.remove_contact('user1', 'user2')
+
+    def close():
+        database.session.close()
+        database.database_engine.dispose()
+        tmp.cleanup()
+
+    return [
+        Benchmark('ServerDB.user_logout+user_login', login_logout, number=200),
+        Benchmark('ServerDB.users_list', database.users_list, number=200),
+        Benchmark('ServerDB.active_users_list', database.active_users_list, number=200),
+        Benchmark('ServerDB.login_history', database.login_history, number=100),
+        Benchmark('ServerDB.login_history(user)', lambda: database.login_history('user0'), number=200),
+        Benchmark('ServerDB.process_message', lambda: database.process_message('user0', 'user1'), number=200),
+        Benchmark('ServerDB.add_contact+remove_contact', add_remove_contact, number=200),
+        Benchmark('ServerDB.get_contacts', lambda: database.get_contacts('user0'), number=500),
+        Benchmark('ServerDB.message_history', database.message_history, number=200, teardown=close),
+    ]
+
+
+def login_history_benchmarks() -> List[Benchmark]:
+    tmp = TempDir()
+    database = ServerDB(os.path.join(tmp.path, 'history_bench.db3'))
+    database.session.execute(ServerDB.AllUsers.__table__.insert(),
+                             [{'name': f'user{i}', 'last_login': datetime.now()} for i in range(HISTORY_USERS)])
+    start = datetime.now() - timedelta(days=HISTORY_DAYS)
+    step = timedelta(days=HISTORY_DAYS) / HISTORY_ROWS
+    database.session.execute(ServerDB.LoginHistory.__table__.insert(), [
+        {'user_id': i % HISTORY_USERS + 1, 'ip_address': '127.0.0.1', 'port': 7777, 'login_time': start + step * i}
+        for i in range(HISTORY_ROWS)])
+    database.session.commit()
+    database.rebuild_daily_logins()
+
+    month_ago = date.today() - timedelta(days=30)
+    day = datetime.combine(month_ago, datetime.min.time())
+    cursor = None
+    for _ in range(10):
+        _, cursor = database.login_history_page('user0', limit=10, after=cursor)
+
+    def close():
+        database.session.close()
+        database.database_engine.dispose()
+        tmp.cleanup()
+
+    rows = f'{HISTORY_ROWS // 1000}k'
+    return [
+        Benchmark(f'ServerDB.login_history(user) of {rows}', lambda: database.login_history('user0'), number=50),
+        Benchmark(f'ServerDB.login_history one day of {rows}',
+                  lambda: database.login_history(since=day, until=day + timedelta(days=1)), number=50),
+        Benchmark(f'ServerDB.login_history_page of {rows}', database.login_history_page, number=200),
+        Benchmark(f'ServerDB.login_history_page(user) p.11 of {rows}',
+                  lambda: database.login_history_page('user0', limit=10, after=cursor), number=200),
+        Benchmark('ServerDB.daily_logins(user) 30 days',
+                  lambda: database.daily_logins('user0', since=month_ago), number=200),
+        Benchmark('ServerDB.login_totals 30 days', lambda: database.login_totals(since=month_ago), number=20,
+                  teardown=close),
+    ]
+
+
+def client_db_benchmarks() -> List[Benchmark]:
+    tmp = TempDir()
+    # ClientDB создаёт файл базы в текущем каталоге
+    with tmp.chdir():
+        database = ClientDB('bench')
+    database.add_users([f'user{i}' for i in range(USERS)])
+    for i in range(20):
+        database.add_contact(f'user{i}')
+    for i in range(200):
+        database.save_message('bench', f'user{i % 20}', 'Hello, how are you?')
+
+    def add_del_contact():
+        database.add_contact('user100')
+        database.del_contact('user100')
+
+    def close():
+        database.session.close()
+        database.database_engine.dispose()
+        tmp.cleanup()
+
+    return [
+        Benchmark('ClientDB.add_contact+del_contact', add_del_contact, number=200),
+        Benchmark('ClientDB.add_users', lambda: database.add_users([]), number=500),
+        Benchmark('ClientDB.save_message', lambda: database.save_message('bench', 'user1', 'Hi'), number=200),
+        Benchmark('ClientDB.get_contacts', database.get_contacts, number=500),
+        Benchmark('ClientDB.get_users', database.get_users, number=500),
+        Benchmark('ClientDB.check_user', lambda: database.check_user('user150'), number=500),
+        Benchmark('ClientDB.check_contact', lambda: database.check_contact('user10'), number=500),
+        Benchmark('ClientDB.get_history', lambda: database.get_history(to_who='user1'), number=200, teardown=close),
+    ]
+
+
+def benchmarks() -> List[Benchmark]:
+    return server_db_benchmarks() + login_history_benchmarks() + client_db_benchmarks()
@@ -0,0 +1,44 @@
+import os
+from typing import List
+
+from harness import Benchmark
+from fixtures import TempDir, chat_message
+from journal import MessageJournal, replay
+
+GROUP = 100
+REPLAY_RECORDS = 10000
+
+
+def benchmarks() -> List[Benchmark]:
+    tmp = TempDir()
+    message = chat_message('alice', 'bob')
+    # Без fsync - стоимость самого журнала, с fsync на каждой группе - верхняя граница задержки записи
+    buffered = MessageJournal(os.path.join(tmp.path, 'buffered'), fsync_interval=None)
+    synced = MessageJournal(os.path.join(tmp.path, 'synced'), fsync_interval=0)
+    replayed = MessageJournal(os.path.join(tmp.path, 'replayed'), fsync_interval=None)
+    for _ in range(REPLAY_RECORDS):
+        replayed.append(message)
+    replayed.commit()
+
+    def group_commit(journal: MessageJournal):
+        def commit():
+            for _ in range(GROUP):
+                journal.append(message)
+            journal.commit()
+        return commit
+
+    def replay_all():
+        for _ in replay(replayed.path):
+            pass
+
+    def close():
+        for journal in (buffered, synced, replayed):
+            journal.close()
+        tmp.cleanup()
+
+    return [
+        Benchmark('MessageJournal.append', lambda: buffered.append(message), number=10000),
+        Benchmark(f'MessageJournal group of {GROUP} without fsync', group_commit(buffered), number=200),
+        Benchmark(f'MessageJournal group of {GROUP} with fsync', group_commit(synced), number=50),
+        Benchmark(f'journal.replay of {REPLAY_RECORDS} records', replay_all, number=5, teardown=close),
+    ]
@@ -0,0 +1,90 @@
+import logging
+import logging.handlers
+import os
+import queue
+from typing import List
+
+from harness import Benchmark
+from fixtures import tcp_pair, chat_message, TempDir
+from db.server_db import ServerDB
+from logs.handlers import RateLimitFilter, LocalQueueHandler
+from server import Server, logger, traffic_logger
+from variables import *
+
+
+# Стоимость логирования на пути доставки сообщения при разных настройках логгера 'server'
+class LoggingMode:
+    def __init__(self, tmp: TempDir, queued: bool, rate: float = 0, enabled: bool = True) -> None:
+        self.tmp = tmp
+        self.queued = queued
+        self.rate = rate
+        self.enabled = enabled
+
+    def setup(self) -> None:
+        self.saved = (logger.handlers[:], logger.level, traffic_logger.filters[:])
+        logger.handlers.clear()
+        traffic_logger.filters.clear()
+        self.devnull = open(os.devnull, 'w')
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(message)s')
+        handlers = [logging.StreamHandler(self.devnull), logging.FileHandler(os.path.join(self.tmp.path, 'bench.log'))]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        self.listener = None
+        if self.queued:
+            log_queue = queue.SimpleQueue()
+            self.listener = logging.handlers.QueueListener(log_queue, *handlers)
+            self.listener.start()
+            logger.addHandler(LocalQueueHandler(log_queue))
+        else:
+            for handler in handlers:
+                logger.addHandler(handler)
+        if self.rate:
+            traffic_logger.addFilter(RateLimitFilter(self.rate))
+        logger.setLevel(logging.DEBUG if self.enabled else logging.WARNING)
+        self.handlers = handlers
+
+    def teardown(self) -> None:
+        if self.listener:
+            self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+        self.devnull.close()
+        handlers, level, filters = self.saved
+        logger.handlers[:] = handlers
+        logger.setLevel(level)
+        traffic_logger.filters[:] = filters
+
+
+def benchmarks() -> List[Benchmark]:
+    tmp = TempDir()
+    database = ServerDB(os.path.join(tmp.path, 'server_bench.db3'))
+    server = Server('127.0.0.1', DEFAULT_PORT, database)
+    bob_server, bob = tcp_pair()
+    server.names['bob'] = bob_server
+    message = chat_message('alice', 'bob')
+
+    def route_message():
+        server.process_message(message, [bob_server])
+        bob.recv(MAX_PACKAGE_LENGTH)
+
+    modes = [
+        ('logging disabled', LoggingMode(tmp, queued=False, enabled=False)),
+        ('sync stream+file handlers', LoggingMode(tmp, queued=False)),
+        ('queued handlers', LoggingMode(tmp, queued=True)),
+        ('queued, rate limited 50/s', LoggingMode(tmp, queued=True, rate=50)),
+    ]
+    result = [
+        Benchmark(f'logging.route {name}', route_message, number=5000, setup=mode.setup, teardown=mode.teardown)
+        for name, mode in modes
+    ]
+
+    def close():
+        modes[-1][1].teardown()
+        bob_server.close()
+        bob.close()
+        database.session.close()
+        database.database_engine.dispose()
+        tmp.cleanup()
+
+    result[-1].teardown = close
+    return result
@@ -0,0 +1,48 @@
+from typing import List
+
+from harness import Benchmark
+from fixtures import tcp_pair, chat_message
+from codec import BinaryCodec
+from messages import Channel, get_message, send_message
+from variables import *
+
+
+def benchmarks() -> List[Benchmark]:
+    left, right = tcp_pair()
+    short = chat_message('alice', 'bob')
+    # Самое длинное сообщение, которое ещё помещается в MAX_PACKAGE_LENGTH
+    long = chat_message('alice', 'bob', 'x' * 900)
+
+    def roundtrip_short():
+        send_message(left, short)
+        get_message(right)
+
+    def roundtrip_long():
+        send_message(left, long)
+        get_message(right)
+
+    def send_only():
+        send_message(left, short)
+        right.recv(MAX_PACKAGE_LENGTH)
+
+    # Пачка кадров, пришедшая одним куском: разбирается из буфера без новых recv
+    burst_left, burst_right = tcp_pair()
+    sender, receiver = Channel(burst_left, BinaryCodec()), Channel(burst_right, BinaryCodec())
+
+    def read_burst():
+        for _ in range(50):
+            send_message(sender, short)
+        received = 0
+        while received < 50:
+            received += len(receiver.read_messages())
+
+    def close():
+        for sock in (left, right, burst_left, burst_right):
+            sock.close()
+
+    return [
+        Benchmark('messages.send+get short', roundtrip_short, number=5000),
+        Benchmark('messages.send+get 900b text', roundtrip_long, number=5000),
+        Benchmark('messages.send_message', send_only, number=5000),
+        Benchmark('channel.bin1 50 frames burst', read_burst, number=200, teardown=close),
+    ]
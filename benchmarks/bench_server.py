@@ -0,0 +1,145 @@
+import contextlib
+import io
+import logging
+import os
+from typing import List
+
+from harness import Benchmark
+from fixtures import tcp_pair, chat_message, presence, TempDir
+from db.server_db import ServerDB
+from server import Server
+from protocol import compile_validators
+from codec import BinaryCodec
+from messages import Channel
+from variables import *
+
+GROUP_SIZE = 50
+
+
+def benchmarks() -> List[Benchmark]:
+    # Здесь меряется только обработка запросов, стоимость логирования - в bench_logging
+    logging.getLogger('server').setLevel(logging.WARNING)
+    tmp = TempDir()
+    database = ServerDB(os.path.join(tmp.path, 'server_bench.db3'))
+    server = Server('127.0.0.1', DEFAULT_PORT, database)
+
+    alice_server, alice = tcp_pair()
+    bob_server, bob = tcp_pair()
+    server.clients.extend([alice_server, bob_server])
+    with contextlib.redirect_stdout(io.StringIO()):
+        server.process_client_message(presence('alice'), alice_server)
+        server.process_client_message(presence('bob'), bob_server)
+    alice.recv(MAX_PACKAGE_LENGTH)
+    bob.recv(MAX_PACKAGE_LENGTH)
+    database.add_contact('alice', 'bob')
+
+    message = chat_message('alice', 'bob')
+    contacts_request = {ACTION: GET_CONTACTS, TIME: 1.0, USER: 'alice'}
+    users_request = {ACTION: USERS_REQUEST, TIME: 1.0, ACCOUNT_NAME: 'alice'}
+    bad_request = {ACTION: 'unknown', TIME: 1.0}
+    # PONG ничего не делает: время его разбора - чистая стоимость выбора обработчика
+    pong = {ACTION: PONG, TIME: 1.0}
+    # Запросы с известным действием, но без нужного поля и от чужого имени: ответ 400 без исключений
+    malformed_message = {ACTION: MESSAGE, TIME: 1.0, SENDER: 'alice', MESSAGE_TEXT: 'Hello'}
+    foreign_contacts = {ACTION: GET_CONTACTS, TIME: 1.0, USER: 'nobody'}
+    validate_fast = compile_validators('fast')[MESSAGE]
+    validate_pydantic = compile_validators('pydantic')[MESSAGE]
+
+    def dispatch_message():
+        server.process_client_message(message, alice_server)
+        server.messages.clear()
+
+    def dispatch_contacts():
+        server.process_client_message(contacts_request, alice_server)
+        alice.recv(MAX_PACKAGE_LENGTH)
+
+    def dispatch_users():
+        server.process_client_message(users_request, alice_server)
+        alice.recv(MAX_PACKAGE_LENGTH)
+
+    def dispatch_bad():
+        server.process_client_message(bad_request, alice_server)
+        alice.recv(MAX_PACKAGE_LENGTH)
+
+    def dispatch_malformed():
+        server.process_client_message(malformed_message, alice_server)
+        alice.recv(MAX_PACKAGE_LENGTH)
+
+    def dispatch_foreign():
+        server.process_client_message(foreign_contacts, alice_server)
+        alice.recv(MAX_PACKAGE_LENGTH)
+
+    def route_message():
+        server.process_message(message, [bob_server])
+        bob.recv(MAX_PACKAGE_LENGTH)
+
+    # Рассылка на GROUP_SIZE получателей: одним групповым сообщением и отдельными сообщениями
+    group = [tcp_pair() for _ in range(GROUP_SIZE)]
+    group_names = [f'member{index}' for index in range(GROUP_SIZE)]
+    for name, (member_server, member) in zip(group_names, group):
+        member_server = Channel(member_server, BinaryCodec())
+        server.clients.append(member_server)
+        with contextlib.redirect_stdout(io.StringIO()):
+            server.process_client_message(presence(name), member_server)
+        member.recv(MAX_PACKAGE_LENGTH)
+    group_server = [server.names[name] for name in group_names]
+    group_message = chat_message('alice', group_names)
+    single_messages = [chat_message('alice', name) for name in group_names]
+
+    def drain_group():
+        for _, member in group:
+            member.recv(65536)
+
+    def fan_out_group():
+        server.process_message(group_message, group_server)
+        drain_group()
+
+    def route_one_by_one():
+        for single in single_messages:
+            server.process_message(single, group_server)
+        drain_group()
+
+    def dispatch_group():
+        server.process_client_message(group_message, alice_server)
+        server.messages.clear()
+
+    def dispatch_one_by_one():
+        for single in single_messages:
+            server.process_client_message(single, alice_server)
+        server.messages.clear()
+
+    # Те же GROUP_SIZE сообщений одной пачкой: одна транзакция в базе и один ответ
+    batch_request = {ACTION: BATCH, TIME: 1.0, LIST_INFO: single_messages}
+
+    def dispatch_batch():
+        server.process_client_message(batch_request, alice_server)
+        alice.recv(MAX_PACKAGE_LENGTH)
+        server.messages.clear()
+
+    def close():
+        for sock in (alice_server, alice, bob_server, bob):
+            sock.close()
+        for member_server, member in group:
+            member_server.close()
+            member.close()
+        database.session.close()
+        database.database_engine.dispose()
+        tmp.cleanup()
+
+    return [
+        Benchmark('server.dispatch MESSAGE', dispatch_message, number=500),
+        Benchmark('server.dispatch GET_CONTACTS', dispatch_contacts, number=1000),
+        Benchmark('server.dispatch USERS_REQUEST', dispatch_users, number=1000),
+        Benchmark('server.dispatch bad request', dispatch_bad, number=5000),
+        Benchmark('server.dispatch PONG', lambda: server.process_client_message(pong, alice_server), number=20000),
+        Benchmark('server.dispatch malformed MESSAGE', dispatch_malformed, number=5000),
+        Benchmark('server.dispatch GET_CONTACTS of another user', dispatch_foreign, number=5000),
+        Benchmark('protocol.validate MESSAGE fast', lambda: validate_fast(message), number=20000),
+        Benchmark('protocol.validate MESSAGE pydantic', lambda: validate_pydantic(message), number=20000),
+        Benchmark('server.process_message route', route_message, number=5000),
+        Benchmark(f'server.route {GROUP_SIZE} recipients one by one', route_one_by_one, number=200),
+        Benchmark(f'server.route {GROUP_SIZE} recipients fan-out', fan_out_group, number=200),
+        Benchmark(f'server.dispatch {GROUP_SIZE} single MESSAGE', dispatch_one_by_one, number=20),
+        Benchmark(f'server.dispatch BATCH of {GROUP_SIZE} MESSAGE', dispatch_batch, number=200),
+        Benchmark(f'server.dispatch group MESSAGE to {GROUP_SIZE}', dispatch_group, number=200, teardown=close),
+    ]
@@ -0,0 +1,104 @@
+import logging
+import os
+import socket
+import time
+from typing import List
+
+from harness import Benchmark
+from fixtures import tcp_pair, chat_message, presence, TempDir
+from db.server_db import ServerDB
+from server import Server
+from codec import BinaryCodec, CODECS
+from messages import Channel, get_message, send_message
+from variables import *
+
+# Срок проверки живости, которого бенчмарки не достигнут
+HEARTBEAT_DISABLED = 24 * 3600
+
+
+def free_port() -> int:
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+# Сервер поднимает слушающие сокеты уже в своём потоке
+def connect(family: int, address) -> socket.socket:
+    for _ in range(100):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+        except (ConnectionRefusedError, FileNotFoundError):
+            sock.close()
+            time.sleep(0.05)
+        else:
+            return sock
+    raise ConnectionError(f'Server is not listening on {address}')
+
+
+def login(sock: socket.socket, name: str) -> Channel:
+    channel = Channel(sock)
+    hello = presence(name)
+    hello[WIRE_CODECS] = [BinaryCodec.name]
+    send_message(channel, hello)
+    channel.codec = CODECS[channel.read_handshake()[WIRE_CODEC]]
+    return channel
+
+
+def benchmarks() -> List[Benchmark]:
+    logging.getLogger('server').setLevel(logging.WARNING)
+    tmp = TempDir()
+    message = chat_message('alice', 'bob')
+
+    # Кадр туда и обратно между двумя сокетами одного процесса: только стоимость транспорта
+    tcp = [Channel(sock, BinaryCodec()) for sock in tcp_pair()]
+    unix = [Channel(sock, BinaryCodec()) for sock in socket.socketpair()]
+
+    def pair_roundtrip(left: Channel, right: Channel):
+        def roundtrip():
+            left.write_message(message)
+            right.read_message()
+            right.write_message(message)
+            left.read_message()
+        return roundtrip
+
+    # Запрос через работающий сервер, который слушает и TCP, и Unix-сокет. Запрос без
+    # обращения к базе (ответ 400), чтобы разница транспортов не терялась на фоне SQLite.
+    # Сервер поднимается при сборе бенчмарков, а клиенты не отвечают на PING: без долгой проверки
+    # живости сервер отключил бы их, пока идут бенчмарки других модулей.
+    path = os.path.join(tmp.path, 'server.sock')
+    server = Server('127.0.0.1', free_port(), ServerDB(os.path.join(tmp.path, 'server_bench.db3')),
+                    rate_limits={'unknown': None}, endpoints=[path], heartbeat_interval=HEARTBEAT_DISABLED,
+                    heartbeat_timeout=HEARTBEAT_DISABLED)
+    server.daemon = True
+    server.start()
+    clients = {
+        'tcp': login(connect(socket.AF_INET, (server.addr, server.port)), 'tcp_bot'),
+        'unix': login(connect(socket.AF_UNIX, path), 'unix_bot'),
+    }
+    request = {ACTION: 'echo', TIME: 1.0}
+
+    def server_roundtrip(client: Channel):
+        def roundtrip():
+            client.write_message(request)
+            client.read_message()
+        return roundtrip
+
+    def close():
+        for channel in tcp + unix + list(clients.values()):
+            channel.close()
+        # База удаляется только после того, как сервер отметит выход клиентов
+        deadline = time.monotonic() + 5
+        while (server.names or server.logouts) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        tmp.cleanup()
+
+    return [
+        Benchmark('transport.tcp loopback frame roundtrip', pair_roundtrip(*tcp), number=5000),
+        Benchmark('transport.unix socket frame roundtrip', pair_roundtrip(*unix), number=5000),
+        Benchmark('transport.tcp server request roundtrip', server_roundtrip(clients['tcp']), number=2000),
+        Benchmark('transport.unix server request roundtrip', server_roundtrip(clients['unix']), number=2000,
+                  teardown=close),
+    ]
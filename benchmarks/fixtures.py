@@ -0,0 +1,58 @@
+import contextlib
+import os
+import shutil
+import socket
+import tempfile
+import time
+from typing import List, Tuple, Union
+
+import harness  # noqa: F401  (добавляет main/ в sys.path)
+from variables import *
+
+
+def tcp_pair() -> Tuple[socket.socket, socket.socket]:
+    # socketpair() отдаёт AF_UNIX, а серверу нужен getpeername() вида (ip, port)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server_side, _ = listener.accept()
+    listener.close()
+    return server_side, client
+
+
+class TempDir:
+    def __init__(self) -> None:
+        self.path = tempfile.mkdtemp(prefix='bench_')
+
+    @contextlib.contextmanager
+    def chdir(self):
+        cwd = os.getcwd()
+        os.chdir(self.path)
+        try:
+            yield self.path
+        finally:
+            os.chdir(cwd)
+
+    def cleanup(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def chat_message(sender: str, destination: Union[str, List[str]], text: str = 'Hello, how are you?') -> dict:
+    return {
+        ACTION: MESSAGE,
+        SENDER: sender,
+        DESTINATION: destination,
+        TIME: time.time(),
+        MESSAGE_TEXT: text
+    }
+
+
+def presence(name: str) -> dict:
+    return {
+        ACTION: PRESENCE,
+        TIME: time.time(),
+        USER: {
+            ACCOUNT_NAME: name
+        }
+    }
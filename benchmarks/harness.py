@@ -0,0 +1,104 @@
+import gc
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, 'main')
+if MAIN not in sys.path:
+    sys.path.insert(0, MAIN)
+
+
+class Benchmark:
+    def __init__(self, name: str, func: Callable[[], None], number: int = 1000, repeat: int = 5,
+                 setup: Optional[Callable[[], None]] = None, teardown: Optional[Callable[[], None]] = None) -> None:
+        self.name = name
+        self.func = func
+        self.number = number
+        self.repeat = repeat
+        self.setup = setup
+        self.teardown = teardown
+
+    def run(self) -> Dict[str, float]:
+        if self.setup:
+            self.setup()
+        func = self.func
+        timings = []
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            # Прогрев, чтобы первый замер не включал ленивые инициализации
+            for _ in range(min(self.number, 10)):
+                func()
+            for _ in range(self.repeat):
+                start = time.perf_counter()
+                for _ in range(self.number):
+                    func()
+                timings.append((time.perf_counter() - start) / self.number)
+        finally:
+            if gc_enabled:
+                gc.enable()
+            if self.teardown:
+                self.teardown()
+        return {
+            'min_us': min(timings) * 1e6,
+            'median_us': statistics.median(timings) * 1e6,
+            'ops_per_sec': 1 / min(timings),
+        }
+
+
+class Suite:
+    def __init__(self) -> None:
+        self.benchmarks: List[Benchmark] = []
+
+    def add(self, name: str, number: int = 1000, repeat: int = 5, setup=None, teardown=None):
+        def decorator(func):
+            self.benchmarks.append(Benchmark(name, func, number, repeat, setup, teardown))
+            return func
+        return decorator
+
+    def extend(self, benchmarks: List[Benchmark]) -> None:
+        self.benchmarks.extend(benchmarks)
+
+    def run(self, pattern: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+        results = {}
+        for benchmark in self.benchmarks:
+            if pattern and pattern not in benchmark.name:
+                # Освобождаем ресурсы фикстур, даже если замер пропущен
+                if benchmark.teardown:
+                    benchmark.teardown()
+                continue
+            results[benchmark.name] = benchmark.run()
+        return results
+
+
+def load_baseline(path: str) -> Dict[str, Dict[str, float]]:
+    with open(path, encoding='utf-8') as baseline:
+        return json.load(baseline)
+
+
+def save_baseline(path: str, results: Dict[str, Dict[str, float]]) -> None:
+    with open(path, 'w', encoding='utf-8') as baseline:
+        json.dump(results, baseline, indent=2, sort_keys=True)
+
+
+def format_results(results: Dict[str, Dict[str, float]],
+                   baseline: Optional[Dict[str, Dict[str, float]]] = None) -> str:
+    header = f'{"benchmark":<45} {"min, us":>12} {"median, us":>12} {"ops/sec":>12}'
+    if baseline is not None:
+        header += f' {"baseline, us":>13} {"change":>9}'
+    lines = [header, '-' * len(header)]
+    for name, result in results.items():
+        line = f'{name:<45} {result["min_us"]:>12.2f} {result["median_us"]:>12.2f} {result["ops_per_sec"]:>12.0f}'
+        if baseline is not None:
+            if name in baseline:
+                base = baseline[name]['min_us']
+                change = (result['min_us'] - base) / base * 100
+                line += f' {base:>13.2f} {change:>+8.1f}%'
+            else:
+                line += f' {"-":>13} {"new":>9}'
+        lines.append(line)
+    return '\n'.join(lines)
@@ -0,0 +1,44 @@
+import glob
+import importlib
+import os
+from typing import Optional, Tuple
+
+import click
+
+from harness import Suite, format_results, load_baseline, save_baseline
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def discover(modules: Tuple[str, ...]) -> Suite:
+    suite = Suite()
+    suite.notes = []
+    names = modules or sorted(
+        os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(BENCH_DIR, 'bench_*.py'))
+    )
+    for name in names:
+        module = importlib.import_module(name if name.startswith('bench_') else f'bench_{name}')
+        suite.extend(module.benchmarks())
+        if hasattr(module, 'notes'):
+            suite.notes.extend(module.notes())
+    return suite
+
+
+@click.command()
+@click.argument('modules', nargs=-1)
+@click.option('--filter', '-k', 'pattern', default=None, help='Run only benchmarks whose name contains this string')
+@click.option('--save', '-s', default=None, help='Save results as a JSON baseline')
+@click.option('--compare', '-c', default=None, help='Compare results with a saved JSON baseline')
+def run(modules: Tuple[str, ...], pattern: Optional[str], save: Optional[str], compare: Optional[str]) -> None:
+    baseline = load_baseline(compare) if compare else None
+    suite = discover(modules)
+    results = suite.run(pattern)
+    print(format_results(results, baseline))
+    for line in suite.notes:
+        print(line)
+    if save:
+        save_baseline(save, results)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,557 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+import click
+
+import logs.config_client_log
+from client import (addressed_to, create_batch, create_presence, create_users_request, create_contacts_request,
+                    process_list_ans, process_response_ans, unsolicited)
+from codec import CODECS, SUPPORTED_CODECS, COMPRESSIONS, SUPPORTED_COMPRESSIONS
+from db.client_db import ClientDB
+from errors import IncorrectDataRecivedError, ServerError
+from files import Transfer, UPLOAD, DOWNLOAD
+from messages import (FRAME_HEADER, FRAME_LENGTH_MASK, data_frame_header, decode_handshake, decode_legacy,
+                      decode_payload, encode_frame)
+from stats.metrics import Registry
+from stats.tracing import start_trace, add_hop, record_trace, HOP_CLIENT_RECV
+from variables import *
+
+logger = logging.getLogger('client')
+traffic_logger = logging.getLogger('client.traffic')
+
+# Сколько раз send_file начинает загрузку заново со смещения, которое назвал сервер
+FILE_UPLOAD_ATTEMPTS = 5
+
+
+class AsyncClient:
+    """Клиент JIM на asyncio для ботов, интеграций и нагрузочных тестов.
+
+    Одна сессия - одно соединение и одна задача чтения, без потоков, поэтому в одном
+    процессе помещаются тысячи сессий. Входящие сообщения складываются в очередь
+    и читаются через receive() или async for. Запросы помечаются request_id, и их
+    можно держать в полёте сколько угодно одновременно.
+
+    database - необязательное хранилище ClientDB. Его вызовы синхронные и выполняются
+    прямо в цикле событий, поэтому для больших флотов его лучше не передавать.
+    """
+
+    def __init__(self, account_name: str, database: Optional[ClientDB] = None, codec: str = SUPPORTED_CODECS[0],
+                 compress: bool = True, metrics: Optional[Registry] = None) -> None:
+        self.account_name = account_name
+        self.database = database
+        self.offered_codec = codec
+        self.compress = compress
+        self.metrics = metrics or Registry()
+        self.codec = None
+        self.compression = None
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.incoming: 'asyncio.Queue[Optional[dict]]' = asyncio.Queue()
+        self.ids = itertools.count(1)
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.read_task: Optional[asyncio.Task] = None
+        self.closed = False
+        # Сколько отправленных сообщений сервер отклонил (лимит запросов или перегрузка)
+        self.rejected = 0
+        # Контакты в сети, по уведомлениям сервера CONTACT_STATUS
+        self.online: Set[str] = set()
+        # Скачиваемые файлы по идентификатору: файл на диске, статистика и признак завершения
+        self.downloads: Dict[str, Tuple[Any, Transfer, asyncio.Future]] = {}
+        # Адрес последнего подключения и токен продолжения сессии для reconnect
+        self.address: Optional[Tuple[str, int, Optional[str]]] = None
+        self.token: Optional[str] = None
+        self.resumed = False
+        self.leftover = b''
+
+    async def connect(self, addr: str = DEFAULT_IP_ADDRESS, port: int = DEFAULT_PORT,
+                      path: Optional[str] = None) -> str:
+        """Подключается по TCP или, если задан path, через Unix-сокет сервера."""
+        if path:
+            self.reader, self.writer = await asyncio.open_unix_connection(path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(addr, port)
+        offered = None if self.offered_codec == 'legacy' else \
+            [self.offered_codec] + [other for other in SUPPORTED_CODECS if other != self.offered_codec]
+        presence = create_presence(self.account_name, offered, SUPPORTED_COMPRESSIONS if self.compress else None)
+        if self.token:
+            presence[RESUME_TOKEN] = self.token
+        # Ответ на PRESENCE приходит в старом формате: один JSON без заголовка
+        self.writer.write(json.dumps(presence).encode(ENCODING))
+        try:
+            data = await self.reader.read(MAX_PACKAGE_LENGTH)
+            if not data:
+                raise ConnectionError('Connection closed by peer')
+            response, size = decode_handshake(data)
+            # Кадры, пришедшие в одном чтении с ответом, читаются первыми
+            self.leftover = data[size:]
+            answer = process_response_ans(response)
+        except Exception:
+            self.writer.close()
+            raise
+        self.codec = self.compression = None
+        if response.get(WIRE_CODEC) in CODECS:
+            self.codec = CODECS[response[WIRE_CODEC]]
+            if response.get(WIRE_COMPRESSION) in COMPRESSIONS:
+                self.compression = COMPRESSIONS[response[WIRE_COMPRESSION]]()
+        self.address = (addr, port, path)
+        self.token = response.get(RESUME_TOKEN)
+        self.resumed = bool(response.get(RESUMED))
+        self.read_task = asyncio.ensure_future(self._read_loop())
+        logger.debug('%s connected to %s, codec: %s', self.account_name, path or f'{addr}:{port}',
+                     response.get(WIRE_CODEC))
+        return answer
+
+    async def reconnect(self) -> bool:
+        """Подключается заново к тому же серверу после обрыва.
+
+        Паузы между попытками растут вдвое до CLIENT_RECONNECT_MAX_DELAY, и из каждой берётся
+        случайная доля, чтобы флот после падения сервера не подключался одной волной. Возвращает
+        True, если сервер продолжил сессию по токену: тогда он сам досылает сообщения, пришедшие
+        за время обрыва, и повторная load() не нужна.
+        """
+        if self.address is None:
+            raise ConnectionError('Client was never connected')
+        if self.writer is not None:
+            self.writer.close()
+        if self.read_task is not None:
+            self.read_task.cancel()
+            try:
+                await self.read_task
+            except asyncio.CancelledError:
+                pass
+        # Признак конца соединения из очереди убирается, полученные сообщения остаются
+        messages = []
+        while not self.incoming.empty():
+            message = self.incoming.get_nowait()
+            if message is not None:
+                messages.append(message)
+        for message in messages:
+            self.incoming.put_nowait(message)
+        # Кто из контактов в сети, сервер пришлёт заново
+        self.online.clear()
+        for attempt in itertools.count():
+            delay = min(CLIENT_RECONNECT_MAX_DELAY, CLIENT_RECONNECT_DELAY * 2 ** min(attempt, 16))
+            await asyncio.sleep(random.uniform(0, delay))
+            try:
+                await self.connect(*self.address)
+            except (OSError, ConnectionError, ValueError, IncorrectDataRecivedError, ServerError) as error:
+                logger.warning('%s: reconnect attempt %s failed: %s', self.account_name, attempt + 1, error)
+                continue
+            return self.resumed
+
+    async def _read_message(self) -> dict:
+        if self.codec is None:
+            data = await self.reader.read(MAX_PACKAGE_LENGTH)
+            if not data:
+                raise ConnectionError('Connection closed by peer')
+            return decode_legacy(data)[0]
+        header = FRAME_HEADER.unpack(await self._read_exactly(FRAME_HEADER.size))[0]
+        size = header & FRAME_LENGTH_MASK
+        if size > MAX_FRAME_LENGTH:
+            raise IncorrectDataRecivedError
+        return decode_payload(self.codec, self.compression, header >> 24, await self._read_exactly(size))
+
+    async def _read_exactly(self, size: int) -> bytes:
+        if not self.leftover:
+            return await self.reader.readexactly(size)
+        data, self.leftover = self.leftover[:size], self.leftover[size:]
+        if len(data) < size:
+            data += await self.reader.readexactly(size - len(data))
+        return data
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                try:
+                    message = await self._read_message()
+                except IncorrectDataRecivedError:
+                    logger.error('Failed to decode received message.')
+                    continue
+                if unsolicited(message, self.codec is not None):
+                    self.rejected += 1
+                    logger.warning('%s: server rejected a message: %s', self.account_name, message.get(ERROR))
+                elif RESPONSE in message:
+                    self._resolve(message)
+                elif message.get(ACTION) == PING:
+                    await self._write({ACTION: PONG, TIME: time.time()})
+                elif message.get(ACTION) == CONTACT_STATUS:
+                    self.online.update(message.get(ONLINE, ()))
+                    self.online.difference_update(message.get(OFFLINE, ()))
+                    traffic_logger.info('%s: contacts online %s, offline %s', self.account_name,
+                                        message.get(ONLINE), message.get(OFFLINE))
+                elif message.get(ACTION) == FILE_CHUNK and FILE_DATA in message:
+                    self._receive_chunk(message)
+                elif message.get(ACTION) == FILE and addressed_to(message, self.account_name) \
+                        and SENDER in message and FILE_ID in message:
+                    traffic_logger.info('Receive file %s from %s', message[FILE_ID], message[SENDER])
+                    self.incoming.put_nowait(message)
+                elif message.get(ACTION) == MESSAGE and addressed_to(message, self.account_name) \
+                        and SENDER in message and MESSAGE_TEXT in message:
+                    if TRACE in message:
+                        add_hop(message, HOP_CLIENT_RECV)
+                        record_trace(message, self.metrics, 'client')
+                    traffic_logger.info('Receive message from %s', message[SENDER])
+                    if self.database is not None:
+                        self.database.save_message(message[SENDER], self.account_name, message[MESSAGE_TEXT])
+                    self.incoming.put_nowait(message)
+                else:
+                    logger.error('Receive non correct answer from server: %s', message)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            if not self.closed:
+                logger.critical('%s lost connection with server', self.account_name)
+        finally:
+            self._fail_pending(ConnectionError('Lost connection with server'))
+            self._fail_downloads(ConnectionError('Lost connection with server'))
+            self.incoming.put_nowait(None)
+
+    def _resolve(self, response: dict) -> None:
+        if REQUEST_ID in response:
+            future = self.pending.pop(response[REQUEST_ID], None)
+        elif self.codec is None and self.pending:
+            # Старый канал: сервер мог не вернуть request_id и отвечает строго по порядку
+            future = self.pending.pop(next(iter(self.pending)))
+        else:
+            future = None
+        if future is None:
+            logger.error('Response to unknown request: %s', response)
+        elif not future.done():
+            future.set_result(response)
+
+    def _fail_pending(self, error: Exception) -> None:
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    # Куски приходят по порядку, каждый пишется на своё место: так продолжается и прерванное скачивание
+    def _receive_chunk(self, message: dict) -> None:
+        download = self.downloads.get(message.get(FILE_ID))
+        if download is None:
+            logger.error('Chunk of unknown file %s', message.get(FILE_ID))
+            return
+        file, transfer, done = download
+        data = message[FILE_DATA]
+        os.pwrite(file.fileno(), data, message[OFFSET])
+        transfer.size = message[FILE_SIZE]
+        transfer.offset = message[OFFSET] + len(data)
+        if transfer.done and not done.done():
+            done.set_result(transfer)
+
+    def _fail_downloads(self, error: Exception) -> None:
+        for _, _, done in self.downloads.values():
+            if not done.done():
+                done.set_exception(error)
+
+    async def _write(self, message: dict) -> None:
+        if self.writer is None or self.read_task is None or self.read_task.done():
+            raise ConnectionError('Not connected to server')
+        if self.codec is None:
+            self.writer.write(json.dumps(message).encode(ENCODING))
+        else:
+            self.writer.write(encode_frame(self.codec, self.compression, message))
+        await self.writer.drain()
+
+    # Кадр с данными файла: описание кодеком соединения и сырые байты
+    async def _write_data(self, meta: dict, data: bytes) -> None:
+        if self.writer is None or self.read_task is None or self.read_task.done():
+            raise ConnectionError('Not connected to server')
+        self.writer.writelines((data_frame_header(self.codec, meta, len(data)), data))
+        await self.writer.drain()
+
+    async def request(self, req: Dict[str, Any], data: Optional[bytes] = None) -> dict:
+        request_id = next(self.ids)
+        req[REQUEST_ID] = request_id
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            if data is None:
+                await self._write(req)
+            else:
+                await self._write_data(req, data)
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ServerError('Server response timed out')
+        except (OSError, ConnectionError):
+            raise ServerError('Lost connection with server')
+        finally:
+            self.pending.pop(request_id, None)
+
+    # to - имя, список имён или BROADCAST; список сервер рассылает одним пакетом
+    async def send(self, to: Union[str, List[str]], text: str, trace: bool = False) -> None:
+        message = {
+            ACTION: MESSAGE,
+            SENDER: self.account_name,
+            DESTINATION: to,
+            TIME: time.time(),
+            MESSAGE_TEXT: text
+        }
+        if trace:
+            start_trace(message)
+        await self._write(message)
+        if self.database is not None:
+            self.database.save_message(self.account_name, to if isinstance(to, str) else ', '.join(to), text)
+
+    async def send_batch(self, messages: List[Tuple[Union[str, List[str]], str]], trace: bool = False) -> List[int]:
+        """Отправляет пары (адресат, текст) одним кадром и возвращает статус каждого сообщения."""
+        items = []
+        for to, text in messages:
+            item = {ACTION: MESSAGE, SENDER: self.account_name, DESTINATION: to, TIME: time.time(), MESSAGE_TEXT: text}
+            if trace:
+                start_trace(item)
+            items.append(item)
+        ans = await self.request(create_batch(items))
+        if ans.get(RESPONSE) != 200:
+            raise ServerError(f'Batch was rejected: {ans.get(ERROR)}')
+        statuses = ans[LIST_INFO]
+        self.rejected += sum(status != 200 for status in statuses)
+        if self.database is not None:
+            for (to, text), status in zip(messages, statuses):
+                if status == 200:
+                    self.database.save_message(self.account_name, to if isinstance(to, str) else ', '.join(to), text)
+        return statuses
+
+    async def send_file(self, to: Union[str, List[str]], path: str, file_id: Optional[str] = None) -> dict:
+        """Загружает файл для получателей to и возвращает статистику передачи.
+
+        Данные идут кусками по FILE_CHUNK_SIZE без ожидания ответов, ответ приходит только
+        на последний кусок. Если сервер потерял часть кусков, загрузка продолжается с названного
+        им смещения. С file_id продолжается загрузка, прерванная вместе с соединением.
+        """
+        if self.codec is None:
+            raise ServerError('File transfer needs a framed codec')
+        size = os.path.getsize(path)
+        request = {ACTION: FILE_UPLOAD, TIME: time.time(), SENDER: self.account_name, DESTINATION: to,
+                   FILE_NAME: os.path.basename(path), FILE_SIZE: size}
+        if file_id is not None:
+            request[FILE_ID] = file_id
+        ans = await self.request(request)
+        if ans.get(RESPONSE) != 200:
+            raise ServerError(ans.get(ERROR) or 'File upload failed')
+        file_id, offset = ans[FILE_ID], ans[OFFSET]
+        transfer = Transfer(file_id, UPLOAD, size, offset)
+        with open(path, 'rb') as file:
+            for _ in range(FILE_UPLOAD_ATTEMPTS):
+                if offset >= size:
+                    transfer.finish()
+                    return transfer.stats()
+                file.seek(offset)
+                while True:
+                    data = file.read(FILE_CHUNK_SIZE)
+                    meta = {ACTION: FILE_CHUNK, FILE_ID: file_id, OFFSET: offset}
+                    if offset + len(data) < size and data:
+                        await self._write_data(meta, data)
+                        offset += len(data)
+                        continue
+                    ans = await self.request(meta, data)
+                    break
+                if ans.get(RESPONSE) == 200:
+                    return ans[TRANSFER]
+                # Сервер отбросил кусок: 400 называет смещение, с которого продолжать, после 429 повторяется последний
+                if ans.get(RESPONSE) == 400 and OFFSET not in ans:
+                    raise ServerError(ans.get(ERROR) or 'File upload failed')
+                offset = ans.get(OFFSET, offset)
+        raise ServerError('File upload failed')
+
+    async def download(self, file_id: str, path: str) -> dict:
+        """Скачивает файл в path и возвращает статистику передачи.
+
+        Если в path уже лежит начало файла, скачивание продолжается с его конца.
+        """
+        if self.codec is None:
+            raise ServerError('File transfer needs a framed codec')
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        file = open(path, 'r+b' if offset else 'wb')
+        transfer = Transfer(file_id, DOWNLOAD, 0, offset)
+        done = asyncio.get_event_loop().create_future()
+        # Куски могут прийти сразу за ответом, поэтому скачивание регистрируется до запроса
+        self.downloads[file_id] = (file, transfer, done)
+        try:
+            ans = await self.request({ACTION: FILE_DOWNLOAD, TIME: time.time(), USER: self.account_name,
+                                      FILE_ID: file_id, OFFSET: offset})
+            if ans.get(RESPONSE) != 200:
+                raise ServerError(ans.get(ERROR) or 'File download failed')
+            transfer.size = ans[FILE_SIZE]
+            if not transfer.done:
+                await done
+            transfer.finish()
+            return transfer.stats()
+        finally:
+            del self.downloads[file_id]
+            file.close()
+
+    async def get_users(self) -> List[str]:
+        return process_list_ans(await self.request(create_users_request(self.account_name)),
+                                'Users list request failed')
+
+    async def get_contacts(self) -> List[str]:
+        return process_list_ans(await self.request(create_contacts_request(self.account_name)),
+                                'Contact list request failed')
+
+    async def add_contact(self, contact: str) -> None:
+        ans = await self.request({ACTION: ADD_CONTACT, TIME: time.time(), USER: self.account_name,
+                                  ACCOUNT_NAME: contact})
+        if ans.get(RESPONSE) != 200:
+            raise ServerError('Contact creation error')
+        if self.database is not None:
+            self.database.add_contact(contact)
+
+    async def remove_contact(self, contact: str) -> None:
+        ans = await self.request({ACTION: REMOVE_CONTACT, TIME: time.time(), USER: self.account_name,
+                                  ACCOUNT_NAME: contact})
+        if ans.get(RESPONSE) != 200:
+            raise ServerError('Client deletion error')
+        if self.database is not None:
+            self.database.del_contact(contact)
+
+    # Аналог database_load: оба запроса уходят сразу, если канал кадрированный
+    async def load(self) -> None:
+        if self.codec is not None:
+            users, contacts = await asyncio.gather(self.get_users(), self.get_contacts())
+        else:
+            users = await self.get_users()
+            contacts = await self.get_contacts()
+        if self.database is not None:
+            self.database.add_users(users)
+            for contact in contacts:
+                self.database.add_contact(contact)
+
+    async def receive(self) -> Optional[dict]:
+        """Следующее входящее сообщение или None, если соединение закрыто."""
+        message = await self.incoming.get()
+        if message is None:
+            # Оставляем признак конца для следующих читателей
+            self.incoming.put_nowait(None)
+        return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self) -> None:
+        if self.closed or self.writer is None:
+            return
+        self.closed = True
+        try:
+            await self._write({ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: self.account_name})
+        except (OSError, ConnectionError):
+            pass
+        self.writer.close()
+        if self.read_task is not None:
+            self.read_task.cancel()
+            try:
+                await self.read_task
+            except asyncio.CancelledError:
+                pass
+
+    async def __aenter__(self) -> 'AsyncClient':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+async def open_sessions(names: List[str], addr: str = DEFAULT_IP_ADDRESS, port: int = DEFAULT_PORT,
+                        concurrency: int = 100, path: Optional[str] = None, **kwargs) -> List[AsyncClient]:
+    """Подключает сессии для всех имён, не больше concurrency подключений одновременно."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def open_one(name: str) -> AsyncClient:
+        session = AsyncClient(name, **kwargs)
+        async with semaphore:
+            await session.connect(addr, port, path)
+        return session
+
+    return list(await asyncio.gather(*(open_one(name) for name in names)))
+
+
+async def run_fleet(addr: str, port: int, sessions: int, messages: int, prefix: str, codec: str,
+                    compress: bool, trace: bool, fanout: int = 1, idle_timeout: float = 10.0,
+                    path: Optional[str] = None, batch: int = 1) -> None:
+    metrics = Registry()
+    start = time.perf_counter()
+    clients = await open_sessions([f'{prefix}{number}' for number in range(sessions)], addr, port, path=path,
+                                  codec=codec, compress=compress, metrics=metrics)
+    connected = time.perf_counter()
+    print(f'{sessions} sessions connected in {connected - start:.2f} s')
+
+    fanout = min(fanout, sessions)
+    expected = sessions * messages * fanout
+    received = [0]
+
+    def destination():
+        if fanout == 1:
+            return random.choice(clients).account_name
+        return [session.account_name for session in random.sample(clients, fanout)]
+
+    async def drain(session: AsyncClient) -> None:
+        async for _ in session:
+            received[0] += 1
+
+    readers = [asyncio.ensure_future(drain(session)) for session in clients]
+    if batch > 1:
+        # Каждая сессия отправляет свои сообщения пачками по batch штук
+        for start_index in range(0, messages, batch):
+            count = min(batch, messages - start_index)
+            await asyncio.gather(*(
+                session.send_batch([(destination(), 'ping') for _ in range(count)], trace) for session in clients
+            ))
+    else:
+        for _ in range(messages):
+            await asyncio.gather(*(
+                session.send(destination(), 'ping', trace) for session in clients
+            ))
+    sent = time.perf_counter()
+    print(f'{sessions * messages} messages sent in {sent - connected:.2f} s '
+          f'({sessions * messages / (sent - connected):.0f} msg/s)')
+
+    # Ждём, пока дойдут все сообщения или они перестанут приходить
+    idle_since = time.perf_counter()
+    last = 0
+    while received[0] < expected and time.perf_counter() - idle_since < idle_timeout:
+        await asyncio.sleep(0.1)
+        if received[0] != last:
+            last, idle_since = received[0], time.perf_counter()
+    print(f'{received[0]} of {expected} messages received in {time.perf_counter() - connected:.2f} s')
+    rejected = sum(session.rejected for session in clients)
+    if rejected:
+        print(f'{rejected} messages rejected by the server')
+    await asyncio.gather(*(session.close() for session in clients))
+    await asyncio.gather(*readers)
+    for labels, histogram in metrics.find('client_trace_total_seconds'):
+        print(f'delivery latency: p50 {histogram.percentile(0.5) * 1000:.2f} ms, '
+              f'p99 {histogram.percentile(0.99) * 1000:.2f} ms')
+
+
+@click.command()
+@click.option('--addr', '-a', default=DEFAULT_IP_ADDRESS, help='IP address of server')
+@click.option('--port', '-p', default=DEFAULT_PORT, help='TCP-port of server')
+@click.option('--sessions', '-s', default=100, help='Number of simultaneous client sessions')
+@click.option('--messages', '-m', default=10, help='Messages sent by every session')
+@click.option('--prefix', default='bot', help='Prefix of session usernames')
+@click.option('--codec', type=click.Choice(SUPPORTED_CODECS + ['legacy']), default=SUPPORTED_CODECS[0],
+              help='Wire codec to offer to the server')
+@click.option('--compress/--no-compress', default=True, help='Offer zlib compression of large frames')
+@click.option('--trace', is_flag=True, default=False, help='Trace delivery of every message')
+@click.option('--fanout', default=1, help='Recipients of every message, more than one sends a group message')
+@click.option('--unix', 'unix_path', default=None, help='Connect through the Unix socket of a server on this host')
+@click.option('--batch', default=1, help='Send messages in batches of this size')
+def run(addr: str, port: int, sessions: int, messages: int, prefix: str, codec: str, compress: bool,
+        trace: bool, fanout: int, unix_path: Optional[str], batch: int) -> None:
+    asyncio.get_event_loop().run_until_complete(
+        run_fleet(addr, port, sessions, messages, prefix, codec, compress, trace, fanout, path=unix_path,
+                  batch=batch))
+
+
+if __name__ == '__main__':
+    run()
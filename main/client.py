@@ -1,27 +1,206 @@
+import functools
+import itertools
 import json
+import random
 import socket
 import time
 import threading
-from typing import Dict, Any, Optional
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, List, Optional, Tuple, Union
 
 import click
 
+import logs.config_client_log
 from db.client_db import ClientDB
-from messages import get_message, send_message
+from messages import get_message, send_message, Channel
+from codec import CODECS, SUPPORTED_CODECS, COMPRESSIONS, SUPPORTED_COMPRESSIONS
 from variables import *
 from errors import IncorrectDataRecivedError, ReqFieldMissingError, ServerError
 from meta.metaclasses import ClientMeta
+from stats.metrics import Registry
+from stats.tracing import start_trace, add_hop, record_trace, HOP_CLIENT_RECV
 
 logger = logging.getLogger('client')
+traffic_logger = logging.getLogger('client.traffic')
 sock_lock = threading.Lock()
 database_lock = threading.Lock()
 
 
+class ServerConnection:
+    """Соединение с сервером, которое восстанавливается после обрыва.
+
+    Сервер выдаёт в ответе на PRESENCE токен, и при переподключении клиент присылает его:
+    если сервер ещё держит сессию, она продолжается без повторной регистрации, и клиент получает
+    накопившиеся за время обрыва сообщения. Попытки подключения идут с паузой, которая растёт
+    вдвое до CLIENT_RECONNECT_MAX_DELAY, и из неё берётся случайная доля, чтобы после падения
+    сервера клиенты не приходили к нему все одновременно. Пока связи нет, сообщения копятся в outbox
+    и уходят после подключения, на кадрированном канале - пачками BATCH по одной. Сообщения, которые
+    сервер отклонил по лимиту частоты (429), возвращаются в начало outbox и уходят снова, когда лимит
+    восстановится. Пока outbox не разослан, новые сообщения встают в него же, чтобы не обгонять старые.
+    """
+
+    def __init__(self, account_name: str, address: Union[Tuple[str, int], str], codecs: Optional[list] = None,
+                 compressions: Optional[list] = None) -> None:
+        self.account_name = account_name
+        # (адрес, порт) или путь Unix-сокета
+        self.address = address
+        self.codecs = codecs
+        self.compressions = compressions
+        self.channel: Optional[Channel] = None
+        self.token: Optional[str] = None
+        self.online = threading.Event()
+        self.outbox = deque(maxlen=OFFLINE_QUEUE_SIZE)
+        # Пачка из outbox ждёт ответа или повторной отправки
+        self.flushing = False
+        self.retry: Optional[threading.Timer] = None
+        # Выход по команде пользователя: обрыв после него не восстанавливается
+        self.closed = False
+
+    # Подключение и PRESENCE. Возвращает True, если сервер продолжил прежнюю сессию.
+    def connect(self) -> bool:
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.address)
+            channel = Channel(sock)
+            presence = create_presence(self.account_name, self.codecs, self.compressions)
+            if self.token:
+                presence[RESUME_TOKEN] = self.token
+            send_message(channel, presence)
+            response = channel.read_handshake()
+            answer = process_response_ans(response)
+        except Exception:
+            sock.close()
+            raise
+        if response.get(WIRE_CODEC) in CODECS:
+            channel.codec = CODECS[response[WIRE_CODEC]]
+            if response.get(WIRE_COMPRESSION) in COMPRESSIONS:
+                channel.compression = COMPRESSIONS[response[WIRE_COMPRESSION]]()
+        self.channel = channel
+        self.token = response.get(RESUME_TOKEN)
+        logger.info(f'Create connection with server. Receive answer: {answer}, codec: {response.get(WIRE_CODEC)}')
+        return bool(response.get(RESUMED))
+
+    def lost(self) -> None:
+        self.online.clear()
+        # Неподтверждённую пачку вернёт в outbox её ответ с ошибкой, отправит reconnect
+        self.flushing = False
+        if self.retry is not None:
+            self.retry.cancel()
+            self.retry = None
+        if self.channel is not None:
+            self.channel.close()
+
+    # Подключается заново, пока не получится, и отправляет накопленное без связи
+    def reconnect(self, requests: Optional['PendingRequests'] = None) -> bool:
+        self.lost()
+        for attempt in itertools.count():
+            delay = min(CLIENT_RECONNECT_MAX_DELAY, CLIENT_RECONNECT_DELAY * 2 ** min(attempt, 16))
+            time.sleep(random.uniform(0, delay))
+            try:
+                resumed = self.connect()
+            except (OSError, ConnectionError, IncorrectDataRecivedError, json.JSONDecodeError,
+                    ServerError, ReqFieldMissingError) as error:
+                # Отказ тоже повторяется: сервер мог ещё не заметить обрыв прежнего соединения
+                logger.warning('Reconnect attempt %s failed: %s', attempt + 1, error)
+                continue
+            logger.info('Reconnected to server, session %s', 'resumed' if resumed else 'started anew')
+            with sock_lock:
+                try:
+                    self.flush_outbox(requests)
+                except OSError:
+                    self.lost()
+                    continue
+                self.online.set()
+            return resumed
+
+    # Отправляет сообщение или, если связи нет, откладывает до переподключения
+    def send(self, message: dict) -> bool:
+        with sock_lock:
+            if self.online.is_set() and not self.flushing:
+                try:
+                    send_message(self.channel, message)
+                    return True
+                except OSError:
+                    # Восстановит связь поток чтения, когда заметит обрыв
+                    self.lost()
+            self.outbox.append(message)
+            return False
+
+    # Вызывается под sock_lock. Ответ на пачку ждать нельзя: его разбирает поток чтения,
+    # который сейчас может и переподключаться, поэтому следующую пачку отправляет batch_answered.
+    def flush_outbox(self, requests: Optional['PendingRequests'] = None) -> None:
+        self.flushing = False
+        if not self.outbox:
+            return
+        if requests is None or self.channel.codec is None:
+            logger.info('Sending %s messages queued while offline', len(self.outbox))
+            while self.outbox:
+                send_message(self.channel, self.outbox[0])
+                self.outbox.popleft()
+            return
+        messages = [self.outbox.popleft() for _ in range(min(MAX_BATCH_SIZE, len(self.outbox)))]
+        logger.info('Sending %s of %s queued messages', len(messages), len(messages) + len(self.outbox))
+        batch = create_batch(messages)
+        requests.register(batch).add_done_callback(functools.partial(self.batch_answered, messages, requests))
+        self.flushing = True
+        try:
+            send_message(self.channel, batch)
+        except OSError as error:
+            requests.discard(batch[REQUEST_ID], error)
+            raise
+
+    # Ответ на пачку из outbox, в потоке чтения. Пачка, не дошедшая до сервера, и сообщения с ответом 429
+    # возвращаются в начало outbox. Следующая пачка уходит из отдельного потока, так как отправка идёт
+    # под sock_lock, а после отказов по лимиту - через столько секунд, сколько лимит восстанавливается.
+    def batch_answered(self, messages: List[dict], requests: 'PendingRequests', future: Future) -> None:
+        if future.exception() is not None:
+            logger.error('Queued messages were not confirmed: %s', future.exception())
+            self.outbox.extendleft(reversed(messages))
+            return
+        response = future.result()
+        statuses = response.get(LIST_INFO)
+        if response.get(RESPONSE) == 429:
+            statuses = [429] * len(messages)
+        elif response.get(RESPONSE) != 200 or not isinstance(statuses, list) or len(statuses) != len(messages):
+            logger.error('Server rejected %s queued messages: %s', len(messages), response.get(ERROR))
+            statuses = [400] * len(messages)
+        rejected = [message for message, status in zip(messages, statuses) if status == 429]
+        invalid = sum(1 for status in statuses if status not in (200, 429))
+        if invalid:
+            logger.warning('Server rejected %s of %s queued messages', invalid, len(messages))
+        delay = 0
+        if rejected:
+            self.outbox.extendleft(reversed(rejected))
+            delay = len(rejected) / RATE_LIMITS[BATCH_ITEM][0]
+            logger.info('%s queued messages exceeded the rate limit, resending in %.1f s', len(rejected), delay)
+        self.retry = threading.Timer(delay, self.resume_flush, args=(requests,))
+        self.retry.daemon = True
+        self.retry.start()
+
+    def resume_flush(self, requests: 'PendingRequests') -> None:
+        with sock_lock:
+            # Без связи outbox отправит reconnect
+            if not self.online.is_set():
+                return
+            try:
+                self.flush_outbox(requests)
+            except OSError:
+                self.lost()
+
+
 class ClientSender(threading.Thread, metaclass=ClientMeta):
-    def __init__(self, account_name: str, sock, database) -> None:
+    def __init__(self, account_name: str, connection: ServerConnection, database, metrics: Optional[Registry] = None,
+                 trace: bool = False, requests: Optional['PendingRequests'] = None) -> None:
         self.account_name = account_name
-        self.sock = sock
+        self.connection = connection
         self.database = database
+        self.metrics = metrics or Registry()
+        self.trace = trace
+        self.requests = requests
         super().__init__()
 
     def create_exit_message(self) -> Dict[str, Any]:
@@ -32,31 +211,38 @@ class ClientSender(threading.Thread, metaclass=ClientMeta):
         }
 
     def create_message(self) -> None:
-        to = input('Choose destination: ')
+        to = input(f'Choose destination (several names separated by commas, {BROADCAST} - everyone online): ')
         message = input('Write your message: ')
-        with database_lock:
-            if not self.database.check_user(to):
-                logger.error(f'User {to} is unknown')
-                return
+        names = [name.strip() for name in to.split(',') if name.strip()]
+        if not names:
+            logger.error('Destination is empty')
+            return
+        if to != BROADCAST:
+            with database_lock:
+                for name in names:
+                    if not self.database.check_user(name):
+                        logger.error('User %s is unknown', name)
+                        return
 
         message_dict = {
             ACTION: MESSAGE,
             SENDER: self.account_name,
-            DESTINATION: to,
+            DESTINATION: names[0] if len(names) == 1 else names,
             TIME: time.time(),
             MESSAGE_TEXT: message
         }
+        if self.trace:
+            start_trace(message_dict)
 
         with database_lock:
             self.database.save_message(self.account_name, to, message)
 
-        with sock_lock:
-            try:
-                send_message(self.sock, message_dict)
-                logger.info(f'Send message to {to}')
-            except Exception as e:
-                logger.critical(f'Lost connection with server: {e}')
-                exit(1)
+        if self.connection.send(message_dict):
+            traffic_logger.info('Send message to %s', to)
+        elif self.connection.online.is_set():
+            logger.info('Message to %s is queued after earlier unsent messages', to)
+        else:
+            logger.warning('No connection with server, message to %s will be sent after reconnect', to)
 
     def run(self) -> None:
         self.print_help()
@@ -67,9 +253,10 @@ class ClientSender(threading.Thread, metaclass=ClientMeta):
             elif command == 'help':
                 self.print_help()
             elif command == 'exit':
+                self.connection.closed = True
                 with sock_lock:
                     try:
-                        send_message(self.sock, self.create_exit_message())
+                        send_message(self.connection.channel, self.create_exit_message())
                     except Exception:
                         pass
                     logger.info('Shutdown by user command.')
@@ -84,6 +271,8 @@ class ClientSender(threading.Thread, metaclass=ClientMeta):
                 self.edit_contacts()
             elif command == 'history':
                 self.print_history()
+            elif command == 'latency':
+                self.print_latency()
             else:
                 print('Invalid command. Please use `help` to see list of commands')
 
@@ -103,6 +292,15 @@ class ClientSender(threading.Thread, metaclass=ClientMeta):
                 for message in history_list:
                     print(f'\nMessage from: {message[0]} to {message[1]} date {message[3]}\n{message[2]}')
 
+    def print_latency(self) -> None:
+        for name in ('client_trace_total_seconds', 'client_trace_hop_seconds'):
+            for labels, histogram in self.metrics.find(name):
+                label = ', '.join(value for _, value in labels)
+                print(f'{name} [{label}]: count {histogram.count}, '
+                      f'p50 {histogram.percentile(0.5) * 1000:.2f} ms, '
+                      f'p99 {histogram.percentile(0.99) * 1000:.2f} ms, '
+                      f'max {histogram.max * 1000:.2f} ms')
+
     def edit_contacts(self) -> None:
         ans = input('For delete any contact - del, for add contact - add: ')
         if ans == 'del':
@@ -117,11 +315,10 @@ class ClientSender(threading.Thread, metaclass=ClientMeta):
             if self.database.check_user(edit):
                 with database_lock:
                     self.database.add_contact(edit)
-                with sock_lock:
-                    try:
-                        add_contact(self.sock, self.account_name, edit)
-                    except ServerError:
-                        logger.error('Failed to send information to the server.')
+                try:
+                    add_contact(self.connection.channel, self.account_name, edit, self.requests)
+                except (ServerError, OSError):
+                    logger.error('Failed to send information to the server.')
 
     @staticmethod
     def print_help():
@@ -129,39 +326,87 @@ class ClientSender(threading.Thread, metaclass=ClientMeta):
         print('history - message history')
         print('contacts - list of contacts')
         print('edit - edit list of contacts')
+        print('latency - delivery latency of traced messages')
         print('help - show this instruction')
         print('exit - disconnect from server')
 
 
 class ClientReader(threading.Thread, metaclass=ClientMeta):
-    def __init__(self, account_name: str, sock, database) -> None:
+    def __init__(self, account_name: str, connection: ServerConnection, database, metrics: Optional[Registry] = None,
+                 requests: Optional['PendingRequests'] = None) -> None:
         self.account_name = account_name
-        self.sock = sock
+        self.connection = connection
         self.database = database
+        self.metrics = metrics or Registry()
+        self.requests = requests
         super().__init__()
 
     def run(self):
         while True:
             try:
-                message = get_message(self.sock)
-                if ACTION in message and message[ACTION] == MESSAGE and SENDER in message and DESTINATION in message \
-                        and MESSAGE_TEXT in message and message[DESTINATION] == self.account_name:
-                    logger.info(f'Receive message from {message[SENDER]}:\n{message[MESSAGE_TEXT]}')
+                message = get_message(self.connection.channel)
+                if ACTION in message and message[ACTION] == MESSAGE and SENDER in message \
+                        and MESSAGE_TEXT in message and addressed_to(message, self.account_name):
+                    if TRACE in message:
+                        add_hop(message, HOP_CLIENT_RECV)
+                        record_trace(message, self.metrics, 'client')
+                    traffic_logger.info('Receive message from %s:\n%s', message[SENDER], message[MESSAGE_TEXT])
                     with database_lock:
                         try:
                             self.database.save_message(message[SENDER], self.account_name, message[MESSAGE_TEXT])
                         except Exception as e:
                             logger.error(e)
+                elif message.get(ACTION) == CONTACT_STATUS:
+                    traffic_logger.info('Contacts online: %s, offline: %s', message.get(ONLINE), message.get(OFFLINE))
+                elif message.get(ACTION) == FILE and SENDER in message and FILE_ID in message \
+                        and addressed_to(message, self.account_name):
+                    # Сам файл консольный клиент не скачивает, это умеет AsyncClient.download
+                    traffic_logger.info('Receive file %s (%s bytes) from %s, id %s', message.get(FILE_NAME),
+                                        message.get(FILE_SIZE), message[SENDER], message[FILE_ID])
+                elif unsolicited(message, self.connection.channel.codec is not None):
+                    # Отказ в ответ на сообщение: у MESSAGE нет request_id, ждать этот ответ некому
+                    logger.warning('Server rejected a message: %s', message.get(ERROR))
+                elif RESPONSE in message and self.requests is not None \
+                        and self.requests.resolve(message, self.connection.channel.codec is not None):
+                    pass
+                elif message.get(ACTION) == PING:
+                    with sock_lock:
+                        send_message(self.connection.channel, {ACTION: PONG, TIME: time.time()})
                 else:
-                    logger.error(f'Receive non correct answer from server: {message}')
+                    logger.error('Receive non correct answer from server: %s', message)
             except IncorrectDataRecivedError:
                 logger.error('Failed to decode received message.')
             except (OSError, ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError):
-                logger.critical('Lost connection with server')
-                break
-
-
-def create_presence(account_name: str) -> Dict[str, Any]:
+                if self.requests is not None:
+                    self.requests.fail_all(ConnectionError('Lost connection with server'))
+                if self.connection.closed:
+                    break
+                logger.error('Lost connection with server, reconnecting')
+                if not self.connection.reconnect(self.requests):
+                    # Сессия началась заново: списки пользователей и контактов запрашиваются снова.
+                    # Ответы на эти запросы читает этот же поток, поэтому ждать их здесь нельзя.
+                    threading.Thread(target=database_load, daemon=True, args=(
+                        self.connection.channel, self.database, self.account_name, self.requests)).start()
+
+
+# Отказ без request_id, который не ждёт ни один запрос: ответ на MESSAGE. Сервер, с которым
+# договорились о кодеке, возвращает request_id в ответах на запросы, поэтому на кадрированном
+# канале любой такой отказ 4xx - ответ на сообщение; на старом канале так отвечает только 429.
+def unsolicited(response: dict, framed: bool) -> bool:
+    if REQUEST_ID in response or not isinstance(response.get(RESPONSE), int):
+        return False
+    return response[RESPONSE] == 429 or framed and 400 <= response[RESPONSE] < 500
+
+
+def addressed_to(message: dict, account_name: str) -> bool:
+    destination = message.get(DESTINATION)
+    if isinstance(destination, list):
+        return account_name in destination
+    return destination == account_name or destination == BROADCAST
+
+
+def create_presence(account_name: str, codecs: Optional[list] = None,
+                    compressions: Optional[list] = None) -> Dict[str, Any]:
     out = {
         ACTION: PRESENCE,
         TIME: time.time(),
@@ -169,7 +414,11 @@ def create_presence(account_name: str) -> Dict[str, Any]:
             ACCOUNT_NAME: account_name
         }
     }
-    logger.debug(f'Create {PRESENCE} message to user {account_name}')
+    if codecs:
+        out[WIRE_CODECS] = codecs
+        if compressions:
+            out[WIRE_COMPRESSION] = compressions
+    logger.debug('Create %s message to user %s', PRESENCE, account_name)
     return out
 
 
@@ -177,37 +426,123 @@ def process_response_ans(message: str) -> Optional[str]:
     if RESPONSE in message:
         if message[RESPONSE] == 200:
             return '200 : OK'
-        elif message[RESPONSE] == 400:
-            raise ServerError(f'400 : {message[ERROR]}')
+        elif 400 <= message[RESPONSE] < 500:
+            raise ServerError(f'{message[RESPONSE]} : {message.get(ERROR)}')
     raise ReqFieldMissingError(RESPONSE)
 
 
-def contacts_list_request(sock, name: str) -> Optional[str]:
-    logger.debug(f'Request a contact list for a user {name}')
-    req = {
+class PendingRequests:
+    """Запросы, ожидающие ответа сервера, по их request_id.
+
+    Ответы читает только ClientReader, а отправивший запрос поток ждёт свой Future.
+    Сервер, не знающий request_id, отвечает без него - тогда ответ достаётся самому
+    старому запросу, так как такой сервер обрабатывает запросы строго по порядку.
+    Это только для старого канала: на кадрированном ответ без request_id не относится ни к одному запросу.
+    """
+
+    def __init__(self) -> None:
+        self.ids = itertools.count(1)
+        self.pending: 'OrderedDict[int, Future]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, request: dict) -> Future:
+        future = Future()
+        with self.lock:
+            request_id = next(self.ids)
+            request[REQUEST_ID] = request_id
+            self.pending[request_id] = future
+        return future
+
+    def resolve(self, response: dict, framed: bool = False) -> bool:
+        with self.lock:
+            if REQUEST_ID in response:
+                future = self.pending.pop(response[REQUEST_ID], None)
+            elif self.pending and not framed:
+                future = self.pending.popitem(last=False)[1]
+            else:
+                future = None
+        if future is None:
+            return False
+        future.set_result(response)
+        return True
+
+    # Запрос, который не удалось отправить
+    def discard(self, request_id: int, error: Exception) -> None:
+        with self.lock:
+            future = self.pending.pop(request_id, None)
+        if future is not None:
+            future.set_exception(error)
+
+    def fail_all(self, error: Exception) -> None:
+        with self.lock:
+            futures = list(self.pending.values())
+            self.pending.clear()
+        for future in futures:
+            future.set_exception(error)
+
+
+def submit_request(sock, req: dict, requests: Optional[PendingRequests] = None) -> Future:
+    # Без PendingRequests ответ читается сразу из сокета, как раньше: так работают
+    # запросы до запуска ClientReader. С ним запрос только отправляется, а ответ
+    # придёт в Future из потока чтения, и можно отправить следующий не дожидаясь.
+    if requests is None:
+        future = Future()
+        send_message(sock, req)
+        future.set_result(get_message(sock))
+        return future
+    future = requests.register(req)
+    with sock_lock:
+        send_message(sock, req)
+    return future
+
+
+def wait_response(future: Future) -> dict:
+    try:
+        return future.result(REQUEST_TIMEOUT)
+    except FutureTimeoutError:
+        raise ServerError('Server response timed out')
+    except (OSError, ConnectionError):
+        raise ServerError('Lost connection with server')
+
+
+def create_contacts_request(name: str) -> Dict[str, Any]:
+    return {
         ACTION: GET_CONTACTS,
         TIME: time.time(),
         USER: name
     }
-    send_message(sock, req)
-    ans = get_message(sock)
-    logger.debug(f'Receive the answer: {ans}')
+
+
+def create_users_request(username: str) -> Dict[str, Any]:
+    return {
+        ACTION: USERS_REQUEST,
+        TIME: time.time(),
+        ACCOUNT_NAME: username
+    }
+
+
+def process_list_ans(ans: dict, error: str) -> list:
     if RESPONSE in ans and ans[RESPONSE] == 202:
         return ans[LIST_INFO]
-    else:
-        raise ServerError
+    raise ServerError(f'{error}: {ans[ERROR]}' if ans.get(ERROR) else error)
+
 
+def contacts_list_request(sock, name: str, requests: Optional[PendingRequests] = None) -> list:
+    logger.debug('Request a contact list for a user %s', name)
+    ans = wait_response(submit_request(sock, create_contacts_request(name), requests))
+    logger.debug('Receive the answer: %s', ans)
+    return process_list_ans(ans, 'Contact list request failed')
 
-def add_contact(sock, username: str, contact: str) -> None:
-    logger.debug(f'Create a contact {contact}')
+
+def add_contact(sock, username: str, contact: str, requests: Optional[PendingRequests] = None) -> None:
+    logger.debug('Create a contact %s', contact)
     req = {
         ACTION: ADD_CONTACT,
         TIME: time.time(),
         USER: username,
         ACCOUNT_NAME: contact
     }
-    send_message(sock, req)
-    ans = get_message(sock)
+    ans = wait_response(submit_request(sock, req, requests))
     if RESPONSE in ans and ans[RESPONSE] == 200:
         pass
     else:
@@ -215,30 +550,20 @@ def add_contact(sock, username: str, contact: str) -> None:
     print('Successful contact creation')
 
 
-def user_list_request(sock, username: str) -> Optional[str]:
-    logger.debug(f'Query a list of known users of {username}')
-    req = {
-        ACTION: USERS_REQUEST,
-        TIME: time.time(),
-        ACCOUNT_NAME: username
-    }
-    send_message(sock, req)
-    ans = get_message(sock)
-    if RESPONSE in ans and ans[RESPONSE] == 202:
-        return ans[LIST_INFO]
-    else:
-        raise ServerError
+def user_list_request(sock, username: str, requests: Optional[PendingRequests] = None) -> list:
+    logger.debug('Query a list of known users of %s', username)
+    ans = wait_response(submit_request(sock, create_users_request(username), requests))
+    return process_list_ans(ans, 'Users list request failed')
 
 
-def remove_contact(sock, username: str, contact: str) -> None:
+def remove_contact(sock, username: str, contact: str, requests: Optional[PendingRequests] = None) -> None:
     req = {
         ACTION: REMOVE_CONTACT,
         TIME: time.time(),
         USER: username,
         ACCOUNT_NAME: contact
     }
-    send_message(sock, req)
-    ans = get_message(sock)
+    ans = wait_response(submit_request(sock, req, requests))
     if RESPONSE in ans and ans[RESPONSE] == 200:
         pass
     else:
@@ -246,43 +571,76 @@ def remove_contact(sock, username: str, contact: str) -> None:
     print('Successful removal')
 
 
-def database_load(sock, database, username: str) -> None:
+def create_batch(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        ACTION: BATCH,
+        TIME: time.time(),
+        LIST_INFO: messages
+    }
+
+
+# Несколько сообщений одним кадром и одним ответом. Возвращает статус каждого сообщения по порядку:
+# 200 - принято, 400 - сообщение неверно, 429 - превышен лимит сообщений
+def send_batch(sock, messages: List[Dict[str, Any]], requests: Optional[PendingRequests] = None) -> List[int]:
+    ans = wait_response(submit_request(sock, create_batch(messages), requests))
+    if RESPONSE in ans and ans[RESPONSE] == 200:
+        return ans[LIST_INFO]
+    raise ServerError(f'Batch was rejected: {ans.get(ERROR)}')
+
+
+def database_load(sock, database, username: str, requests: Optional[PendingRequests] = None) -> None:
+    # На кадрированном канале оба запроса уходят сразу, и ожидание ответов перекрывается.
+    # В старом формате без кадров два ответа могут склеиться в одном recv, поэтому там по очереди.
+    if requests is not None and getattr(sock, 'codec', None) is not None:
+        users_future = submit_request(sock, create_users_request(username), requests)
+        contacts_future = submit_request(sock, create_contacts_request(username), requests)
+    else:
+        users_future = contacts_future = None
+
     try:
-        users_list = user_list_request(sock, username)
+        users_future = users_future or submit_request(sock, create_users_request(username), requests)
+        users_list = process_list_ans(wait_response(users_future), 'Users list request failed')
     except ServerError:
         logger.error('Failed to query list of known users.')
     else:
-        database.add_users(users_list)
+        with database_lock:
+            database.add_users(users_list)
 
     try:
-        contacts_list = contacts_list_request(sock, username)
+        contacts_future = contacts_future or submit_request(sock, create_contacts_request(username), requests)
+        contacts_list = process_list_ans(wait_response(contacts_future), 'Contact list request failed')
     except ServerError:
         logger.error('Contact list request failed.')
     else:
-        for contact in contacts_list:
-            database.add_contact(contact)
+        with database_lock:
+            for contact in contacts_list:
+                database.add_contact(contact)
 
 
 @click.command()
 @click.option('--addr', '-a', default=DEFAULT_IP_ADDRESS, help='IP address of server')
 @click.option('--port', '-p', default=DEFAULT_PORT, help='TCP-port of server')
 @click.option('--name', '-n', default=None, help='username')
-def run(addr: str, port: int, name: str):
+@click.option('--trace', is_flag=True, default=False, help='Attach delivery trace to sent messages')
+@click.option('--codec', type=click.Choice(SUPPORTED_CODECS + ['legacy']), default=SUPPORTED_CODECS[0],
+              help='Preferred wire codec, legacy disables negotiation')
+@click.option('--compress/--no-compress', default=True, help='Offer zlib compression of large frames')
+@click.option('--unix', 'unix_path', default=None, help='Connect through the Unix socket of a server on this host')
+def run(addr: str, port: int, name: str, trace: bool, codec: str, compress: bool, unix_path: Optional[str]):
     if not name:
         name = input('Choose username: ')
     else:
         print(f'Start client with name: {name}')
 
+    server_address = unix_path or f'{addr}:{port}'
     logger.info(
-        f'Start client on {addr} with {port} port and username {name}')
+        f'Start client on {server_address} with username {name}')
 
+    offered = None if codec == 'legacy' else [codec] + [other for other in SUPPORTED_CODECS if other != codec]
+    connection = ServerConnection(name, unix_path or (addr, port), offered,
+                                  SUPPORTED_COMPRESSIONS if compress else None)
     try:
-        transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        transport.connect((addr, port))
-        send_message(transport, create_presence(name))
-        answer = process_response_ans(get_message(transport))
-        logger.info(f'Create connection with server. Receive answer: {answer}')
-
+        connection.connect()
     except json.JSONDecodeError:
         logger.error('Invalid JSON received')
         exit(1)
@@ -292,19 +650,22 @@ def run(addr: str, port: int, name: str):
     except ReqFieldMissingError as missing_error:
         logger.error(missing_error.missing_field)
         exit(1)
-    except (ConnectionRefusedError, ConnectionError):
+    except (ConnectionRefusedError, ConnectionError, FileNotFoundError):
         logger.critical(
-            f'Failed to connect to server {addr}:{port}')
+            f'Failed to connect to server {server_address}')
         exit(1)
     else:
         database = ClientDB(name)
-        database_load(transport, database, name)
-
-        module_reciver = ClientReader(name, transport, database)
+        metrics = Registry()
+        requests = PendingRequests()
+        connection.online.set()
+        module_reciver = ClientReader(name, connection, database, metrics, requests)
         module_reciver.daemon = True
         module_reciver.start()
 
-        module_sender = ClientSender(name, transport, database)
+        database_load(connection.channel, database, name, requests)
+
+        module_sender = ClientSender(name, connection, database, metrics, trace, requests)
         module_sender.daemon = True
         module_sender.start()
         logger.debug('Start processes')
@@ -0,0 +1,314 @@
+import errno
+import logging
+import select
+import socket
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from codec import BinaryCodec
+from errors import IncorrectDataRecivedError
+from messages import Channel
+from protocol import DESTINATION_TYPES, compile_validator
+from variables import *
+from workers import IPC_BUFFER_SIZE, ROUTE
+
+logger = logging.getLogger('server')
+
+# Служебные сообщения между узлами кластера, клиентам они не видны
+HELLO = 'hello'
+NODE = 'node'
+
+# Пауза перед повторным подключением к недоступному соседу, удваивается до RECONNECT_MAX_DELAY
+RECONNECT_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
+
+LINK_ERRORS = (OSError, ConnectionError, IncorrectDataRecivedError)
+
+# Пересылаемые соседом сообщения и уведомления о файлах: без этих полей их нельзя доставить
+validate_forwarded = compile_validator({SENDER: str, DESTINATION: DESTINATION_TYPES})
+
+
+# "host:port, host:port" из server.ini
+def parse_peers(value: str) -> List[Tuple[str, int]]:
+    peers = []
+    for item in value.split(','):
+        item = item.strip()
+        if item:
+            host, _, port = item.rpartition(':')
+            peers.append((host, int(port)))
+    return peers
+
+
+class PeerLink:
+    """Исходящая связь с соседним узлом. Пока сосед недоступен, подключение повторяется с растущей паузой."""
+
+    def __init__(self, address: Tuple[str, int]) -> None:
+        self.address = address
+        self.sock: Optional[socket.socket] = None
+        self.channel: Optional[Channel] = None
+        self.node: Optional[str] = None
+        self.delay = RECONNECT_DELAY
+        self.retry_at = 0.0
+
+
+class ClusterRouter:
+    """Связи узла кластера с соседями, по интерфейсу как workers.WorkerRouter.
+
+    Каждый узел подключается ко всем соседям из настроек и принимает их подключения,
+    так что между двумя узлами две связи: по своей исходящей узел сообщает соседу о входах
+    и выходах своих клиентов и пересылает ему сообщения, по входящей получает то же от него.
+    Таблица маршрутов "имя -> узел" собирается из этих сообщений и хранится на каждом узле,
+    поэтому пересылка не требует запросов к другим узлам. При подключении узел отправляет
+    соседу полный список своих клиентов, при потере входящей связи маршруты соседа забываются.
+    """
+
+    def __init__(self, node: str, address: str, port: int, peers: List[Tuple[str, int]]) -> None:
+        self.node = node
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((address, port))
+        self.listener.listen(len(peers) + 1)
+        self.listener.setblocking(False)
+        self.links = [PeerLink(peer) for peer in peers]
+        # Входящие связи и имена узлов, приславших HELLO
+        self.incoming: Dict[Channel, Optional[str]] = {}
+        self.routes: Dict[str, str] = {}
+        self.local: Set[str] = set()
+        self.received: List[dict] = []
+        # (имя, в сети ли) для клиентов соседей, как в WorkerRouter
+        self.changes: List[Tuple[str, bool]] = []
+
+    def channels(self) -> list:
+        return [self.listener] + list(self.incoming) + [link.channel for link in self.links if link.channel is not None]
+
+    # Подключения к соседям без блокировки цикла сервера: connect не ждёт, готовность проверяется здесь
+    def tick(self, now: float) -> None:
+        for link in self.links:
+            if link.channel is None and link.sock is None and now >= link.retry_at:
+                self.connect(link)
+        pending = [link.sock for link in self.links if link.sock is not None]
+        if not pending:
+            return
+        _, ready, _ = select.select([], pending, [], 0)
+        for link in self.links:
+            if link.sock is not None and link.sock in ready:
+                self.connected(link)
+
+    def connect(self, link: PeerLink) -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, IPC_BUFFER_SIZE)
+        sock.setblocking(False)
+        code = sock.connect_ex(link.address)
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self.retry(link)
+            return
+        link.sock = sock
+
+    def connected(self, link: PeerLink) -> None:
+        sock, link.sock = link.sock, None
+        code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if code:
+            sock.close()
+            self.retry(link)
+            return
+        sock.setblocking(True)
+        link.channel = Channel(sock, BinaryCodec())
+        link.delay = RECONNECT_DELAY
+        try:
+            link.channel.write_message({ACTION: HELLO, NODE: self.node, LIST_INFO: sorted(self.local)})
+        except OSError:
+            self.link_lost(link)
+            return
+        logger.info('Connected to cluster peer %s:%s', *link.address)
+
+    def retry(self, link: PeerLink) -> None:
+        link.retry_at = time.monotonic() + link.delay
+        link.delay = min(link.delay * 2, RECONNECT_MAX_DELAY)
+
+    def link_lost(self, link: PeerLink) -> None:
+        if link.channel is not None:
+            logger.error('Lost link with cluster peer %s (%s:%s)', link.node, *link.address)
+            link.channel.close()
+        link.channel = None
+        link.node = None
+        self.retry(link)
+
+    def link_of(self, channel) -> Optional[PeerLink]:
+        return next((link for link in self.links if link.channel is channel), None)
+
+    # Ошибка чтения, которую не обработал read: закрывается только эта связь, узел продолжает работать
+    def channel_lost(self, channel) -> bool:
+        if channel in self.incoming:
+            self.incoming_lost(channel)
+        else:
+            link = self.link_of(channel)
+            if link is not None:
+                self.link_lost(link)
+        return True
+
+    def read(self, channel) -> None:
+        if channel is self.listener:
+            self.accept()
+        elif channel in self.incoming:
+            # Ошибка разбора или неверный кадр закрывают только эту связь, узел продолжает работать
+            try:
+                messages = channel.read_messages()
+            except Exception:
+                logger.exception('Failed to read from cluster peer %s', self.incoming[channel])
+                self.incoming_lost(channel)
+                return
+            for message, _ in messages:
+                if not self.handle(channel, message):
+                    logger.error('Cluster peer %s sent a malformed %s frame', self.incoming.get(channel),
+                                 message.get(ACTION) if isinstance(message, dict) else None)
+                    self.incoming_lost(channel)
+                    return
+                if channel not in self.incoming:
+                    return
+        else:
+            # Связь могла оборваться раньше в этом же проходе, при отправке соседу
+            link = self.link_of(channel)
+            if link is None:
+                return
+            try:
+                messages = channel.read_messages()
+            except Exception:
+                logger.exception('Failed to read from cluster peer %s:%s', *link.address)
+                self.link_lost(link)
+                return
+            # По исходящей связи приходит только ответный HELLO с именем соседа
+            for message, _ in messages:
+                if not isinstance(message, dict) or message.get(ACTION) != HELLO:
+                    continue
+                if not isinstance(message.get(NODE), str) or not message[NODE]:
+                    logger.error('Cluster peer %s:%s sent %s without a node name', *link.address, HELLO)
+                    self.link_lost(link)
+                    return
+                link.node = message[NODE]
+
+    def accept(self) -> None:
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                # Оборванное до accept подключение или нехватка дескрипторов: узел продолжает работать
+                logger.error('Failed to accept a cluster peer: %s', error)
+                return
+            sock.setblocking(True)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, IPC_BUFFER_SIZE)
+            self.incoming[Channel(sock, BinaryCodec())] = None
+            logger.info('Cluster peer connected from %s:%s', *address)
+
+    # False, если кадр соседа неверный: связь с ним закрывается
+    def handle(self, channel: Channel, message: dict) -> bool:
+        if not isinstance(message, dict):
+            return False
+        action = message.get(ACTION)
+        node = self.incoming[channel]
+        if action == HELLO:
+            names = message.get(LIST_INFO)
+            if not isinstance(message.get(NODE), str) or not message[NODE] or not isinstance(names, list) \
+                    or not all(isinstance(name, str) for name in names):
+                return False
+            node = self.incoming[channel] = message[NODE]
+            # Полный список клиентов соседа заменяет всё, что о нём было известно
+            self.forget(node)
+            for name in names:
+                self.learn(name, node)
+            try:
+                channel.write_message({ACTION: HELLO, NODE: self.node})
+            except OSError:
+                self.incoming_lost(channel)
+        elif node is None:
+            # До HELLO сосед неизвестен
+            return False
+        elif action == ROUTE:
+            name = message.get(ACCOUNT_NAME)
+            if not isinstance(name, str) or not isinstance(message.get(NODE, False), (str, type(None))):
+                return False
+            if message[NODE] is not None:
+                self.learn(name, node)
+            elif self.routes.get(name) == node:
+                del self.routes[name]
+                self.changes.append((name, False))
+        elif action in (MESSAGE, FILE):
+            if validate_forwarded(message) is not None:
+                return False
+            self.received.append(message)
+        return True
+
+    def learn(self, name: str, node: str) -> None:
+        if name in self.local:
+            # Одновременный вход под одним именем на двух узлах: каждый доставляет своему клиенту
+            logger.warning('Client %s is connected both here and to node %s', name, node)
+        if name not in self.routes:
+            self.changes.append((name, True))
+        self.routes[name] = node
+
+    def forget(self, node: str) -> None:
+        for name in [name for name, owner in self.routes.items() if owner == node]:
+            del self.routes[name]
+            self.changes.append((name, False))
+
+    def incoming_lost(self, channel: Channel) -> None:
+        node = self.incoming.pop(channel, None)
+        channel.close()
+        if node is not None:
+            logger.error('Cluster peer %s disconnected', node)
+            self.forget(node)
+
+    # Имя свободно, если его не держит другой узел; о входе узнают все соседи
+    def claim(self, name: str) -> bool:
+        if name in self.routes:
+            return False
+        self.local.add(name)
+        self.announce({ACTION: ROUTE, ACCOUNT_NAME: name, NODE: self.node})
+        return True
+
+    def release(self, names: List[str]) -> None:
+        for name in names:
+            if name in self.local:
+                self.local.discard(name)
+                self.announce({ACTION: ROUTE, ACCOUNT_NAME: name, NODE: None})
+
+    def announce(self, message: dict) -> None:
+        for link in self.links:
+            self.write_link(link, message)
+
+    # Пересылает сообщение узлам, у которых есть получатели из names.
+    # Возвращает имена, которых нет ни на одном доступном узле.
+    def forward(self, message: dict, names: List[str]) -> List[str]:
+        by_node: Dict[str, List[str]] = {}
+        unknown = []
+        for name in names:
+            node = self.routes.get(name)
+            if node is None or name in self.local:
+                unknown.append(name)
+            else:
+                by_node.setdefault(node, []).append(name)
+        for node, recipients in by_node.items():
+            link = next((link for link in self.links if link.node == node and link.channel is not None), None)
+            if link is None:
+                unknown.extend(recipients)
+            elif isinstance(message[DESTINATION], str):
+                self.write_link(link, message)
+            else:
+                copy = dict(message)
+                copy[DESTINATION] = recipients
+                self.write_link(link, copy)
+        return unknown
+
+    def broadcast(self, message: dict) -> None:
+        for link in self.links:
+            self.write_link(link, message)
+
+    def write_link(self, link: PeerLink, message: dict) -> None:
+        if link.channel is None:
+            return
+        try:
+            link.channel.write_message(message)
+        except OSError:
+            self.link_lost(link)
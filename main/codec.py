@@ -0,0 +1,289 @@
+import json
+import struct
+import time
+import zlib
+from typing import Any, List, Optional
+
+from errors import IncorrectDataRecivedError
+from variables import *
+
+
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, message: dict) -> bytes:
+        return json.dumps(message, separators=(',', ':')).encode(ENCODING)
+
+    def decode(self, payload) -> dict:
+        try:
+            message = json.loads(str(payload, ENCODING))
+        except (ValueError, UnicodeDecodeError):
+            raise IncorrectDataRecivedError
+        if not isinstance(message, dict):
+            raise IncorrectDataRecivedError
+        return message
+
+
+# Строки, которые кодируются одним байтом вместо полного текста: ключи JIM и частые значения.
+# Таблица общая для клиента и сервера, поэтому менять порядок нельзя - только завести новую версию кодека.
+ATOMS = (
+    ACTION, TIME, USER, ACCOUNT_NAME, SENDER, DESTINATION, PRESENCE, RESPONSE, ERROR, MESSAGE, MESSAGE_TEXT,
+    EXIT, GET_CONTACTS, LIST_INFO, REMOVE_CONTACT, ADD_CONTACT, USERS_REQUEST, TRACE, TRACE_ID, TRACE_HOPS,
+    WIRE_CODECS, WIRE_CODEC, WIRE_COMPRESSION, REQUEST_ID, PING, PONG, FILE_UPLOAD, FILE_CHUNK, FILE_DOWNLOAD,
+    FILE, FILE_ID, FILE_NAME, FILE_SIZE, OFFSET, TRANSFER, BATCH, CONTACT_STATUS, ONLINE, OFFLINE, RESUME_TOKEN,
+    RESUMED,
+)
+
+# Типы значений в универсальной схеме
+TAG_NONE, TAG_FALSE, TAG_TRUE, TAG_INT, TAG_FLOAT, TAG_STR, TAG_LIST, TAG_DICT, TAG_ATOM, TAG_SHORT_STR, \
+    TAG_STR_LIST = range(11)
+ATOM_BYTES = {atom: bytes((TAG_ATOM, index)) for index, atom in enumerate(ATOMS)}
+
+
+# Компактный двоичный кодек. Первый байт кадра - номер схемы:
+#   SCHEMA_CHAT - обычное сообщение MESSAGE без лишних полей, упаковывается одним struct.pack;
+#   SCHEMA_STATUS - ответ, состоящий только из кода;
+#   SCHEMA_GENERIC - всё остальное, типизированное дерево значений с ключами из ATOMS.
+class BinaryCodec:
+    name = 'bin1'
+
+    SCHEMA_GENERIC = 0
+    SCHEMA_CHAT = 1
+    SCHEMA_STATUS = 2
+
+    chat_header = struct.Struct('!BdHHI')
+    status = struct.Struct('!BH')
+    tag_int = struct.Struct('!Bq')
+    tag_float = struct.Struct('!Bd')
+    tag_len = struct.Struct('!BI')
+    tag_short_len = struct.Struct('!BB')
+    tag_str_list = struct.Struct('!BII')
+    length = struct.Struct('!I')
+    int64 = struct.Struct('!q')
+    float64 = struct.Struct('!d')
+
+    def encode(self, message: dict) -> bytes:
+        if len(message) == 5 and message.get(ACTION) == MESSAGE:
+            try:
+                sender = message[SENDER].encode(ENCODING)
+                destination = message[DESTINATION].encode(ENCODING)
+                text = message[MESSAGE_TEXT].encode(ENCODING)
+                header = self.chat_header.pack(self.SCHEMA_CHAT, message[TIME], len(sender), len(destination),
+                                               len(text))
+            except (KeyError, AttributeError, TypeError, struct.error):
+                pass
+            else:
+                return b''.join((header, sender, destination, text))
+        if len(message) == 1 and type(message.get(RESPONSE)) is int and 0 <= message[RESPONSE] < 65536:
+            return self.status.pack(self.SCHEMA_STATUS, message[RESPONSE])
+
+        parts = [b'\x00']
+        self._encode_value(message, parts)
+        return b''.join(parts)
+
+    def _encode_value(self, value: Any, parts: List[bytes]) -> None:
+        if value is None:
+            parts.append(b'\x00')
+        elif value is True:
+            parts.append(b'\x02')
+        elif value is False:
+            parts.append(b'\x01')
+        elif isinstance(value, str):
+            atom = ATOM_BYTES.get(value)
+            if atom is not None:
+                parts.append(atom)
+            else:
+                data = value.encode(ENCODING)
+                if len(data) < 256:
+                    parts.append(self.tag_short_len.pack(TAG_SHORT_STR, len(data)))
+                else:
+                    parts.append(self.tag_len.pack(TAG_STR, len(data)))
+                parts.append(data)
+        elif isinstance(value, int):
+            try:
+                parts.append(self.tag_int.pack(TAG_INT, value))
+            except struct.error:
+                raise ValueError(f'Integer {value} does not fit into 64 bits')
+        elif isinstance(value, float):
+            parts.append(self.tag_float.pack(TAG_FLOAT, value))
+        elif isinstance(value, dict):
+            parts.append(self.tag_len.pack(TAG_DICT, len(value)))
+            for key, item in value.items():
+                self._encode_value(key, parts)
+                self._encode_value(item, parts)
+        elif isinstance(value, (list, tuple)):
+            # Списки имён (LIST_INFO) кодируются одной строкой с разделителем \0 - это одна операция на C
+            if value and all(type(item) is str for item in value):
+                data = '\0'.join(value).encode(ENCODING)
+                if data.count(b'\0') == len(value) - 1:
+                    parts.append(self.tag_str_list.pack(TAG_STR_LIST, len(value), len(data)))
+                    parts.append(data)
+                    return
+            parts.append(self.tag_len.pack(TAG_LIST, len(value)))
+            for item in value:
+                self._encode_value(item, parts)
+        else:
+            raise TypeError(f'Type {type(value).__name__} is not supported by {self.name} codec')
+
+    def decode(self, payload) -> dict:
+        try:
+            schema = payload[0]
+            if schema == self.SCHEMA_CHAT:
+                return self._decode_chat(payload)
+            if schema == self.SCHEMA_STATUS:
+                return {RESPONSE: self.status.unpack_from(payload)[1]}
+            if schema == self.SCHEMA_GENERIC:
+                message, offset = self._decode_value(payload, 1)
+                if isinstance(message, dict) and offset == len(payload):
+                    return message
+        except (IndexError, KeyError, TypeError, UnicodeDecodeError, RecursionError, struct.error):
+            pass
+        raise IncorrectDataRecivedError
+
+    def _decode_chat(self, payload) -> dict:
+        _, sent_at, sender_len, destination_len, text_len = self.chat_header.unpack_from(payload)
+        start = self.chat_header.size
+        if start + sender_len + destination_len + text_len != len(payload):
+            raise IncorrectDataRecivedError
+        sender_end = start + sender_len
+        destination_end = sender_end + destination_len
+        return {
+            ACTION: MESSAGE,
+            SENDER: str(payload[start:sender_end], ENCODING),
+            DESTINATION: str(payload[sender_end:destination_end], ENCODING),
+            TIME: sent_at,
+            MESSAGE_TEXT: str(payload[destination_end:], ENCODING),
+        }
+
+    def _decode_value(self, payload, offset: int):
+        tag = payload[offset]
+        offset += 1
+        if tag == TAG_ATOM:
+            return ATOMS[payload[offset]], offset + 1
+        if tag == TAG_SHORT_STR:
+            size = payload[offset]
+            offset += 1
+            if offset + size > len(payload):
+                raise IndexError
+            return str(payload[offset:offset + size], ENCODING), offset + size
+        if tag == TAG_STR:
+            size = self.length.unpack_from(payload, offset)[0]
+            offset += 4
+            if offset + size > len(payload):
+                raise IndexError
+            return str(payload[offset:offset + size], ENCODING), offset + size
+        if tag == TAG_STR_LIST:
+            count, size = self.tag_str_list.unpack_from(payload, offset - 1)[1:]
+            offset += 8
+            if offset + size > len(payload):
+                raise IndexError
+            items = str(payload[offset:offset + size], ENCODING).split('\0')
+            if len(items) != count:
+                raise IndexError
+            return items, offset + size
+        if tag == TAG_INT:
+            return self.int64.unpack_from(payload, offset)[0], offset + 8
+        if tag == TAG_FLOAT:
+            return self.float64.unpack_from(payload, offset)[0], offset + 8
+        if tag == TAG_DICT:
+            count = self.length.unpack_from(payload, offset)[0]
+            offset += 4
+            result = {}
+            for _ in range(count):
+                key, offset = self._decode_value(payload, offset)
+                result[key], offset = self._decode_value(payload, offset)
+            return result, offset
+        if tag == TAG_LIST:
+            count = self.length.unpack_from(payload, offset)[0]
+            offset += 4
+            result = []
+            for _ in range(count):
+                item, offset = self._decode_value(payload, offset)
+                result.append(item)
+            return result, offset
+        if tag == TAG_NONE:
+            return None, offset
+        if tag == TAG_TRUE:
+            return True, offset
+        if tag == TAG_FALSE:
+            return False, offset
+        raise KeyError(tag)
+
+
+# Поддерживаемые кодеки, первый предлагается клиентом по умолчанию
+CODEC_LIST = (BinaryCodec(), JsonCodec())
+CODECS = {codec.name: codec for codec in CODEC_LIST}
+SUPPORTED_CODECS = [codec.name for codec in CODEC_LIST]
+
+
+def negotiate(offered, supported=CODECS) -> Optional[str]:
+    if not isinstance(offered, list):
+        return None
+    for name in offered:
+        if isinstance(name, str) and name in supported:
+            return name
+    return None
+
+
+# Общая статистика сжатия по всем соединениям сервера
+class CompressionStats:
+    def __init__(self) -> None:
+        self.frames = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_seconds = 0.0
+        self.decompress_seconds = 0.0
+
+    @property
+    def ratio(self) -> float:
+        return self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 1.0
+
+
+# Потоковое сжатие zlib на одно соединение. Кадры сжимаются с Z_SYNC_FLUSH, поэтому каждый
+# распаковывается сразу по приходу, а словарь общий для всего соединения - повторяющиеся
+# имена и ключи в следующих кадрах почти ничего не стоят. Кадры меньше threshold не сжимаются
+# и в поток не попадают, так что состояние обеих сторон остаётся согласованным.
+class ZlibCompression:
+    name = 'zlib'
+
+    # Потоки zlib создаются при первом кадре, который действительно сжимается или распаковывается:
+    # у соединений, где все кадры короче threshold, их нет вовсе
+    def __init__(self, threshold: int = COMPRESSION_THRESHOLD, level: int = 6,
+                 stats: Optional[CompressionStats] = None, wbits: int = COMPRESSION_WBITS,
+                 memlevel: int = COMPRESSION_MEMLEVEL) -> None:
+        self.threshold = threshold
+        self.level = level
+        self.wbits = wbits
+        self.memlevel = memlevel
+        self.compressor = None
+        self.decompressor = None
+        self.stats = stats or CompressionStats()
+
+    def compress(self, payload: bytes) -> bytes:
+        start = time.perf_counter()
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits, self.memlevel)
+        data = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        stats = self.stats
+        stats.compress_seconds += time.perf_counter() - start
+        stats.frames += 1
+        stats.raw_bytes += len(payload)
+        stats.compressed_bytes += len(data)
+        return data
+
+    def decompress(self, data) -> bytes:
+        start = time.perf_counter()
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj()
+        try:
+            payload = self.decompressor.decompress(data, MAX_FRAME_LENGTH)
+        except zlib.error:
+            raise IncorrectDataRecivedError
+        if self.decompressor.unconsumed_tail:
+            raise IncorrectDataRecivedError
+        self.stats.decompress_seconds += time.perf_counter() - start
+        return payload
+
+
+COMPRESSIONS = {ZlibCompression.name: ZlibCompression}
+SUPPORTED_COMPRESSIONS = list(COMPRESSIONS)
@@ -64,10 +64,13 @@ class ClientDB:
         self.session.query(self.Contacts).filter_by(name=contact).delete()
         self.session.commit()
 
+    # Список может прийти повторно после переподключения, известные имена пропускаются
     def add_users(self, users_list: List[str]) -> None:
+        known = {row.username for row in self.session.query(self.KnownUsers.username)}
         for user in users_list:
-            user_row = self.KnownUsers(user)
-            self.session.add(user_row)
+            if user not in known:
+                known.add(user)
+                self.session.add(self.KnownUsers(user))
         self.session.commit()
 
     def save_message(self, from_user: str, to_user: str, message: str) -> None:
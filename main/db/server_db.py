@@ -1,8 +1,16 @@
-from typing import List, Optional
+from collections import Counter, defaultdict
+from typing import List, Optional, Tuple
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import create_engine, inspect, insert, select, tuple_, Column, Integer, String, Date, DateTime, \
+    ForeignKey, Index, func
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.orm import sessionmaker, declarative_base
-from datetime import datetime
+from datetime import date, datetime
+
+from variables import LOGIN_HISTORY_PAGE
+
+# Курсор страницы истории входов: время и id последней показанной записи
+LoginCursor = Tuple[datetime, int]
 
 
 class ServerDB:
@@ -34,6 +42,12 @@ class ServerDB:
 
     class LoginHistory(Base):
         __tablename__ = 'Login History'
+        # В SQLite id - это rowid и есть в каждом индексе, поэтому (user_id, login_time) отдаёт входы
+        # пользователя в порядке (login_time, id) без сортировки, а (login_time) - то же по всем
+        __table_args__ = (
+            Index('ix_login_history_user_time', 'user_id', 'login_time'),
+            Index('ix_login_history_time', 'login_time'),
+        )
         id = Column(Integer, primary_key=True)
         user_id = Column(Integer, ForeignKey('Users.id'))
         ip_address = Column(String)
@@ -46,6 +60,19 @@ class ServerDB:
             self.port = port
             self.login_time = login_time
 
+    # Входы пользователя за день. Строка обновляется при каждом входе, так что отчёты по дням
+    # не читают историю входов.
+    class DailyLogins(Base):
+        __tablename__ = 'Daily Logins'
+        __table_args__ = (
+            Index('ix_daily_logins_day', 'day'),
+        )
+        user_id = Column(Integer, ForeignKey('Users.id'), primary_key=True)
+        day = Column(Date, primary_key=True)
+        logins = Column(Integer)
+        first_login = Column(DateTime)
+        last_login = Column(DateTime)
+
     class Contacts(Base):
         __tablename__ = 'Contacts'
         id = Column(Integer, primary_key=True)
@@ -68,20 +95,43 @@ class ServerDB:
             self.sent = 0
             self.accepted = 0
 
-    def __init__(self, path) -> None:
+    # keep_active - не очищать список подключённых: сервер сам решит, кого из них оставить, прочитав снимок
+    def __init__(self, path, keep_active: bool = False) -> None:
         self.database_engine = create_engine(
             f'sqlite:///{path}',
             echo=False,
             pool_recycle=7200,
             connect_args={'check_same_thread': False}
         )
+        new_rollups = not inspect(self.database_engine).has_table(self.DailyLogins.__tablename__)
         self.Base.metadata.create_all(self.database_engine)
+        # create_all не добавляет индексы к уже существующим таблицам
+        for index in self.LoginHistory.__table__.indexes:
+            index.create(self.database_engine, checkfirst=True)
 
         Session = sessionmaker(bind=self.database_engine)
         self.session = Session()
-        self.session.query(self.ActiveUsers).delete()
+        if new_rollups:
+            self.rebuild_daily_logins()
+        if not keep_active:
+            self.clear_active_users()
+
+    # Очищает список подключённых, кроме пользователей из keep
+    def clear_active_users(self, keep: List[str] = ()) -> None:
+        query = self.session.query(self.ActiveUsers)
+        if keep:
+            user_ids = self.session.query(self.AllUsers.id).filter(self.AllUsers.name.in_(set(keep)))
+            query = query.filter(self.ActiveUsers.user_id.notin_(user_ids.scalar_subquery()))
+        query.delete(synchronize_session=False)
         self.session.commit()
 
+    # Отметка состояния пользователей и контактов: снимок сервера годится, только пока она не изменилась
+    def state_stamp(self) -> tuple:
+        stamp = ()
+        for table in (self.AllUsers, self.Contacts, self.ActiveUsers):
+            stamp += tuple(self.session.query(func.count(table.id), func.coalesce(func.max(table.id), 0)).one())
+        return stamp
+
     def user_login(self, username: str, ip_address: str, port: int) -> None:
         print(username, ip_address, port)
 
@@ -105,13 +155,35 @@ class ServerDB:
         )
         self.session.add(new_active_user)
 
+        login_time = datetime.now()
         history = self.LoginHistory(
             user_id=user.id,
-            login_time=datetime.now(),
+            login_time=login_time,
             ip_address=ip_address,
             port=port
         )
         self.session.add(history)
+        self.session.execute(self.count_daily_login(user.id, login_time))
+        self.session.commit()
+
+    # Прибавка к дневной сводке одним INSERT ... ON CONFLICT DO UPDATE
+    def count_daily_login(self, user_id: int, login_time: datetime):
+        daily = self.DailyLogins.__table__
+        statement = sqlite.insert(daily).values(user_id=user_id, day=login_time.date(), logins=1,
+                                                first_login=login_time, last_login=login_time)
+        return statement.on_conflict_do_update(
+            index_elements=[daily.c.user_id, daily.c.day],
+            set_={'logins': daily.c.logins + 1, 'last_login': statement.excluded.last_login})
+
+    # Сводка по дням заново из истории входов: для базы, созданной до появления сводки
+    def rebuild_daily_logins(self) -> None:
+        history = self.LoginHistory.__table__
+        self.session.query(self.DailyLogins).delete(synchronize_session=False)
+        self.session.execute(insert(self.DailyLogins.__table__).from_select(
+            ['user_id', 'day', 'logins', 'first_login', 'last_login'],
+            select(history.c.user_id, func.date(history.c.login_time), func.count(),
+                   func.min(history.c.login_time), func.max(history.c.login_time))
+            .group_by(history.c.user_id, func.date(history.c.login_time))))
         self.session.commit()
 
     def user_logout(self, username: str) -> None:
@@ -119,6 +191,13 @@ class ServerDB:
         self.session.query(self.ActiveUsers).filter_by(user_id=user.id).delete()
         self.session.commit()
 
+    # Выход сразу нескольких пользователей одним DELETE и одной фиксацией
+    def users_logout(self, usernames: List[str]) -> None:
+        user_ids = self.session.query(self.AllUsers.id).filter(self.AllUsers.name.in_(set(usernames)))
+        self.session.query(self.ActiveUsers).filter(self.ActiveUsers.user_id.in_(user_ids.scalar_subquery())).delete(
+            synchronize_session=False)
+        self.session.commit()
+
     def users_list(self) -> List[tuple]:
         query = self.session.query(self.AllUsers.name, self.AllUsers.last_login)
         return query.all()
@@ -132,41 +211,150 @@ class ServerDB:
         ).join(self.AllUsers)
         return query.all()
 
-    def login_history(self, username: Optional[str] = None) -> List[tuple]:
+    # Входы с since включительно до until, не включая его, по времени входа
+    def login_history(self, username: Optional[str] = None, since: Optional[datetime] = None,
+                      until: Optional[datetime] = None) -> List[tuple]:
+        query = self.login_history_query(username, since, until)
+        if query is None:
+            return []
+        return [row[:4] for row in query.order_by(self.LoginHistory.login_time, self.LoginHistory.id)]
+
+    def login_history_page(self, username: Optional[str] = None, since: Optional[datetime] = None,
+                           until: Optional[datetime] = None, limit: int = LOGIN_HISTORY_PAGE,
+                           after: Optional[LoginCursor] = None) -> Tuple[List[tuple], Optional[LoginCursor]]:
+        """Страница истории входов от новых к старым и курсор следующей страницы, None на последней.
+
+        Страница начинается сразу за курсором по индексу, а не пропуском OFFSET строк, поэтому
+        дальние страницы читаются так же быстро, как первая, и не сдвигаются от новых входов.
+        """
+        query = self.login_history_query(username, since, until)
+        if query is None:
+            return [], None
+        if after is not None:
+            query = query.filter(tuple_(self.LoginHistory.login_time, self.LoginHistory.id) < tuple_(*after))
+        rows = query.order_by(self.LoginHistory.login_time.desc(), self.LoginHistory.id.desc()).limit(limit + 1).all()
+        cursor = (rows[limit - 1].login_time, rows[limit - 1].id) if len(rows) > limit else None
+        return [row[:4] for row in rows[:limit]], cursor
+
+    # Запрос строк (имя, время, адрес, порт, id) или None, если пользователя нет. Пользователь ищется
+    # отдельно, чтобы отбор шёл по user_id и индексу (user_id, login_time).
+    def login_history_query(self, username: Optional[str], since: Optional[datetime], until: Optional[datetime]):
         query = self.session.query(
             self.AllUsers.name,
             self.LoginHistory.login_time,
             self.LoginHistory.ip_address,
-            self.LoginHistory.port
+            self.LoginHistory.port,
+            self.LoginHistory.id
+        ).join(self.AllUsers)
+        if username:
+            user = self.session.query(self.AllUsers.id).filter_by(name=username).first()
+            if user is None:
+                return None
+            query = query.filter(self.LoginHistory.user_id == user.id)
+        if since is not None:
+            query = query.filter(self.LoginHistory.login_time >= since)
+        if until is not None:
+            query = query.filter(self.LoginHistory.login_time < until)
+        return query
+
+    # Входы по дням из сводки: (имя, день, входов, первый вход, последний вход), дни с since по until включительно
+    def daily_logins(self, username: Optional[str] = None, since: Optional[date] = None,
+                     until: Optional[date] = None) -> List[tuple]:
+        query = self.session.query(
+            self.AllUsers.name,
+            self.DailyLogins.day,
+            self.DailyLogins.logins,
+            self.DailyLogins.first_login,
+            self.DailyLogins.last_login
         ).join(self.AllUsers)
         if username:
             query = query.filter(self.AllUsers.name == username)
-        return query.all()
+        if since is not None:
+            query = query.filter(self.DailyLogins.day >= since)
+        if until is not None:
+            query = query.filter(self.DailyLogins.day <= until)
+        return query.order_by(self.DailyLogins.day, self.AllUsers.name).all()
+
+    # Итоги за дни с since по until по пользователям: (имя, входов, дней со входами, последний вход).
+    # Сводка группируется по user_id, имена подставляются уже к итогам.
+    def login_totals(self, since: Optional[date] = None, until: Optional[date] = None) -> List[tuple]:
+        query = self.session.query(
+            self.DailyLogins.user_id,
+            func.sum(self.DailyLogins.logins).label('logins'),
+            func.count(self.DailyLogins.day).label('days'),
+            func.max(self.DailyLogins.last_login).label('last_login')
+        )
+        if since is not None:
+            query = query.filter(self.DailyLogins.day >= since)
+        if until is not None:
+            query = query.filter(self.DailyLogins.day <= until)
+        totals = query.group_by(self.DailyLogins.user_id).subquery()
+        return self.session.query(
+            self.AllUsers.name,
+            totals.c.logins,
+            totals.c.days,
+            totals.c.last_login
+        ).join(totals, self.AllUsers.id == totals.c.user_id).order_by(totals.c.logins.desc()).all()
 
+    # Получатель может быть зарегистрирован только на другом узле кластера, тогда счётчики не меняются
     def process_message(self, sender_name: str, recipient_name: str) -> None:
-        sender_id = self.session.query(self.AllUsers).filter_by(name=sender_name).first().id
-        recipient_id = self.session.query(self.AllUsers).filter_by(name=recipient_name).first().id
-
-        sender_row = self.session.query(self.History).filter_by(user_id=sender_id).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(self.History).filter_by(user_id=recipient_id).first()
-        recipient_row.accepted += 1
-
-        self.session.commit()
+        self.process_group_message(sender_name, [recipient_name])
+
+    # Групповое сообщение: счётчики отправителя и всех получателей обновляются двумя UPDATE в одной транзакции
+    def process_group_message(self, sender_name: str, recipient_names: List[str]) -> int:
+        sender = self.session.query(self.AllUsers.id).filter_by(name=sender_name).one()
+        recipient_ids = [row.id for row in
+                         self.session.query(self.AllUsers.id).filter(self.AllUsers.name.in_(set(recipient_names)))]
+        if recipient_ids:
+            self.session.query(self.History).filter(self.History.user_id == sender.id).update(
+                {self.History.sent: self.History.sent + len(recipient_ids)}, synchronize_session=False)
+            self.session.query(self.History).filter(self.History.user_id.in_(recipient_ids)).update(
+                {self.History.accepted: self.History.accepted + 1}, synchronize_session=False)
+            self.session.commit()
+        return len(recipient_ids)
+
+    # Пачка сообщений [(отправитель, [получатели]), ...] одной транзакцией. Прибавки к счётчикам
+    # суммируются заранее, и на каждую пару "счётчик, величина прибавки" уходит один UPDATE.
+    def process_messages(self, messages: List[Tuple[str, List[str]]]) -> int:
+        names = set()
+        for sender_name, recipient_names in messages:
+            names.add(sender_name)
+            names.update(recipient_names)
+        ids = dict(self.session.query(self.AllUsers.name, self.AllUsers.id).filter(self.AllUsers.name.in_(names)))
+        sent, accepted = Counter(), Counter()
+        for sender_name, recipient_names in messages:
+            recipient_ids = {ids[name] for name in recipient_names if name in ids}
+            if sender_name in ids and recipient_ids:
+                sent[ids[sender_name]] += len(recipient_ids)
+                accepted.update(recipient_ids)
+        for column, increments in ((self.History.sent, sent), (self.History.accepted, accepted)):
+            by_amount = defaultdict(list)
+            for user_id, amount in increments.items():
+                by_amount[amount].append(user_id)
+            for amount, user_ids in by_amount.items():
+                self.session.query(self.History).filter(self.History.user_id.in_(user_ids)).update(
+                    {column: column + amount}, synchronize_session=False)
+        if sent:
+            self.session.commit()
+        return sum(sent.values())
 
-    def add_contact(self, user_name: str, contact_name: str) -> None:
+    # False, если такого пользователя нет
+    def add_contact(self, user_name: str, contact_name: str) -> bool:
         user = self.session.query(self.AllUsers).filter_by(name=user_name).first()
         contact = self.session.query(self.AllUsers).filter_by(name=contact_name).first()
 
-        if not contact or self.session.query(self.Contacts).filter_by(
+        if not contact:
+            return False
+        if self.session.query(self.Contacts).filter_by(
                 user_id=user.id,
                 contact_id=contact.id
         ).count():
-            return
+            return True
 
         contact_row = self.Contacts(user.id, contact.id)
         self.session.add(contact_row)
         self.session.commit()
+        return True
 
     def remove_contact(self, user_name: str, contact_name: str) -> None:
         user = self.session.query(self.AllUsers).filter_by(name=user_name).first()
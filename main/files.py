@@ -0,0 +1,157 @@
+import json
+import os
+import re
+import time
+import uuid
+from collections import deque
+from typing import Optional
+
+from variables import *
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+
+# Идентификатор файла - uuid4 в hex, другие строки не превращаются в пути на диске
+FILE_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+class Transfer:
+    """Одна передача файла в одну сторону: сколько байт прошло и за какое время."""
+
+    def __init__(self, file_id: str, direction: str, size: int, offset: int) -> None:
+        self.file_id = file_id
+        self.direction = direction
+        self.size = size
+        # Передача может продолжать прерванную, в статистику идёт только переданное в этот раз
+        self.start_offset = offset
+        self.offset = offset
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.offset >= self.size
+
+    @property
+    def bytes(self) -> int:
+        return self.offset - self.start_offset
+
+    @property
+    def seconds(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    # Байт в секунду
+    @property
+    def throughput(self) -> float:
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def finish(self) -> None:
+        self.finished = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            FILE_ID: self.file_id,
+            'direction': self.direction,
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 6),
+            'throughput': round(self.throughput, 1),
+        }
+
+
+class Upload:
+    """Загрузка файла от клиента: куски пишутся в <id>.part по своим смещениям."""
+
+    def __init__(self, info: dict, fd: int, offset: int) -> None:
+        self.info = info
+        self.fd = fd
+        self.transfer = Transfer(info[FILE_ID], UPLOAD, info[FILE_SIZE], offset)
+
+    def write(self, data: bytes) -> None:
+        os.pwrite(self.fd, data, self.transfer.offset)
+        self.transfer.offset += len(data)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Download:
+    """Отправка готового файла клиенту кусками не больше FILE_CHUNK_SIZE."""
+
+    def __init__(self, info: dict, file, offset: int) -> None:
+        self.info = info
+        self.file = file
+        self.transfer = Transfer(info[FILE_ID], DOWNLOAD, info[FILE_SIZE], offset)
+
+    def next_chunk(self) -> int:
+        return min(FILE_CHUNK_SIZE, self.transfer.size - self.transfer.offset)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class FileStore:
+    """Файлы, переданные через сервер.
+
+    Каждый файл - это описание <id>.json (отправитель, адресат, имя, размер) и данные:
+    <id>.part, пока загрузка не закончена, и <id> после неё. Всё состояние лежит на диске,
+    поэтому загрузку можно продолжить после обрыва, а рабочие процессы одного сервера
+    отдают файлы, загруженные через соседей.
+    """
+
+    def __init__(self, path: str = FILES_DIR, history: int = 100) -> None:
+        self.path = path
+        # Статистика последних законченных передач
+        self.recent = deque(maxlen=history)
+
+    def _path(self, file_id: str, suffix: str = '') -> Optional[str]:
+        if not isinstance(file_id, str) or not FILE_ID_PATTERN.fullmatch(file_id):
+            return None
+        return os.path.join(self.path, file_id + suffix)
+
+    def create(self, sender: str, destination, name: str, size: int) -> dict:
+        os.makedirs(self.path, exist_ok=True)
+        info = {
+            FILE_ID: uuid.uuid4().hex,
+            SENDER: sender,
+            DESTINATION: destination,
+            FILE_NAME: name,
+            FILE_SIZE: size,
+            TIME: time.time(),
+        }
+        with open(self._path(info[FILE_ID], '.json'), 'w', encoding=ENCODING) as file:
+            json.dump(info, file)
+        return info
+
+    def info(self, file_id: str) -> Optional[dict]:
+        path = self._path(file_id, '.json')
+        if path is None:
+            return None
+        try:
+            with open(path, encoding=ENCODING) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def complete(self, file_id: str) -> bool:
+        path = self._path(file_id)
+        return path is not None and os.path.exists(path)
+
+    # Загрузка продолжается с конца уже записанного: куски пишутся только по порядку
+    def upload(self, info: dict) -> Upload:
+        fd = os.open(self._path(info[FILE_ID], '.part'), os.O_WRONLY | os.O_CREAT, 0o644)
+        return Upload(info, fd, os.fstat(fd).st_size)
+
+    def finish_upload(self, upload: Upload) -> None:
+        upload.close()
+        upload.transfer.finish()
+        file_id = upload.info[FILE_ID]
+        os.replace(self._path(file_id, '.part'), self._path(file_id))
+        self.recent.append(upload.transfer.stats())
+
+    def download(self, info: dict, offset: int) -> Download:
+        return Download(info, open(self._path(info[FILE_ID]), 'rb'), offset)
+
+    def finish_download(self, download: Download) -> None:
+        download.close()
+        download.transfer.finish()
+        self.recent.append(download.transfer.stats())
@@ -0,0 +1,283 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import Counter
+from typing import Iterator, List, Optional, Tuple
+
+import click
+
+from variables import *
+
+logger = logging.getLogger('server')
+
+# Запись: длина нагрузки, crc32 нагрузки, время записи; нагрузка - сообщение в JSON
+RECORD_HEADER = struct.Struct('<IId')
+# Индекс сегмента: смещение каждой записи от начала сегмента
+INDEX_ENTRY = struct.Struct('<Q')
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+Record = Tuple[int, float, dict]
+
+
+def segment_path(path: str, first_seq: int, suffix: str = SEGMENT_SUFFIX) -> str:
+    return os.path.join(path, f'{first_seq:020d}{suffix}')
+
+
+# Сегменты каталога по порядку: [(номер первой записи, путь), ...]
+def list_segments(path: str) -> List[Tuple[int, str]]:
+    if not os.path.isdir(path):
+        return []
+    segments = []
+    for name in os.listdir(path):
+        stem, suffix = os.path.splitext(name)
+        if suffix == SEGMENT_SUFFIX and stem.isdigit():
+            segments.append((int(stem), os.path.join(path, name)))
+    return sorted(segments)
+
+
+# Смещения целых записей с верной контрольной суммой, начиная с offset
+def scan_records(data, offset: int = 0) -> Iterator[Tuple[int, float, bytes]]:
+    end = len(data)
+    while offset + RECORD_HEADER.size <= end:
+        size, crc, written = RECORD_HEADER.unpack_from(data, offset)
+        payload_end = offset + RECORD_HEADER.size + size
+        if payload_end > end:
+            return
+        payload = data[offset + RECORD_HEADER.size:payload_end]
+        if zlib.crc32(payload) != crc:
+            return
+        yield offset, written, payload
+        offset = payload_end
+
+
+def read_segment(first_seq: int, path: str, start: int = 0) -> Iterator[Record]:
+    """Записи сегмента с номера start: последовательное чтение через mmap без копирования файла.
+
+    Начальное смещение берётся из индекса сегмента, так что чтение с середины не просматривает
+    предыдущие записи. Недописанная запись в конце (обрыв во время записи) завершает чтение.
+    """
+    if os.path.getsize(path) == 0:
+        return
+    offset = 0
+    skip = max(0, start - first_seq)
+    index_path = os.path.splitext(path)[0] + INDEX_SUFFIX
+    if skip and os.path.exists(index_path) and os.path.getsize(index_path) >= (skip + 1) * INDEX_ENTRY.size:
+        with open(index_path, 'rb') as index:
+            index.seek(skip * INDEX_ENTRY.size)
+            offset = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0]
+        seq = first_seq + skip
+    else:
+        seq = first_seq
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for _, written, payload in scan_records(data, offset):
+            if seq >= start:
+                yield seq, written, json.loads(payload)
+            seq += 1
+
+
+def replay(path: str, start: int = 0) -> Iterator[Record]:
+    """Все записи журнала в каталоге path с номера start: (номер, время записи, сообщение)."""
+    segments = list_segments(path)
+    for position, (first_seq, segment) in enumerate(segments):
+        following = segments[position + 1][0] if position + 1 < len(segments) else None
+        if following is not None and following <= start:
+            continue
+        yield from read_segment(first_seq, segment, start)
+
+
+class MessageJournal:
+    """Журнал доставленных сервером сообщений: только дописывание, файлы-сегменты по segment_size байт.
+
+    Каждый сегмент называется номером своей первой записи, а рядом лежит индекс со смещениями
+    записей, поэтому чтение с любого номера начинается сразу с нужного места. Записи копятся
+    в памяти и уходят на диск одним write в commit, который сервер вызывает раз за проход цикла.
+    fsync_interval задаёт, как часто данные сбрасываются на диск: 0 - при каждом commit,
+    N - не чаще раза в N секунд, None - когда решит ОС. Старые сегменты удаляются, когда
+    журнал больше max_bytes или сегмент старше max_age секунд; проверка идёт при ротации и из commit
+    раз в JOURNAL_RETENTION_INTERVAL секунд, текущий сегмент не удаляется.
+    После аварийной остановки недописанный хвост последнего сегмента отрезается, а его индекс
+    строится заново.
+    """
+
+    def __init__(self, path: str, segment_size: int = JOURNAL_SEGMENT_SIZE,
+                 fsync_interval: Optional[float] = JOURNAL_FSYNC_INTERVAL, max_bytes: Optional[int] = None,
+                 max_age: Optional[float] = None) -> None:
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.buffer = bytearray()
+        self.index_buffer = bytearray()
+        self.synced_at = time.monotonic()
+        self.retention_at = time.monotonic()
+        self.dirty = False
+        os.makedirs(path, exist_ok=True)
+        segments = list_segments(path)
+        if segments:
+            self.first_seq, segment = segments[-1]
+            self.next_seq = self.first_seq + self.recover(segment)
+        else:
+            self.first_seq = self.next_seq = 0
+        self.open_segment()
+        self.enforce_retention()
+
+    # Проверяет последний сегмент: отрезает повреждённый хвост и пишет индекс заново.
+    # Возвращает число целых записей в нём.
+    def recover(self, segment: str) -> int:
+        offsets = []
+        end = 0
+        if os.path.getsize(segment):
+            with open(segment, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset, _, payload in scan_records(data):
+                    offsets.append(offset)
+                    end = offset + RECORD_HEADER.size + len(payload)
+        if end != os.path.getsize(segment):
+            logger.warning('Journal segment %s has a damaged tail, truncated to %s bytes', segment, end)
+            os.truncate(segment, end)
+        with open(os.path.splitext(segment)[0] + INDEX_SUFFIX, 'wb') as index:
+            index.write(b''.join(INDEX_ENTRY.pack(offset) for offset in offsets))
+        return len(offsets)
+
+    def open_segment(self) -> None:
+        self.segment = os.open(segment_path(self.path, self.first_seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index = os.open(segment_path(self.path, self.first_seq, INDEX_SUFFIX),
+                             os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.segment).st_size
+
+    # Возвращает номер записи
+    def append(self, message: dict, now: Optional[float] = None) -> int:
+        payload = json.dumps(message, ensure_ascii=False, separators=(',', ':'), default=str).encode(ENCODING)
+        self.index_buffer += INDEX_ENTRY.pack(self.size + len(self.buffer))
+        self.buffer += RECORD_HEADER.pack(len(payload), zlib.crc32(payload), now or time.time())
+        self.buffer += payload
+        seq = self.next_seq
+        self.next_seq += 1
+        if self.size + len(self.buffer) >= self.segment_size:
+            self.commit()
+            self.rotate()
+        return seq
+
+    # Групповая запись накопленного. Возвращает число записанных байт.
+    def commit(self, now: Optional[float] = None) -> int:
+        written = len(self.buffer)
+        if written:
+            write_all(self.segment, self.buffer)
+            write_all(self.index, self.index_buffer)
+            self.size += written
+            self.buffer.clear()
+            self.index_buffer.clear()
+            self.dirty = True
+        if self.dirty and self.fsync_interval is not None:
+            now = now or time.monotonic()
+            if now - self.synced_at >= self.fsync_interval:
+                self.sync(now)
+        # Без ротации сегменты иначе не удалялись бы по сроку на сервере, которому не хватает трафика
+        # заполнить сегмент
+        if self.max_bytes is not None or self.max_age is not None:
+            now = now or time.monotonic()
+            if now - self.retention_at >= JOURNAL_RETENTION_INTERVAL:
+                self.retention_at = now
+                self.enforce_retention()
+        return written
+
+    # Индекс не сбрасывается: после сбоя он строится заново по сегменту
+    def sync(self, now: Optional[float] = None) -> None:
+        os.fsync(self.segment)
+        self.dirty = False
+        self.synced_at = now or time.monotonic()
+
+    def rotate(self) -> None:
+        if self.dirty:
+            self.sync()
+        os.close(self.segment)
+        os.close(self.index)
+        self.first_seq = self.next_seq
+        self.open_segment()
+        self.enforce_retention()
+
+    def enforce_retention(self, now: Optional[float] = None) -> List[str]:
+        now = now or time.time()
+        segments = [(path, os.path.getsize(path), os.path.getmtime(path))
+                    for first_seq, path in list_segments(self.path) if first_seq != self.first_seq]
+        total = sum(size for _, size, _ in segments) + self.size
+        removed = []
+        for path, size, modified in segments:
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            too_old = self.max_age is not None and now - modified > self.max_age
+            if not (too_big or too_old):
+                break
+            os.unlink(path)
+            index_path = os.path.splitext(path)[0] + INDEX_SUFFIX
+            if os.path.exists(index_path):
+                os.unlink(index_path)
+            total -= size
+            removed.append(path)
+        if removed:
+            logger.info('Journal retention removed %s segments', len(removed))
+        return removed
+
+    def replay(self, start: int = 0) -> Iterator[Record]:
+        self.commit()
+        return replay(self.path, start)
+
+    def close(self) -> None:
+        self.commit()
+        if self.dirty:
+            self.sync()
+        os.close(self.segment)
+        os.close(self.index)
+
+
+def write_all(fd: int, data: bytearray) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+@click.group()
+@click.option('--path', default=JOURNAL_DIR, help='Journal directory')
+@click.pass_context
+def cli(context: click.Context, path: str) -> None:
+    context.obj = path
+
+
+@cli.command()
+@click.option('--start', default=0, help='First record number')
+@click.option('--since', type=float, default=None, help='Only records written after this unix time')
+@click.pass_obj
+def export(path: str, start: int, since: Optional[float]) -> None:
+    """Записи журнала в JSON Lines: {"seq", "time", "message"} в строке."""
+    for seq, written, message in replay(path, start):
+        if since is None or written >= since:
+            sys.stdout.write(json.dumps({'seq': seq, 'time': written, 'message': message}, ensure_ascii=False) + '\n')
+
+
+@cli.command()
+@click.pass_obj
+def counters(path: str) -> None:
+    """Счётчики отправленных и принятых сообщений по журналу, как в таблице History.
+
+    Журнал хранит адресата так, как его указал отправитель, поэтому BROADCAST считается
+    одной отправкой без получателей. Сегменты, удалённые по сроку хранения, в счёт не входят.
+    """
+    sent, accepted = Counter(), Counter()
+    for _, _, message in replay(path):
+        if message.get(ACTION) != MESSAGE:
+            continue
+        destination = message.get(DESTINATION)
+        recipients = destination if isinstance(destination, list) else [] if destination == BROADCAST else [destination]
+        sent[message.get(SENDER)] += max(len(recipients), 1)
+        accepted.update(recipients)
+    for name in sorted(set(sent) | set(accepted)):
+        click.echo(f'{name}\t{sent[name]}\t{accepted[name]}')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,39 @@
+from typing import Dict, Optional, Tuple
+
+# (запросов в секунду, размер всплеска) или None - без ограничения
+Limit = Optional[Tuple[float, int]]
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate: float, burst: int, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = now
+
+    def take(self, now: float, cost: float = 1) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+# Ограничение частоты запросов одного соединения: по корзине на каждое действие,
+# корзины создаются при первом запросе. Действия без своего лимита берут default.
+class RateLimiter:
+    def __init__(self, limits: Dict[str, Limit], default: Limit = None) -> None:
+        self.limits = limits
+        self.default = default
+        self.buckets: Dict[str, Optional[TokenBucket]] = {}
+
+    def allow(self, action: str, now: float) -> bool:
+        try:
+            bucket = self.buckets[action]
+        except KeyError:
+            limit = self.limits.get(action, self.default)
+            bucket = self.buckets[action] = TokenBucket(limit[0], limit[1], now) if limit else None
+        return bucket is None or bucket.take(now)
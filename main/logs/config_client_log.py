@@ -1,7 +1,10 @@
+import atexit
 import sys
 import os
-import logging
-from main.variables import LOGGING_LEVEL
+import logging.handlers
+import queue
+from variables import LOGGING_LEVEL, TRAFFIC_LOG_RATE, TRAFFIC_LOG_SAMPLE
+from logs.handlers import RateLimitFilter, LocalQueueHandler
 sys.path.append('../')
 
 client_formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(message)s')
@@ -15,7 +18,14 @@ steam.setLevel(logging.ERROR)
 log_file = logging.FileHandler(path, encoding='utf8')
 log_file.setFormatter(client_formatter)
 
+log_queue = queue.SimpleQueue()
+listener = logging.handlers.QueueListener(log_queue, steam, log_file, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
 logger = logging.getLogger('client')
-logger.addHandler(steam)
-logger.addHandler(log_file)
+logger.addHandler(LocalQueueHandler(log_queue))
 logger.setLevel(LOGGING_LEVEL)
+
+traffic_logger = logging.getLogger('client.traffic')
+traffic_logger.addFilter(RateLimitFilter(TRAFFIC_LOG_RATE, TRAFFIC_LOG_SAMPLE))
@@ -1,7 +1,10 @@
+import atexit
 import sys
 import logging.handlers
 import os
-from main.variables import LOGGING_LEVEL
+import queue
+from variables import LOGGING_LEVEL, TRAFFIC_LOG_RATE, TRAFFIC_LOG_SAMPLE
+from logs.handlers import RateLimitFilter, LocalQueueHandler
 sys.path.append('../')
 
 # создаём формировщик логов (formatter):
@@ -16,7 +19,19 @@ steam.setLevel(logging.INFO)
 log_file = logging.handlers.TimedRotatingFileHandler(path, encoding='utf8', interval=1, when='D')
 log_file.setFormatter(server_formatter)
 
+# Сетевой цикл только кладёт записи в очередь, запись на диск и в консоль идёт в отдельном потоке
+log_queue = queue.SimpleQueue()
+listener = logging.handlers.QueueListener(log_queue, steam, log_file, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+# Поток записи не переживает fork, поэтому рабочий процесс сервера запускает свой
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=listener.start)
+
 logger = logging.getLogger('server')
-logger.addHandler(steam)
-logger.addHandler(log_file)
+logger.addHandler(LocalQueueHandler(log_queue))
 logger.setLevel(LOGGING_LEVEL)
+
+# Записи о каждом соединении и сообщении прореживаются, чтобы не забивать очередь под нагрузкой
+traffic_logger = logging.getLogger('server.traffic')
+traffic_logger.addFilter(RateLimitFilter(TRAFFIC_LOG_RATE, TRAFFIC_LOG_SAMPLE))
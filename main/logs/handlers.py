@@ -0,0 +1,48 @@
+import logging
+import logging.handlers
+import time
+
+
+# Пропускает каждую sample_every-ю запись и не более rate записей в секунду на каждый шаблон сообщения.
+# Число отброшенных записей дописывается к следующей пропущенной, чтобы потери были видны в логе.
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate: float = 0, sample_every: int = 1, burst: int = 0) -> None:
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self.sample_every = max(sample_every, 1)
+        self.seen = 0
+        self.buckets = {}
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        self.seen += 1
+        if self.seen % self.sample_every:
+            self.suppressed += 1
+            return False
+
+        if self.rate:
+            now = time.monotonic()
+            tokens, last = self.buckets.get(record.msg, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[record.msg] = (tokens, now)
+                self.suppressed += 1
+                return False
+            self.buckets[record.msg] = (tokens - 1, now)
+
+        if self.suppressed:
+            record.msg = f'{record.getMessage()} (+{self.suppressed} similar records suppressed)'
+            record.args = None
+            self.suppressed = 0
+        return True
+
+
+# Очередь живёт внутри процесса, поэтому запись не нужно заранее форматировать и очищать от аргументов:
+# форматирование целиком переезжает в поток QueueListener
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
@@ -1,28 +1,270 @@
 import json
+import socket
+import struct
 import sys
+import time
+from typing import List, Tuple
 
 from errors import IncorrectDataRecivedError, NonDictInputError
-from variables import MAX_PACKAGE_LENGTH, ENCODING
+from variables import MAX_PACKAGE_LENGTH, MAX_FRAME_LENGTH, RECV_BUFFER_SIZE, ENCODING, FILE_DATA
 
 sys.path.append('/')
 
+# Заголовок кадра после согласования кодека: старший байт - флаги, младшие три - длина нагрузки
+FRAME_HEADER = struct.Struct('!I')
+FRAME_LENGTH_MASK = 0xFFFFFF
+FLAG_COMPRESSED = 0x01
+# Кадр с данными файла: нагрузка - длина описания, описание кодеком соединения и сырые байты.
+# Такие кадры не сжимаются, а данные отправляются без копирования в нагрузку.
+FLAG_DATA = 0x02
+DATA_META = struct.Struct('!H')
+# Заголовок отправляется с MSG_MORE, чтобы ядро не выпускало его отдельным маленьким пакетом
+SEND_MORE = getattr(socket, 'MSG_MORE', 0)
 
-def get_message(client):
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
-    if isinstance(encoded_response, bytes):
-        json_response = encoded_response.decode(ENCODING)
-        response = json.loads(json_response)
-        if isinstance(response, dict):
-            return response
-        else:
+
+# Соединение с согласованным форматом обмена. Пока кодек не выбран (codec is None),
+# работает как раньше: один recv - один JSON без заголовка. После выбора кодека
+# каждое сообщение передаётся кадром "заголовок + нагрузка", нагрузка может быть сжата.
+# Приём идёт через recv_into в собственный буфер соединения: кадры нарезаются memoryview
+# и декодируются прямо из буфера, буфер переиспользуется и растёт не больше чем до max_buffer.
+class Channel:
+    def __init__(self, sock, codec=None, compression=None, buffer_size: int = RECV_BUFFER_SIZE,
+                 max_buffer: int = MAX_FRAME_LENGTH + FRAME_HEADER.size) -> None:
+        self.sock = sock
+        self.codec = codec
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.max_buffer = max_buffer
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        # Когда с соединения последний раз пришли данные, по time.monotonic()
+        self.last_seen = time.monotonic()
+        try:
+            self.peer = sock.getpeername()
+        except OSError:
+            self.peer = None
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def _reserve(self, size: int) -> None:
+        # Освобождает место под кадр размера size: сдвигает хвост в начало или увеличивает буфер
+        pending = self.end - self.start
+        if size > self.max_buffer:
+            raise IncorrectDataRecivedError
+        if size > len(self.buffer):
+            buffer = bytearray(max(size, min(len(self.buffer) * 2, self.max_buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def _fill(self) -> int:
+        if self.end == len(self.buffer):
+            self._reserve(len(self.buffer) + 1 if not self.start else self.end - self.start)
+        received = self.sock.recv_into(self.view[self.end:])
+        if not received:
+            raise ConnectionError('Connection closed by peer')
+        self.end += received
+        self.last_seen = time.monotonic()
+        return received
+
+    def _next_frame(self):
+        available = self.end - self.start
+        if available < FRAME_HEADER.size:
+            return None
+        header = FRAME_HEADER.unpack_from(self.buffer, self.start)[0]
+        flags, size = header >> 24, header & FRAME_LENGTH_MASK
+        if size > MAX_FRAME_LENGTH:
             raise IncorrectDataRecivedError
-    else:
+        frame_end = self.start + FRAME_HEADER.size + size
+        if frame_end > self.end:
+            if FRAME_HEADER.size + size > len(self.buffer) - self.start:
+                self._reserve(FRAME_HEADER.size + size)
+            return None
+        payload = self.view[frame_end - size:frame_end]
+        self.start = frame_end
+        return flags, payload, size
+
+    def _decode_frame(self, flags: int, payload, size: int) -> Tuple[dict, int]:
+        try:
+            return decode_payload(self.codec, self.compression, flags, payload), size + FRAME_HEADER.size
+        finally:
+            if self.start == self.end:
+                self.start = self.end = 0
+                # Буфер, раздувшийся под большой кадр, возвращается к исходному размеру
+                if len(self.buffer) > self.buffer_size:
+                    self.buffer = bytearray(self.buffer_size)
+                    self.view = memoryview(self.buffer)
+
+    # Ответ на PRESENCE - один JSON без заголовка, но сразу за ним сервер может отправить кадры
+    # (например, сообщения, накопленные за время обрыва), и они приходят тем же recv.
+    # Разбирается только JSON, остаток остаётся в буфере и читается как кадры.
+    def read_handshake(self) -> dict:
+        received = self.sock.recv_into(self.view[:MAX_PACKAGE_LENGTH])
+        if not received:
+            raise ConnectionError('Connection closed by peer')
+        self.last_seen = time.monotonic()
+        response, size = decode_handshake(self.view[:received])
+        self.start, self.end = size, received
+        if self.start == self.end:
+            self.start = self.end = 0
+        return response
+
+    def read_message(self) -> Tuple[dict, int]:
+        if self.codec is None:
+            received = self.sock.recv_into(self.view[:MAX_PACKAGE_LENGTH])
+            self.last_seen = time.monotonic()
+            return decode_legacy(self.view[:received])
+        frame = self._next_frame()
+        while frame is None:
+            self._fill()
+            frame = self._next_frame()
+        return self._decode_frame(*frame)
+
+    # Для сервера: один recv_into на одно срабатывание select и все целиком пришедшие кадры.
+    # Незаконченный кадр остаётся в буфере до следующего раза, поэтому цикл сервера не блокируется.
+    def read_messages(self) -> List[Tuple[dict, int]]:
+        if self.codec is None:
+            return [self.read_message()]
+        self._fill()
+        return self.buffered_messages()
+
+    # Кадры, уже целиком лежащие в буфере, без обращения к сокету
+    def buffered_messages(self) -> List[Tuple[dict, int]]:
+        messages = []
+        frame = self._next_frame()
+        while frame is not None:
+            messages.append(self._decode_frame(*frame))
+            frame = self._next_frame()
+        return messages
+
+    def write_message(self, message: dict) -> int:
+        if self.codec is None:
+            return send_message(self.sock, message)
+        frame = encode_frame(self.codec, self.compression, message)
+        self.sock.sendall(frame)
+        return len(frame)
+
+    def write_data(self, meta: dict, data) -> int:
+        header = data_frame_header(self.codec, meta, len(data))
+        self.sock.sendall(header, SEND_MORE)
+        self.sock.sendall(data)
+        return len(header) + len(data)
+
+    # Кусок файла с диска прямо в сокет через sendfile, минуя память процесса
+    def send_file(self, meta: dict, file, offset: int, count: int) -> int:
+        header = data_frame_header(self.codec, meta, count)
+        self.sock.sendall(header, SEND_MORE)
+        sent = self.sock.sendfile(file, offset, count)
+        if sent != count:
+            raise ConnectionError('File is shorter than announced')
+        return len(header) + count
+
+    # Для рассылки: сообщение кодируется один раз на каждый кодек (encode), а готовая нагрузка
+    # отправляется всем соединениям с тем же кодеком (write_payload). Сжатие у каждого соединения
+    # своё потоковое, поэтому оно остаётся в write_payload.
+    def encode(self, message: dict) -> bytes:
+        if self.codec is None:
+            return json.dumps(message).encode(ENCODING)
+        return self.codec.encode(message)
+
+    def write_payload(self, payload: bytes) -> int:
+        if self.codec is None:
+            self.sock.send(payload)
+            return len(payload)
+        frame = frame_payload(self.compression, payload)
+        self.sock.sendall(frame)
+        return len(frame)
+
+
+# Кодирование и разбор кадра отдельно от сокета - общие для Channel и asyncio-клиента
+def encode_frame(codec, compression, message: dict) -> bytes:
+    return frame_payload(compression, codec.encode(message))
+
+
+def frame_payload(compression, payload: bytes) -> bytes:
+    flags = 0
+    if compression is not None and len(payload) >= compression.threshold:
+        payload = compression.compress(payload)
+        flags = FLAG_COMPRESSED
+    return FRAME_HEADER.pack(flags << 24 | len(payload)) + payload
+
+
+def data_frame_header(codec, meta: dict, size: int) -> bytes:
+    encoded = codec.encode(meta)
+    length = DATA_META.size + len(encoded) + size
+    if len(encoded) > 0xFFFF or length > MAX_FRAME_LENGTH:
+        raise ValueError('Data frame is too large')
+    return FRAME_HEADER.pack(FLAG_DATA << 24 | length) + DATA_META.pack(len(encoded)) + encoded
+
+
+def decode_payload(codec, compression, flags: int, payload) -> dict:
+    if flags & FLAG_DATA:
+        if len(payload) < DATA_META.size:
+            raise IncorrectDataRecivedError
+        meta_end = DATA_META.size + DATA_META.unpack_from(payload)[0]
+        if meta_end > len(payload):
+            raise IncorrectDataRecivedError
+        message = codec.decode(payload[DATA_META.size:meta_end])
+        # Копия: буфер соединения переиспользуется под следующие кадры
+        message[FILE_DATA] = bytes(payload[meta_end:])
+        return message
+    if flags & FLAG_COMPRESSED:
+        if compression is None:
+            raise IncorrectDataRecivedError
+        payload = compression.decompress(payload)
+    return codec.decode(payload)
+
+
+def decode_legacy(encoded) -> Tuple[dict, int]:
+    response = json.loads(str(encoded, ENCODING))
+    if isinstance(response, dict):
+        return response, len(encoded)
+    raise IncorrectDataRecivedError
+
+
+# JSON в начале data и число его байт. Ответ сервера - ASCII (json.dumps экранирует остальное),
+# поэтому latin-1 переводит байты в символы один к одному, в том числе байты идущих следом кадров.
+def decode_handshake(data) -> Tuple[dict, int]:
+    try:
+        response, size = json.JSONDecoder().raw_decode(str(data, 'latin-1'))
+    except ValueError:
         raise IncorrectDataRecivedError
+    if isinstance(response, dict):
+        return response, size
+    raise IncorrectDataRecivedError
+
+
+def recv_message(client) -> Tuple[dict, int]:
+    if isinstance(client, Channel):
+        return client.read_message()
+    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
+    if isinstance(encoded_response, bytes):
+        return decode_legacy(encoded_response)
+    raise IncorrectDataRecivedError
+
+
+def get_message(client):
+    return recv_message(client)[0]
 
 
-def send_message(sock, message):
+def send_message(sock, message) -> int:
     if not isinstance(message, dict):
         raise NonDictInputError
+    if isinstance(sock, Channel):
+        return sock.write_message(message)
     js_message = json.dumps(message)
     encoded_message = js_message.encode(ENCODING)
     sock.send(encoded_message)
+    return len(encoded_message)
@@ -23,7 +23,8 @@ class ServerMeta(type):
         if 'connect' in methods:
             raise TypeError('Использование метода connect недопустимо в серверном классе')
 
-        if not ('SOCK_STREAM' in attrs and 'AF_INET' in attrs):
+        # Сервер слушает TCP и, при необходимости, Unix-сокет
+        if not ('SOCK_STREAM' in attrs and ('AF_INET' in attrs or 'AF_UNIX' in attrs)):
             raise TypeError('Некорректная инициализация сокета.')
 
         super().__init__(clsname, bases, clsdict)
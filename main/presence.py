@@ -0,0 +1,98 @@
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from variables import PRESENCE_COALESCE_WINDOW
+
+
+class ContactPresence:
+    """Контакты подключённых к серверу пользователей и уведомления им о входе и выходе контактов.
+
+    Контакты пользователя читаются из базы один раз при входе и дальше меняются вместе
+    с ADD_CONTACT / REMOVE_CONTACT, а обратный индекс watchers говорит, кого уведомить
+    о пользователе. Изменения копятся window секунд и уходят каждому получателю одним
+    сообщением, поэтому массовое переподключение даёт по одному кадру на получателя.
+    Вход и выход одного контакта внутри окна гасят друг друга.
+    """
+
+    def __init__(self, window: float = PRESENCE_COALESCE_WINDOW) -> None:
+        self.window = window
+        self.contacts: Dict[str, Set[str]] = {}
+        self.watchers: Dict[str, Set[str]] = {}
+        # Получатель -> {контакт: в сети ли}, ещё не отправленное
+        self.pending: Dict[str, Dict[str, bool]] = {}
+        self.due: Optional[float] = None
+
+    # Только что вошедший пользователь считает все контакты не в сети, поэтому в первое
+    # уведомление попадают те, кто в сети сейчас
+    def load(self, user: str, contacts: Iterable[str], online: Callable[[str], bool], now: float) -> None:
+        self.unload(user)
+        self.contacts[user] = set(contacts)
+        for contact in self.contacts[user]:
+            self.watchers.setdefault(contact, set()).add(user)
+            if online(contact):
+                self._queue(user, contact, True, now)
+
+    def unload(self, user: str) -> None:
+        for contact in self.contacts.pop(user, ()):
+            watchers = self.watchers[contact]
+            watchers.discard(user)
+            if not watchers:
+                del self.watchers[contact]
+        self.pending.pop(user, None)
+
+    def get(self, user: str) -> Optional[List[str]]:
+        contacts = self.contacts.get(user)
+        return None if contacts is None else sorted(contacts)
+
+    def add(self, user: str, contact: str, online: bool, now: float) -> None:
+        contacts = self.contacts.get(user)
+        if contacts is None or contact in contacts:
+            return
+        contacts.add(contact)
+        self.watchers.setdefault(contact, set()).add(user)
+        if online:
+            self._queue(user, contact, True, now)
+
+    def remove(self, user: str, contact: str) -> None:
+        contacts = self.contacts.get(user)
+        if contacts is None or contact not in contacts:
+            return
+        contacts.discard(contact)
+        watchers = self.watchers[contact]
+        watchers.discard(user)
+        if not watchers:
+            del self.watchers[contact]
+        pending = self.pending.get(user)
+        if pending is not None:
+            pending.pop(contact, None)
+
+    def changed(self, name: str, online: bool, now: float) -> int:
+        watchers = self.watchers.get(name, ())
+        for user in watchers:
+            if user != name:
+                self._queue(user, name, online, now)
+        return len(watchers)
+
+    def _queue(self, user: str, contact: str, online: bool, now: float) -> None:
+        pending = self.pending.setdefault(user, {})
+        if pending.get(contact, online) != online:
+            # Обратное изменение в том же окне: получатель уже знает это состояние
+            del pending[contact]
+            if not pending:
+                del self.pending[user]
+        else:
+            pending[contact] = online
+        if self.due is None:
+            self.due = now + self.window
+
+    # Накопленное к концу окна: [(получатель, вошедшие, вышедшие), ...]
+    def flush(self, now: float) -> List[Tuple[str, List[str], List[str]]]:
+        if self.due is None or now < self.due:
+            return []
+        updates = [
+            (user, [name for name, online in pending.items() if online],
+             [name for name, online in pending.items() if not online])
+            for user, pending in self.pending.items()
+        ]
+        self.pending = {}
+        self.due = None
+        return updates
@@ -0,0 +1,106 @@
+from typing import Callable, Dict, List, Optional, Union
+
+from pydantic import BaseModel, StrictBytes, StrictFloat, StrictInt, StrictStr, ValidationError, create_model
+
+from variables import *
+
+# Проверка запроса: None, если запрос верный, иначе текст ошибки для ответа 400
+Validator = Callable[[dict], Optional[str]]
+
+VALIDATION_ENGINES = ('fast', 'pydantic')
+
+NUMBER = (int, float)
+# Адресат: имя, список имён или BROADCAST
+DESTINATION_TYPES = (str, list)
+
+# Обязательные поля запросов и их типы; вложенный словарь - поле-словарь со своими полями.
+# Необязательные поля (REQUEST_ID, TRACE, RESUME_TOKEN, OFFSET у FILE_DOWNLOAD) проверяют обработчики.
+SCHEMAS: Dict[str, dict] = {
+    PRESENCE: {TIME: NUMBER, USER: {ACCOUNT_NAME: str}},
+    MESSAGE: {DESTINATION: DESTINATION_TYPES, TIME: NUMBER, SENDER: str, MESSAGE_TEXT: str},
+    BATCH: {LIST_INFO: list},
+    FILE_CHUNK: {FILE_ID: str, OFFSET: int, FILE_DATA: bytes},
+    FILE_UPLOAD: {SENDER: str, DESTINATION: DESTINATION_TYPES, FILE_NAME: str, FILE_SIZE: int},
+    FILE_DOWNLOAD: {FILE_ID: str, USER: str},
+    EXIT: {ACCOUNT_NAME: str},
+    PONG: {},
+    GET_CONTACTS: {USER: str},
+    ADD_CONTACT: {ACCOUNT_NAME: str, USER: str},
+    REMOVE_CONTACT: {ACCOUNT_NAME: str, USER: str},
+    USERS_REQUEST: {ACCOUNT_NAME: str},
+}
+
+# Поле с именем, под которым должен был войти клиент, приславший запрос
+OWNERS: Dict[str, str] = {
+    MESSAGE: SENDER,
+    FILE_UPLOAD: SENDER,
+    FILE_DOWNLOAD: USER,
+    EXIT: ACCOUNT_NAME,
+    GET_CONTACTS: USER,
+    ADD_CONTACT: USER,
+    REMOVE_CONTACT: USER,
+    USERS_REQUEST: ACCOUNT_NAME,
+}
+
+MISSING = object()
+
+
+def compile_validator(schema: dict) -> Validator:
+    """Проверка по схеме, собранная один раз: обход кортежа полей с isinstance, без исключений.
+
+    Возвращает ошибку о первом отсутствующем поле или поле не того типа.
+    """
+    fields = tuple((field, dict, compile_validator(kind)) if isinstance(kind, dict) else (field, kind, None)
+                   for field, kind in schema.items())
+
+    def validate(message: dict) -> Optional[str]:
+        for field, types, nested in fields:
+            value = message.get(field, MISSING)
+            if value is MISSING:
+                return f'Missing field {field}'
+            if not isinstance(value, types):
+                return f'Bad field {field}'
+            if nested is not None:
+                error = nested(value)
+                if error is not None:
+                    return error
+        return None
+    return validate
+
+
+PYDANTIC_TYPES = {
+    str: StrictStr,
+    int: StrictInt,
+    bytes: StrictBytes,
+    list: list,
+    NUMBER: Union[StrictInt, StrictFloat],
+    DESTINATION_TYPES: Union[StrictStr, List],
+}
+
+
+def schema_model(name: str, schema: dict) -> BaseModel:
+    fields = {field: (schema_model(f'{name}_{field}', kind) if isinstance(kind, dict) else PYDANTIC_TYPES[kind], ...)
+              for field, kind in schema.items()}
+    return create_model(name, **fields)
+
+
+def compile_model_validator(name: str, schema: dict) -> Validator:
+    """Та же проверка моделью pydantic, построенной по схеме: медленнее, нужна для сверки схем."""
+    model = schema_model(name, schema)
+
+    def validate(message: dict) -> Optional[str]:
+        try:
+            model.parse_obj(message)
+        except ValidationError as error:
+            problem = error.errors()[0]
+            field = problem['loc'][-1]
+            return f'Missing field {field}' if problem['type'] == 'value_error.missing' else f'Bad field {field}'
+        return None
+    return validate
+
+
+# Проверки для всех действий из SCHEMAS
+def compile_validators(engine: str = 'fast') -> Dict[str, Validator]:
+    if engine == 'pydantic':
+        return {action: compile_model_validator(action, schema) for action, schema in SCHEMAS.items()}
+    return {action: compile_validator(schema) for action, schema in SCHEMAS.items()}
@@ -1,185 +1,1122 @@
 import logging
 import os
+import secrets
 import select
+import signal
 import socket
+import stat
 import sys
 import threading
-from typing import Optional
+import time
+from collections import OrderedDict, deque
+from typing import List, Optional, Tuple, Union
 
 import click
 import configparser
 
+import logs.config_server_log
 from db.server_db import ServerDB
 from meta.metaclasses import ServerMeta
 from utils.port import Port
 from variables import *
-from messages import get_message, send_message
+from errors import IncorrectDataRecivedError
+from messages import send_message, Channel
+from timers import TimerWheel
+from limits import RateLimiter
+from workers import start_workers
+from cluster import ClusterRouter, parse_peers
+from files import FileStore, Upload, UPLOAD, DOWNLOAD
+from presence import ContactPresence
+from snapshot import BACKLOG, load_snapshot, save_snapshot
+from journal import MessageJournal
+from protocol import OWNERS, VALIDATION_ENGINES, compile_validators
+from codec import CODECS, COMPRESSIONS, CompressionStats, negotiate
+from stats.metrics import Registry, InstrumentedProxy
+from stats.exporter import StatsExporter
+from stats.rolling import LiveStats
+from stats.profiler import Profiler, PROFILE_MODES
+from stats.tracing import add_hop, record_trace, HOP_SERVER_RECV, HOP_SERVER_DB, HOP_SERVER_SEND
 from PyQt5.QtWidgets import QApplication, QMessageBox
 from PyQt5.QtCore import QTimer
-from ui.server_gui import MainWindow, gui_create_model, HistoryWindow, create_stat_model, ConfigWindow
+from ui.server_gui import (MainWindow, gui_create_model, HistoryWindow, create_stat_model, ConfigWindow, status_text,
+                           LiveStatsWindow, create_top_model, live_stats_text)
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
 
 
 logger = logging.getLogger('server')
+traffic_logger = logging.getLogger('server.traffic')
 new_connection = False
 conflag_lock = threading.Lock()
 
+ACTIONS = (PRESENCE, MESSAGE, EXIT, GET_CONTACTS, ADD_CONTACT, REMOVE_CONTACT, USERS_REQUEST, PONG, FILE_UPLOAD,
+           FILE_CHUNK, FILE_DOWNLOAD, BATCH)
+
+# Адрес для приёма клиентов: (host, port) для TCP или путь Unix-сокета
+Endpoint = Union[Tuple[str, int], str]
+
+
+# "host:port, unix:/path" из server.ini
+def parse_endpoints(value: str) -> List[Endpoint]:
+    endpoints = []
+    for item in value.split(','):
+        item = item.strip()
+        if item.startswith('unix:'):
+            endpoints.append(item[len('unix:'):])
+        elif item:
+            host, _, port = item.rpartition(':')
+            endpoints.append((host, int(port)))
+    return endpoints
+
+
+# Unix-сокет не сообщает адрес клиента, в историю входов такой клиент попадает как 'unix'
+def peer_address(peer) -> Tuple[str, int]:
+    if isinstance(peer, tuple):
+        return peer[0], peer[1]
+    return 'unix', 0
+
+
+# Сессия оборвавшегося клиента, которую можно продолжить по токену до expires
+class DetachedSession:
+    __slots__ = ('expires', 'backlog')
+
+    def __init__(self, expires: float) -> None:
+        self.expires = expires
+        self.backlog = deque(maxlen=RESUME_BACKLOG)
+
 
 class Server(threading.Thread, metaclass=ServerMeta):
     port = Port()
 
-    def __init__(self, addr: str, port: int, database) -> None:
+    def __init__(self, addr: str, port: int, database, metrics: Optional[Registry] = None,
+                 profiler: Optional[Profiler] = None, heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 heartbeat_timeout: float = HEARTBEAT_TIMEOUT, max_clients: int = MAX_CLIENTS,
+                 listen_backlog: int = MAX_CONNECTIONS, rate_limits: Optional[dict] = None, router=None,
+                 reuse_port: bool = False, endpoints: Optional[List[Endpoint]] = None,
+                 files: Optional[FileStore] = None, resume_grace: float = RESUME_GRACE,
+                 snapshot: Optional[str] = None, journal: Optional[MessageJournal] = None,
+                 validation: str = 'fast') -> None:
+        self.created = time.monotonic()
         self.addr = addr
         self.port = port
-        self.database = database
+        # Адреса, которые слушаются вместе с основным addr:port
+        self.endpoints = endpoints or []
+        self.listeners = []
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_clients = max_clients
+        self.listen_backlog = listen_backlog
+        self.rate_limits = RATE_LIMITS if rate_limits is None else rate_limits
+        # Связь с другими процессами (workers.WorkerRouter) или узлами кластера (cluster.ClusterRouter),
+        # None в обычном режиме
+        self.router = router
+        self.reuse_port = reuse_port
+        self.metrics = metrics or Registry()
+        self.profiler = profiler or Profiler(PROFILE_DIR)
+        self.database = InstrumentedProxy(database, self.metrics, 'server_db_seconds', 'Time spent in ServerDB calls')
 
         self.clients = []
         self.messages = []
         self.names = dict()
+        self.compression_stats = CompressionStats()
+        # Проверка живости: у каждого соединения один таймер в колесе, время отправки PING - в pinged
+        self.timers = TimerWheel(now=time.monotonic())
+        self.pinged = dict()
+        # Имена отключившихся за проход цикла, выходят из базы одним запросом в flush_logouts
+        self.logouts = []
+        self.limiters = dict()
+        self.pass_seconds = 0.0
+        # Передачи файлов: не больше одной загрузки и одной отдачи на соединение
+        self.files = files or FileStore()
+        self.uploads = dict()
+        self.downloads = dict()
+        # Контакты подключённых пользователей и ещё не отправленные им изменения присутствия
+        self.presence = ContactPresence()
+        # Токены продолжения сессий и сессии, ждущие переподключения, в порядке истечения.
+        # С другими процессами и узлами сессии не продолжаются: клиент может вернуться не туда.
+        self.resume_grace = resume_grace if router is None else 0
+        self.tokens = dict()
+        self.detached = OrderedDict()
+        # Нагрузка за последний час для окна статистики и /live, без обращений к базе
+        self.live = LiveStats()
+        # Журнал доставленных сообщений, None - без журнала
+        self.journal = journal
+        # Файл снимка сессий для быстрого перезапуска, None - без снимка
+        self.snapshot = snapshot
+        self.stopping = threading.Event()
+        self.ready = threading.Event()
+        self.ready_seconds = 0.0
+        # Таблица разбора запросов: действие -> (обработчик, проверка полей, поле с именем владельца).
+        # Проверки собираются один раз здесь, а не на каждом запросе.
+        self.validators = compile_validators(validation)
+        handlers = {
+            PRESENCE: self.handle_presence,
+            MESSAGE: self.handle_message,
+            BATCH: self.process_batch,
+            FILE_CHUNK: self.receive_chunk,
+            FILE_UPLOAD: self.start_upload,
+            FILE_DOWNLOAD: self.start_download,
+            EXIT: self.handle_exit,
+            PONG: self.handle_pong,
+            GET_CONTACTS: self.handle_get_contacts,
+            ADD_CONTACT: self.handle_add_contact,
+            REMOVE_CONTACT: self.handle_remove_contact,
+            USERS_REQUEST: self.handle_users_request,
+        }
+        self.dispatch = {action: (handler, self.validators[action], OWNERS.get(action))
+                         for action, handler in handlers.items()}
 
+        self.init_metrics()
         super().__init__()
 
-    def init_socket(self):
-        transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        transport.bind((self.addr, self.port))
-        transport.settimeout(0.5)
+    def init_metrics(self) -> None:
+        metrics = self.metrics
+        self.connections_total = metrics.counter('server_connections_total', 'Accepted client connections')
+        self.disconnects_total = metrics.counter('server_disconnects_total', 'Closed or lost client connections')
+        metrics.gauge('server_active_connections', 'Connected sockets', func=lambda: len(self.clients))
+        metrics.gauge('server_registered_users', 'Clients that sent presence', func=lambda: len(self.names))
+        metrics.gauge('server_profiler_active', 'Profiling window is open', func=lambda: int(self.profiler.active))
+        self.bytes_in = metrics.counter('server_bytes_in_total', 'Bytes received from clients')
+        self.bytes_out = metrics.counter('server_bytes_out_total', 'Bytes sent to clients')
+        self.messages_routed = metrics.counter('server_messages_routed_total', 'Messages delivered to recipients')
+        self.messages_unroutable = metrics.counter(
+            'server_messages_undeliverable_total', 'Messages to unknown or disconnected recipients')
+        self.messages_forwarded = metrics.counter(
+            'server_messages_forwarded_total', 'Messages passed to the process that serves the recipient')
+        self.group_messages_total = metrics.counter(
+            'server_group_messages_total', 'Messages to a list of recipients or broadcast')
+        self.batched_total = metrics.counter('server_batched_messages_total', 'Messages accepted in batches')
+        self.presence_updates = metrics.counter('server_presence_updates_total',
+                                                'Coalesced contact status updates sent to clients')
+        self.presence_changes = metrics.counter('server_presence_changes_total',
+                                                'Logins and logouts queued for the contacts of the user')
+        metrics.gauge('server_presence_users', 'Users with cached contacts', func=lambda: len(self.presence.contacts))
+        if self.journal is not None:
+            metrics.gauge('server_journal_records', 'Records appended to the message journal',
+                          func=lambda: self.journal.next_seq)
+            self.journal_commit_seconds = metrics.histogram('server_journal_commit_seconds',
+                                                            'Time to write one group of journal records')
+        for window, seconds in LiveStats.WINDOWS:
+            metrics.gauge('server_messages_per_minute', 'Messages accepted per minute over the window',
+                          func=lambda seconds=seconds: self.live.messages.per_minute(seconds), window=window)
+            metrics.gauge('server_logins_per_minute', 'Logins per minute over the window',
+                          func=lambda seconds=seconds: self.live.logins.per_minute(seconds), window=window)
+        metrics.gauge('server_ready_seconds', 'Time from start to accepting clients', func=lambda: self.ready_seconds)
+        self.resumed_total = metrics.counter('server_resumed_sessions_total', 'Sessions continued with a token')
+        metrics.gauge('server_detached_sessions', 'Sessions waiting for their client to reconnect',
+                      func=lambda: len(self.detached))
+        self.pings_total = metrics.counter('server_pings_total', 'Heartbeat pings sent to idle connections')
+        self.reaped_total = metrics.counter('server_reaped_total', 'Connections closed after missing a heartbeat')
+        metrics.gauge('server_heartbeat_timers', 'Connections with a pending heartbeat timer',
+                      func=lambda: len(self.timers))
+        self.rejected_total = {
+            reason: metrics.counter('server_rejected_total', 'Connections and requests refused by admission control',
+                                    reason=reason)
+            for reason in ('connections', 'rate', 'overload')
+        }
+        compression = self.compression_stats
+        metrics.gauge('server_compressed_frames_total', 'Frames sent compressed', func=lambda: compression.frames)
+        metrics.gauge('server_compression_raw_bytes_total', 'Bytes before compression',
+                      func=lambda: compression.raw_bytes)
+        metrics.gauge('server_compression_compressed_bytes_total', 'Bytes after compression',
+                      func=lambda: compression.compressed_bytes)
+        metrics.gauge('server_compression_ratio', 'Raw to compressed bytes ratio', func=lambda: compression.ratio)
+        metrics.gauge('server_compression_seconds_total', 'CPU time spent compressing',
+                      func=lambda: compression.compress_seconds)
+        metrics.gauge('server_decompression_seconds_total', 'CPU time spent decompressing',
+                      func=lambda: compression.decompress_seconds)
+        self.file_bytes = {
+            direction: metrics.counter('server_file_bytes_total', 'File data received and sent', direction=direction)
+            for direction in (UPLOAD, DOWNLOAD)
+        }
+        self.file_seconds = {
+            direction: metrics.histogram('server_file_transfer_seconds', 'Duration of finished file transfers',
+                                         direction=direction)
+            for direction in (UPLOAD, DOWNLOAD)
+        }
+        metrics.gauge('server_file_transfers', 'File uploads and downloads in progress',
+                      func=lambda: len(self.uploads) + len(self.downloads))
+        # Гистограммы создаются заранее, чтобы в цикле сервера был только поиск по словарю
+        self.requests_total = {
+            action: metrics.counter('server_requests_total', 'Requests received by action', action=action)
+            for action in ACTIONS + ('unknown',)
+        }
+        self.action_seconds = {
+            action: metrics.histogram('server_action_seconds', 'Time spent processing a request', action=action)
+            for action in ACTIONS + ('unknown',)
+        }
+
+    def send(self, client, message: dict) -> None:
+        self.bytes_out.inc(send_message(client, message))
 
-        self.sock = transport
-        self.sock.listen()
+    # Ответ на запрос: если клиент пометил запрос идентификатором, он возвращается в ответе,
+    # чтобы клиент мог держать несколько запросов в полёте и сопоставлять ответы
+    def respond(self, client, request: dict, response: dict) -> None:
+        if REQUEST_ID in request:
+            response = dict(response)
+            response[REQUEST_ID] = request[REQUEST_ID]
+        self.send(client, response)
+
+    def init_socket(self):
+        for endpoint in [(self.addr, self.port)] + self.endpoints:
+            if isinstance(endpoint, str):
+                transport = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                # Файл сокета, оставшийся от прошлого запуска, не даст сделать bind
+                if os.path.exists(endpoint) and stat.S_ISSOCK(os.stat(endpoint).st_mode):
+                    os.unlink(endpoint)
+            else:
+                transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                # Соединения, закрытые прошлым запуском, ещё в TIME_WAIT и не должны мешать перезапуску
+                transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if self.reuse_port:
+                    # Несколько рабочих процессов слушают один порт, ядро распределяет подключения между ними
+                    transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            transport.bind(endpoint)
+            transport.setblocking(False)
+            transport.listen(self.listen_backlog)
+            self.listeners.append(transport)
 
     def run(self):
+        warm = self.restore_snapshot()
         self.init_socket()
+        self.ready_seconds = time.monotonic() - self.created
+        self.ready.set()
+        logger.info('Server ready in %.1f ms (%s start)', self.ready_seconds * 1000, 'warm' if warm else 'cold')
 
-        while True:
+        while not self.stopping.is_set():
+            self.profiler.poll()
+            # Слушающие сокеты ждут в одном select с клиентами: новое подключение или сообщение
+            # будит цикл сразу, а без событий он спит не дольше SERVER_POLL_INTERVAL
+            links = self.router.channels() if self.router is not None else []
+            read = []
+            timeout = SERVER_POLL_INTERVAL
+            if self.presence.due is not None:
+                # Накопленные изменения присутствия уходят к концу окна, а не к концу ожидания select
+                timeout = max(0.0, min(timeout, self.presence.due - time.monotonic()))
             try:
-                client, client_address = self.sock.accept()
+                # Пока идёт отдача файла, цикл просыпается и тогда, когда её получатель готов принять следующий кусок
+                read, _, _ = select.select(self.listeners + self.clients + links, list(self.downloads), [], timeout)
             except OSError:
                 pass
-            else:
-                logger.info(f'Receive connection from {client_address}')
-                self.clients.append(client)
+            pass_start = time.monotonic()
+
+            for client_with_message in read:
+                if client_with_message in self.listeners:
+                    self.accept_clients(client_with_message)
+                elif client_with_message in links:
+                    try:
+                        self.router.read(client_with_message)
+                    except (OSError, ConnectionError, IncorrectDataRecivedError):
+                        # Без главного процесса воркер не работает, а связь с соседом по кластеру закрывается одна
+                        if not self.router.channel_lost(client_with_message):
+                            logger.critical('Lost connection with the main server process')
+                            return
+                else:
+                    self.read_client(client_with_message)
 
-            read = []
             write = []
+            if self.clients and (self.messages or self.downloads or self.router is not None and self.router.received):
+                try:
+                    _, write, _ = select.select([], self.clients, [], 0)
+                except OSError:
+                    pass
+            if self.messages:
+                self.record_messages(self.messages)
+            self.route_messages(self.messages, write)
+            if self.router is not None:
+                self.route_messages(self.router.received, write, local=True)
+            if self.downloads:
+                self.send_chunks(write)
+
+            now = time.monotonic()
+            if self.router is not None:
+                self.router.tick(now)
+                for name, online in self.router.changes:
+                    self.presence_changes.inc(self.presence.changed(name, online, now))
+                self.router.changes.clear()
+            self.check_heartbeats(now)
+            self.expire_sessions(now)
+            self.flush_logouts()
+            self.flush_presence(now)
+            if self.journal is not None:
+                # Всё принятое за проход уходит в журнал одной записью
+                commit_start = time.monotonic()
+                if self.journal.commit(commit_start):
+                    self.journal_commit_seconds.record(time.monotonic() - commit_start)
+            self.pass_seconds = time.monotonic() - pass_start
+        self.shutdown()
+
+    # Остановка с записью снимка. Цикл заметит её не позже чем через SERVER_POLL_INTERVAL.
+    def stop(self) -> None:
+        self.stopping.set()
+
+    # Сессии из снимка становятся сессиями, ждущими переподключения: клиент с токеном продолжит
+    # свою без записи о входе и чтения контактов. Подключёнными в базе остаются только они.
+    def restore_snapshot(self) -> bool:
+        if not self.snapshot:
+            return False
+        sessions = load_snapshot(self.snapshot, self.database.state_stamp()) if self.resume_grace else None
+        if sessions is None:
+            self.database.clear_active_users()
+            return False
+        now = time.monotonic()
+        for name, session in sessions.items():
+            self.tokens[name] = session[RESUME_TOKEN]
+            self.detached[name] = DetachedSession(now + self.resume_grace)
+            self.detached[name].backlog.extend(session[BACKLOG])
+        for name, session in sessions.items():
+            self.presence.load(name, session[LIST_INFO], self.online, now)
+        self.database.clear_active_users(keep=list(sessions))
+        logger.info('Restored %s sessions from %s', len(sessions), self.snapshot)
+        return True
+
+    def shutdown(self) -> None:
+        self.flush_logouts()
+        if self.snapshot and self.resume_grace:
+            sessions = {}
+            for name in list(self.names) + list(self.detached):
+                if name in self.tokens:
+                    sessions[name] = {
+                        RESUME_TOKEN: self.tokens[name],
+                        LIST_INFO: sorted(self.presence.contacts.get(name, ())),
+                        BACKLOG: list(self.detached[name].backlog) if name in self.detached else [],
+                    }
+            size = save_snapshot(self.snapshot, self.database.state_stamp(), sessions)
+            logger.info('Saved %s sessions to %s (%s bytes)', len(sessions), self.snapshot, size)
+        if self.journal is not None:
+            self.journal.close()
+        for channel in self.clients + self.listeners:
+            channel.close()
+
+    def accept_clients(self, listener: socket.socket) -> None:
+        # За одно срабатывание select принимаются все ожидающие подключения
+        while True:
             try:
-                if self.clients:
-                    read, write, err_lst = select.select(self.clients, self.clients, [], 0)
+                client, client_address = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                logger.error('Accept failed: %s', error)
+                return
+            client.setblocking(True)
+            self.accept_client(client, client_address)
+
+    def accept_client(self, client: socket.socket, client_address) -> None:
+        if len(self.clients) >= self.max_clients:
+            # Отказ уходит в старом формате: клиент прочитает его как ответ на свой PRESENCE
+            traffic_logger.info('Reject connection from %s: server is full', client_address)
+            self.rejected_total['connections'].inc()
+            response = dict(RESPONSE_429)
+            response[ERROR] = 'Server is full'
+            try:
+                send_message(client, response)
             except OSError:
                 pass
+            client.close()
+            return
+        traffic_logger.info('Receive connection from %s', client_address)
+        channel = Channel(client)
+        self.clients.append(channel)
+        self.timers.schedule(channel, channel.last_seen + self.heartbeat_interval)
+        self.limiters[channel] = RateLimiter(self.rate_limits, DEFAULT_RATE_LIMIT)
+        self.connections_total.inc()
 
-            if read:
-                for client_with_message in read:
-                    try:
-                        self.process_client_message(get_message(client_with_message), client_with_message)
-                    except Exception:
-                        logger.info(f'Client {client_with_message.getpeername()} stopped connection')
-                        for name in self.names:
-                            if self.names[name] == client_with_message:
-                                self.database.user_logout(name)
-                                del self.names[name]
-                                break
-                        self.clients.remove(client_with_message)
-
-            for message in self.messages:
+    # Перегрузка: в очереди на отправку слишком много сообщений или прошлый проход цикла был слишком долгим
+    def overloaded(self) -> bool:
+        return len(self.messages) >= MAX_PENDING_MESSAGES or self.pass_seconds >= OVERLOAD_PASS_SECONDS
+
+    # Допуск запроса к обработке. Вход, выход и ответы на PING не отбрасываются при перегрузке,
+    # иначе сервер перестал бы освобождать ресурсы именно тогда, когда они нужнее всего.
+    def admit(self, client: Channel, message: dict, action: str) -> bool:
+        if action not in (PRESENCE, EXIT, PONG) and self.overloaded():
+            reason, error = 'overload', 'Server is busy'
+        elif client in self.limiters and not self.limiters[client].allow(action, time.monotonic()):
+            reason, error = 'rate', 'Too many requests'
+        else:
+            return True
+        self.rejected_total[reason].inc()
+        response = dict(RESPONSE_429)
+        response[ERROR] = error
+        self.respond(client, message, response)
+        return False
+
+    # Принятые за проход сообщения идут в журнал и в текущую статистику
+    def record_messages(self, messages: List[dict]) -> None:
+        now = time.monotonic()
+        for message in messages:
+            if self.journal is not None:
+                self.journal.append(message)
+            if message[ACTION] == MESSAGE:
+                destination = message[DESTINATION]
+                if isinstance(destination, list):
+                    self.live.message(message[SENDER], destination, now)
+                else:
+                    self.live.message(message[SENDER], () if destination == BROADCAST else (destination,), now)
+
+    def route_messages(self, messages: List[dict], write: list, local: bool = False) -> None:
+        for message in messages:
+            try:
+                self.process_message(message, write, local)
+            except Exception:
+                self.messages_unroutable.inc()
+                destination = message.get(DESTINATION)
+                # Отвалившихся получателей группового сообщения fan_out отключает сам, по одному
+                if isinstance(destination, str) and destination != BROADCAST:
+                    self.drop_user(destination)
+                else:
+                    logger.exception('Failed to deliver a group message from %s', message.get(SENDER))
+        messages.clear()
+
+    def drop_user(self, name: str) -> None:
+        traffic_logger.info('Lost connection with %s client', name)
+        if name in self.names:
+            self.remove_client(self.names[name])
+
+    def remove_client(self, client: Channel) -> None:
+        self.disconnects_total.inc()
+        if client in self.clients:
+            self.clients.remove(client)
+        self.timers.cancel(client)
+        self.pinged.pop(client, None)
+        self.limiters.pop(client, None)
+        self.end_transfers(client)
+        for name in self.names:
+            if self.names[name] == client:
+                del self.names[name]
+                if name in self.tokens:
+                    # Пользователь остаётся в сети для базы и контактов, пока сессия ждёт его возвращения
+                    self.detached[name] = DetachedSession(time.monotonic() + self.resume_grace)
+                else:
+                    self.end_session(name)
+                break
+        try:
+            client.close()
+        except OSError:
+            pass
+
+    def end_session(self, name: str) -> None:
+        self.detached.pop(name, None)
+        self.tokens.pop(name, None)
+        self.logouts.append(name)
+        self.live.logout()
+        self.presence.unload(name)
+        self.presence_changes.inc(self.presence.changed(name, False, time.monotonic()))
+
+    def expire_sessions(self, now: float) -> None:
+        while self.detached:
+            name, session = next(iter(self.detached.items()))
+            if session.expires > now:
+                break
+            traffic_logger.info('Session of %s expired', name)
+            self.end_session(name)
+
+    def flush_logouts(self) -> None:
+        global new_connection
+        if self.logouts:
+            self.database.users_logout(self.logouts)
+            if self.router is not None:
+                self.router.release(self.logouts)
+            self.logouts.clear()
+            with conflag_lock:
+                new_connection = True
+
+    def online(self, name: str) -> bool:
+        return name in self.names or name in self.detached or self.router is not None and name in self.router.routes
+
+    # Изменения присутствия за окно уходят каждому получателю одним сообщением. Клиентам
+    # без кодека они не отправляются: в старом формате ответы и уведомления склеились бы в одном recv.
+    def flush_presence(self, now: float) -> None:
+        for name, online, offline in self.presence.flush(now):
+            client = self.names.get(name)
+            if client is None or client.codec is None:
+                continue
+            try:
+                self.send(client, {ACTION: CONTACT_STATUS, TIME: time.time(), ONLINE: online, OFFLINE: offline})
+            except OSError:
+                self.remove_client(client)
+                continue
+            self.presence_updates.inc()
+
+    # Таймер соединения срабатывает через heartbeat_interval после последних данных от него.
+    # Данные учитываются лениво: если они приходили, таймер просто переставляется на новый срок.
+    # Молчащему соединению отправляется PING, и если до следующего срабатывания от него ничего
+    # не пришло, соединение закрывается. Старому клиенту без кадров PING не отправляется: PING, пришедший
+    # вместе с ответом, он не отделит от него. Такое соединение закрывается, если молчит дольше
+    # heartbeat_interval и heartbeat_timeout вместе.
+    def check_heartbeats(self, now: float) -> None:
+        for client in self.timers.advance(now):
+            pinged_at = self.pinged.pop(client, None)
+            idle_deadline = client.last_seen + self.heartbeat_interval + self.heartbeat_timeout
+            if pinged_at is not None and client.last_seen < pinged_at or client.codec is None and idle_deadline <= now:
+                traffic_logger.info('Client %s missed heartbeat', client.peer)
+                self.reaped_total.inc()
+                self.remove_client(client)
+            elif client.last_seen + self.heartbeat_interval > now:
+                self.timers.schedule(client, client.last_seen + self.heartbeat_interval)
+            elif client.codec is None:
+                self.timers.schedule(client, idle_deadline)
+            else:
                 try:
-                    self.process_message(message, write)
-                except Exception:
-                    logger.info(f'Lost connection with {message[DESTINATION]} client')
-                    self.clients.remove(self.names[message[DESTINATION]])
-                    self.database.user_logout(message[DESTINATION])
-                    del self.names[message[DESTINATION]]
-            self.messages.clear()
-
-    def process_message(self, message: dict, listen_socks: list) -> None:
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]] in listen_socks:
-            send_message(self.names[message[DESTINATION]], message)
-            logger.info(
-                f'Send message from {message[DESTINATION]} to {message[SENDER]}.')
+                    self.send(client, {ACTION: PING, TIME: time.time()})
+                except OSError:
+                    self.remove_client(client)
+                    continue
+                self.pings_total.inc()
+                self.pinged[client] = now
+                self.timers.schedule(client, now + self.heartbeat_timeout)
+
+    def read_client(self, client: Channel) -> None:
+        try:
+            for message, size in client.read_messages():
+                self.bytes_in.inc(size)
+                action = message.get(ACTION)
+                if not isinstance(action, str) or action not in self.action_seconds:
+                    action = 'unknown'
+                self.requests_total[action].inc()
+                if not self.admit(client, message, action):
+                    continue
+                start = time.perf_counter()
+                self.process_client_message(message, client)
+                self.action_seconds[action].record(time.perf_counter() - start)
+        except Exception:
+            traffic_logger.info('Client %s stopped connection', client.peer)
+            self.remove_client(client)
+
+    # Получатели группового сообщения без повторов или None, если адресат задан неверно
+    def recipients(self, message: dict) -> Optional[List[str]]:
+        destination = message[DESTINATION]
+        if destination == BROADCAST:
+            names = list(self.names) if self.router is None else list({**self.names, **self.router.routes})
+            return [name for name in names if name != message[SENDER]]
+        if isinstance(destination, list) and 0 < len(destination) <= MAX_RECIPIENTS \
+                and all(isinstance(name, str) for name in destination):
+            return list(dict.fromkeys(destination))
+        return None
+
+    # Рассылка группового сообщения: нагрузка кодируется один раз на каждый кодек получателей,
+    # и те же байты уходят во все соединения. Отвалившиеся получатели отключаются по одному,
+    # не прерывая доставку остальным.
+    def fan_out(self, message: dict, listen_socks: list, local: bool = False) -> None:
+        if TRACE in message:
+            add_hop(message, HOP_SERVER_SEND)
+            record_trace(message, self.metrics, 'server')
+        writable = set(listen_socks)
+        payloads = {}
+        lost = []
+        remote = []
+        delivered = 0
+        for name in self.recipients(message) or ():
+            client = self.names.get(name)
+            if client is None:
+                if name in self.detached:
+                    self.detached[name].backlog.append(message)
+                else:
+                    remote.append(name)
+                continue
+            if client not in writable:
+                lost.append((name, client))
+                continue
+            codec = client.codec.name if client.codec is not None else None
+            payload = payloads.get(codec)
+            if payload is None:
+                payload = payloads[codec] = client.encode(message)
+            try:
+                self.bytes_out.inc(client.write_payload(payload))
+            except OSError:
+                lost.append((name, client))
+                continue
+            delivered += 1
+        self.messages_routed.inc(delivered)
+        self.group_messages_total.inc()
+        # Получателей из других процессов обслуживают их процессы; пришедшее оттуда не пересылается дальше
+        if message[DESTINATION] == BROADCAST:
+            # Широковещательное уходит всем соседям целиком, их клиентов обслужат они сами
+            if self.router is not None and not local:
+                self.router.broadcast(message)
+                self.messages_forwarded.inc(len(remote))
+            remote = []
+        elif self.router is not None and not local and remote:
+            unknown = self.router.forward(message, remote)
+            self.messages_forwarded.inc(len(remote) - len(unknown))
+            remote = unknown
+        self.messages_unroutable.inc(len(remote))
+        # Отключается именно соединение, запись в которое не удалась
+        for name, client in lost:
+            self.messages_unroutable.inc()
+            traffic_logger.info('Lost connection with %s client', name)
+            self.remove_client(client)
+        traffic_logger.info('Send message from %s to %s recipients.', message[SENDER], delivered)
+
+    def process_message(self, message: dict, listen_socks: list, local: bool = False) -> None:
+        if not isinstance(message[DESTINATION], str) or message[DESTINATION] == BROADCAST:
+            self.fan_out(message, listen_socks, local)
+        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] in listen_socks:
+            if TRACE in message:
+                add_hop(message, HOP_SERVER_SEND)
+                record_trace(message, self.metrics, 'server')
+            self.send(self.names[message[DESTINATION]], message)
+            self.messages_routed.inc()
+            traffic_logger.info('Send message from %s to %s.', message[SENDER], message[DESTINATION])
         elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in listen_socks:
             raise ConnectionError
+        elif message[DESTINATION] in self.detached:
+            self.detached[message[DESTINATION]].backlog.append(message)
+        elif not local and self.router is not None and not self.router.forward(message, [message[DESTINATION]]):
+            self.messages_forwarded.inc()
+        else:
+            self.messages_unroutable.inc()
+            logger.error('Client %s is not registered', message[DESTINATION])
+
+    # Получатели сообщения из пачки или None, если это не MESSAGE, адресат задан неверно
+    # или отправитель - не тот пользователь, что вошёл под этим соединением
+    def batch_recipients(self, item, client: Channel) -> Optional[List[str]]:
+        if not isinstance(item, dict) or item.get(ACTION) != MESSAGE or self.validators[MESSAGE](item) is not None \
+                or self.names.get(item[SENDER]) is not client:
+            return None
+        if isinstance(item[DESTINATION], str) and item[DESTINATION] != BROADCAST:
+            return [item[DESTINATION]]
+        return self.recipients(item)
+
+    # Пачка сообщений в одном кадре. Каждое сообщение проверяется как отдельный MESSAGE и берёт жетон
+    # из своей корзины BATCH_ITEM, в которую помещается пачка MAX_BATCH_SIZE. Принятые уходят в очередь
+    # разом, а счётчики в базе обновляются одной транзакцией. В ответе статусы сообщений в порядке пачки:
+    # 200, 400 или 429.
+    def process_batch(self, message: dict, client: Channel) -> None:
+        items = message[LIST_INFO]
+        if not isinstance(items, list) or not 0 < len(items) <= MAX_BATCH_SIZE:
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Bad batch'
+            self.respond(client, message, response)
+            return
+        limiter = self.limiters.get(client)
+        now = time.monotonic()
+        statuses = []
+        accepted = []
+        for item in items:
+            recipients = self.batch_recipients(item, client)
+            if recipients is None:
+                statuses.append(400)
+                continue
+            if limiter is not None and not limiter.allow(BATCH_ITEM, now):
+                self.rejected_total['rate'].inc()
+                statuses.append(429)
+                continue
+            if TRACE in item:
+                add_hop(item, HOP_SERVER_RECV)
+            accepted.append((item, recipients))
+            statuses.append(200)
+        if accepted:
+            self.database.process_messages([(item[SENDER], recipients) for item, recipients in accepted])
+            for item, _ in accepted:
+                if TRACE in item:
+                    add_hop(item, HOP_SERVER_DB)
+                self.messages.append(item)
+            self.batched_total.inc(len(accepted))
+        self.respond(client, message, {RESPONSE: 200, LIST_INFO: statuses})
+
+    # Загрузка файла: в ответе идентификатор и смещение, с которого клиенту слать куски.
+    # С FILE_ID в запросе продолжается прерванная загрузка того же отправителя.
+    def start_upload(self, message: dict, client: Channel) -> None:
+        size = message[FILE_SIZE]
+        if isinstance(message[DESTINATION], str) and message[DESTINATION] != BROADCAST:
+            destination_valid = bool(message[DESTINATION])
+        else:
+            destination_valid = self.recipients(message) is not None
+        if client.codec is None or not destination_valid or type(size) is not int \
+                or not 0 <= size <= MAX_FILE_SIZE or not isinstance(message[FILE_NAME], str):
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Bad file upload'
+            self.respond(client, message, response)
+            return
+        if FILE_ID in message:
+            info = self.files.info(message[FILE_ID])
+            if info is None or info[SENDER] != message[SENDER] or info[FILE_SIZE] != size:
+                response = dict(RESPONSE_400)
+                response[ERROR] = 'Unknown file'
+                self.respond(client, message, response)
+                return
+            if self.files.complete(info[FILE_ID]):
+                self.respond(client, message, {RESPONSE: 200, FILE_ID: info[FILE_ID], OFFSET: size})
+                return
+        else:
+            # От пути клиента остаётся только имя файла
+            name = os.path.basename(message[FILE_NAME].replace('\\', '/')) or 'unnamed'
+            info = self.files.create(message[SENDER], message[DESTINATION], name, size)
+        previous = self.uploads.pop(client, None)
+        if previous is not None:
+            previous.close()
+        upload = self.files.upload(info)
+        self.respond(client, message, {RESPONSE: 200, FILE_ID: info[FILE_ID], OFFSET: upload.transfer.offset})
+        if upload.transfer.done:
+            self.finish_upload(client, upload)
+        else:
+            self.uploads[client] = upload
+
+    # Куски принимаются только по порядку. Неожиданный кусок отбрасывается молча, а на последний
+    # кусок, который клиент помечает request_id, приходит ответ со смещением, с которого слать заново.
+    def receive_chunk(self, message: dict, client: Channel) -> None:
+        upload = self.uploads.get(client)
+        data = message[FILE_DATA]
+        if upload is None or upload.info[FILE_ID] != message[FILE_ID] or upload.transfer.offset != message[OFFSET] \
+                or upload.transfer.offset + len(data) > upload.transfer.size:
+            if REQUEST_ID in message:
+                response = dict(RESPONSE_400)
+                response[ERROR] = 'Unexpected file chunk'
+                if upload is not None and upload.info[FILE_ID] == message[FILE_ID]:
+                    response[OFFSET] = upload.transfer.offset
+                self.respond(client, message, response)
+            return
+        upload.write(data)
+        self.file_bytes[UPLOAD].inc(len(data))
+        if upload.transfer.done:
+            del self.uploads[client]
+            self.finish_upload(client, upload, message)
+
+    # Загруженный файл доставляется получателям уведомлением FILE, как обычное сообщение
+    def finish_upload(self, client: Channel, upload: Upload, request: Optional[dict] = None) -> None:
+        self.files.finish_upload(upload)
+        info, transfer = upload.info, upload.transfer
+        self.file_seconds[UPLOAD].record(transfer.seconds)
+        logger.info('File %s from %s received: %d bytes in %.3f s, %.0f bytes/s', info[FILE_ID], info[SENDER],
+                    transfer.bytes, transfer.seconds, transfer.throughput)
+        if request is not None:
+            self.respond(client, request, {RESPONSE: 200, FILE_ID: info[FILE_ID], OFFSET: transfer.offset,
+                                           TRANSFER: transfer.stats()})
+        notice = {ACTION: FILE, **info}
+        self.messages.append(notice)
+        if isinstance(notice[DESTINATION], str) and notice[DESTINATION] != BROADCAST:
+            self.database.process_message(notice[SENDER], notice[DESTINATION])
         else:
-            logger.error(
-                f'Client {message[DESTINATION]} is not registered')
+            self.database.process_group_message(notice[SENDER], self.recipients(notice) or [])
 
+    @staticmethod
+    def may_download(info: dict, name: str) -> bool:
+        destination = info[DESTINATION]
+        return name in (info[SENDER], destination) or destination == BROADCAST \
+            or isinstance(destination, list) and name in destination
+
+    # Отдача файла начинается с OFFSET из запроса, куски уходят из send_chunks
+    def start_download(self, message: dict, client: Channel) -> None:
+        info = self.files.info(message[FILE_ID])
+        offset = message.get(OFFSET, 0)
+        if client.codec is None or info is None or not self.files.complete(info[FILE_ID]) \
+                or not self.may_download(info, message[USER]) or type(offset) is not int \
+                or not 0 <= offset <= info[FILE_SIZE]:
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Unknown file'
+            self.respond(client, message, response)
+            return
+        previous = self.downloads.pop(client, None)
+        if previous is not None:
+            previous.close()
+        download = self.files.download(info, offset)
+        self.respond(client, message, {RESPONSE: 200, FILE_ID: info[FILE_ID], FILE_NAME: info[FILE_NAME],
+                                       FILE_SIZE: info[FILE_SIZE], OFFSET: offset})
+        if download.transfer.done:
+            self.files.finish_download(download)
+        else:
+            self.downloads[client] = download
+
+    # За проход цикла каждый готовый к записи получатель получает один кусок через sendfile:
+    # большие файлы отдаются по очереди и задерживают сообщения чата не больше чем на кусок
+    def send_chunks(self, write: list) -> None:
+        writable = set(write)
+        for client, download in list(self.downloads.items()):
+            if client not in writable:
+                continue
+            transfer = download.transfer
+            count = download.next_chunk()
+            meta = {ACTION: FILE_CHUNK, FILE_ID: transfer.file_id, OFFSET: transfer.offset, FILE_SIZE: transfer.size}
+            try:
+                self.bytes_out.inc(client.send_file(meta, download.file, transfer.offset, count))
+            except OSError:
+                traffic_logger.info('Client %s stopped connection', client.peer)
+                self.remove_client(client)
+                continue
+            transfer.offset += count
+            self.file_bytes[DOWNLOAD].inc(count)
+            if transfer.done:
+                del self.downloads[client]
+                self.files.finish_download(download)
+                self.file_seconds[DOWNLOAD].record(transfer.seconds)
+                logger.info('File %s sent to %s: %d bytes in %.3f s, %.0f bytes/s', transfer.file_id, client.peer,
+                            transfer.bytes, transfer.seconds, transfer.throughput)
+
+    def end_transfers(self, client: Channel) -> None:
+        upload = self.uploads.pop(client, None)
+        if upload is not None:
+            upload.close()
+        download = self.downloads.pop(client, None)
+        if download is not None:
+            download.close()
+
+    # Ответ на PRESENCE ещё в старом формате, дальше - кадрами выбранного кодека
+    def welcome(self, client: Channel, message: dict, response: dict) -> None:
+        codec = negotiate(message.get(WIRE_CODECS))
+        if not codec:
+            self.respond(client, message, response)
+            return
+        response[WIRE_CODEC] = codec
+        compression = negotiate(message.get(WIRE_COMPRESSION), COMPRESSIONS)
+        if compression:
+            response[WIRE_COMPRESSION] = compression
+        self.respond(client, message, response)
+        client.codec = CODECS[codec]
+        if compression:
+            client.compression = COMPRESSIONS[compression](stats=self.compression_stats)
+
+    def resumable(self, message: dict) -> bool:
+        token = message.get(RESUME_TOKEN)
+        return token is not None and self.tokens.get(message[USER][ACCOUNT_NAME]) == token
+
+    # Продолжение сессии по токену: ни записи о входе в базу, ни чтения контактов, ни уведомлений
+    # контактам. Прежнее соединение, если сервер ещё не заметил его обрыва, закрывается.
+    def resume_session(self, message: dict, client: Channel) -> None:
+        name = message[USER][ACCOUNT_NAME]
+        previous = self.names.get(name)
+        if previous is client:
+            # Повторный PRESENCE с соединения, за которым сессия и так закреплена
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Session is already active'
+            self.respond(client, message, response)
+            return
+        if previous is not None:
+            self.remove_client(previous)
+        session = self.detached.pop(name, None)
+        self.names[name] = client
+        self.welcome(client, message, {RESPONSE: 200, RESUME_TOKEN: self.tokens[name], RESUMED: True})
+        self.resumed_total.inc()
+        traffic_logger.info('Session of %s resumed', name)
+        # Переподключившийся клиент не знает, кто из контактов в сети: он получит их заново
+        self.presence.load(name, list(self.presence.contacts.get(name, ())), self.online, time.monotonic())
+        for pending in session.backlog if session is not None else ():
+            if client.codec is None:
+                self.messages_unroutable.inc()
+                continue
+            try:
+                self.send(client, pending)
+            except OSError:
+                self.remove_client(client)
+                return
+            self.messages_routed.inc()
+
+    # Разбор запроса: один поиск в таблице по действию и одна проверка полей. Неверный запрос
+    # получает 400 с названием поля, обработчики получают только проверенные запросы.
     def process_client_message(self, message: dict, client) -> None:
+        action = message.get(ACTION)
+        entry = self.dispatch.get(action) if isinstance(action, str) else None
+        if entry is None:
+            error = 'Bad request'
+        else:
+            handler, validate, owner = entry
+            error = validate(message)
+            if error is None:
+                if owner is None or self.names.get(message[owner]) is client:
+                    handler(message, client)
+                    return
+                error = 'Not authorized'
+        response = dict(RESPONSE_400)
+        response[ERROR] = error
+        self.respond(client, message, response)
+
+    def handle_presence(self, message: dict, client: Channel) -> None:
         global new_connection
-        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
-            if message[USER][ACCOUNT_NAME] not in self.names.keys():
-                self.names[message[USER][ACCOUNT_NAME]] = client
-                client_ip, client_port = client.getpeername()
-                self.database.user_login(message[USER][ACCOUNT_NAME], client_ip, client_port)
-                send_message(client, RESPONSE_200)
-                with conflag_lock:
-                    new_connection = True
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Name is already reserved'
-                send_message(client, response)
-                self.clients.remove(client)
-                client.close()
+        name = message[USER][ACCOUNT_NAME]
+        if self.resumable(message):
+            self.resume_session(message, client)
+        elif name not in self.names and (self.router is None or self.router.claim(name)):
+            if name in self.detached:
+                # Вход без токена: прежняя сессия заканчивается
+                self.end_session(name)
+            if name in self.logouts:
+                # Переподключение до того, как прежняя сессия вышла из базы
+                self.flush_logouts()
+            self.names[name] = client
+            client_ip, client_port = peer_address(client.getpeername())
+            self.database.user_login(name, client_ip, client_port)
+            self.live.login()
+            response = {RESPONSE: 200}
+            if self.resume_grace:
+                response[RESUME_TOKEN] = self.tokens[name] = secrets.token_hex(16)
+            self.welcome(client, message, response)
+            now = time.monotonic()
+            self.presence.load(name, self.database.get_contacts(name), self.online, now)
+            self.presence_changes.inc(self.presence.changed(name, True, now))
+            with conflag_lock:
+                new_connection = True
+        else:
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Name is already reserved'
+            self.respond(client, message, response)
+            self.remove_client(client)
 
-        elif (
-                ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message
-                and TIME in message and SENDER in message and MESSAGE_TEXT in message):
-            self.messages.append(message)
+    def handle_message(self, message: dict, client: Channel) -> None:
+        if isinstance(message[DESTINATION], str) and message[DESTINATION] != BROADCAST:
+            recipients = None
+        else:
+            recipients = self.recipients(message)
+            if recipients is None:
+                response = dict(RESPONSE_400)
+                response[ERROR] = 'Bad destination'
+                self.respond(client, message, response)
+                return
+        if TRACE in message:
+            add_hop(message, HOP_SERVER_RECV)
+        self.messages.append(message)
+        if recipients is None:
             self.database.process_message(message[SENDER], message[DESTINATION])
+        else:
+            self.database.process_group_message(message[SENDER], recipients)
+        if TRACE in message:
+            add_hop(message, HOP_SERVER_DB)
 
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message:
-            self.database.user_logout(message[ACCOUNT_NAME])
-            self.clients.remove(self.names[ACCOUNT_NAME])
-            self.names[ACCOUNT_NAME].close()
-            del self.names[ACCOUNT_NAME]
-            with conflag_lock:
-                new_connection = True
+    # Выход по команде заканчивает сессию, продолжить её уже нельзя: без токена remove_client
+    # не оставляет сессию ждать переподключения, а выводит пользователя, как при обрыве
+    def handle_exit(self, message: dict, client: Channel) -> None:
+        self.tokens.pop(message[ACCOUNT_NAME], None)
+        self.remove_client(client)
 
-        elif (
-                ACTION in message and message[ACTION] == GET_CONTACTS
-                and USER in message and self.names[message[USER]] == client
-        ):
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
-            send_message(client, response)
-
-        elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            send_message(client, RESPONSE_200)
-
-        elif (
-                ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message
-                and USER in message and self.names[message[USER]] == client
-        ):
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
-            send_message(client, RESPONSE_200)
-
-        elif (
-                ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message
-                and self.names[message[ACCOUNT_NAME]] == client
-        ):
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0] for user in self.database.users_list()]
-            send_message(client, response)
+    def handle_pong(self, message: dict, client: Channel) -> None:
+        pass
 
-        else:
-            response = RESPONSE_400
-            response[ERROR] = 'Bad request'
-            send_message(client, response)
+    def handle_get_contacts(self, message: dict, client: Channel) -> None:
+        response = dict(RESPONSE_202)
+        # Контакты вошедшего пользователя уже в памяти
+        contacts = self.presence.get(message[USER])
+        response[LIST_INFO] = self.database.get_contacts(message[USER]) if contacts is None else contacts
+        self.respond(client, message, response)
+
+    def handle_add_contact(self, message: dict, client: Channel) -> None:
+        # В режиме рабочих процессов запись не ждёт базу и возвращает None: имя считается известным
+        if self.database.add_contact(message[USER], message[ACCOUNT_NAME]) is not False:
+            self.presence.add(message[USER], message[ACCOUNT_NAME], self.online(message[ACCOUNT_NAME]),
+                              time.monotonic())
+        self.respond(client, message, RESPONSE_200)
+
+    def handle_remove_contact(self, message: dict, client: Channel) -> None:
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        self.presence.remove(message[USER], message[ACCOUNT_NAME])
+        self.respond(client, message, RESPONSE_200)
+
+    def handle_users_request(self, message: dict, client: Channel) -> None:
+        response = dict(RESPONSE_202)
+        response[LIST_INFO] = [user[0] for user in self.database.users_list()]
+        self.respond(client, message, response)
 
 
 @click.command()
 @click.option('--addr', '-a', help='IP address to listen to')
 @click.option('--port', '-p', help='TCP-port')
-def run(addr: Optional[str], port: Optional[int]) -> None:
+@click.option('--stats-port', help='TCP-port of the local metrics endpoint, 0 to disable')
+@click.option('--profile', type=float, default=None, help='Profile the server thread for N seconds after start')
+@click.option('--profile-mode', type=click.Choice(PROFILE_MODES), default='cprofile', help='Profiler to use')
+@click.option('--workers', '-w', type=int, default=None, help='Number of worker processes sharing the port')
+@click.option('--config', 'config_path', default=None, help='Settings file, server.ini by default')
+def run(addr: Optional[str], port: Optional[int], stats_port: Optional[int], profile: Optional[float],
+        profile_mode: str, workers: Optional[int], config_path: Optional[str]) -> None:
     config = configparser.ConfigParser()
     dir_path = os.path.dirname(os.path.realpath(__file__))
-    config.read(f"{dir_path}/{'server.ini'}")
+    config_path = config_path or f"{dir_path}/{'server.ini'}"
+    config.read(config_path)
     listen_address = addr or config['SETTINGS']['Listen_Address']
     listen_port = port or config['SETTINGS']['Default_port']
+    stats_port = int(stats_port or config['SETTINGS'].get('Stats_port') or 0)
+    stats_address = config['SETTINGS'].get('Stats_address') or '127.0.0.1'
+    workers = int(workers or config['SETTINGS'].get('Workers') or 1)
+    options = dict(
+        heartbeat_interval=float(config['SETTINGS'].get('Heartbeat_interval') or HEARTBEAT_INTERVAL),
+        heartbeat_timeout=float(config['SETTINGS'].get('Heartbeat_timeout') or HEARTBEAT_TIMEOUT),
+        max_clients=int(config['SETTINGS'].get('Max_clients') or MAX_CLIENTS),
+        listen_backlog=int(config['SETTINGS'].get('Listen_backlog') or MAX_CONNECTIONS),
+        files=FileStore(config['SETTINGS'].get('Files_path') or FILES_DIR),
+        resume_grace=float(config['SETTINGS'].get('Resume_grace') or RESUME_GRACE),
+        validation=config['SETTINGS'].get('Validation') or 'fast',
+    )
+    if options['validation'] not in VALIDATION_ENGINES:
+        raise click.UsageError(f"validation must be one of: {', '.join(VALIDATION_ENGINES)}")
+    database_path = os.path.join(config['SETTINGS']['Database_path'], config['SETTINGS']['Database_file'])
+
+    endpoints = parse_endpoints(config['SETTINGS'].get('Endpoints') or '')
+    cluster_port = int(config['SETTINGS'].get('Cluster_port') or 0)
+    if cluster_port and workers > 1:
+        raise click.UsageError('Cluster mode runs a single worker process on every node')
+
+    # Журнал сообщений включается каталогом journal_path; journal_fsync - секунды между fsync или never
+    journal_path = config['SETTINGS'].get('Journal_path')
+    journal_fsync = config['SETTINGS'].get('Journal_fsync')
+    journal_options = dict(
+        segment_size=int(config['SETTINGS'].get('Journal_segment_size') or JOURNAL_SEGMENT_SIZE),
+        fsync_interval=None if journal_fsync == 'never' else float(journal_fsync or JOURNAL_FSYNC_INTERVAL),
+        max_bytes=int(config['SETTINGS'].get('Journal_max_bytes') or 0) or None,
+        max_age=float(config['SETTINGS'].get('Journal_max_age') or 0) or None,
+    )
+
+    # Сессии продолжаются только в одном процессе, поэтому и снимок пишется только там
+    snapshot = None
+    if workers == 1 and not cluster_port:
+        snapshot = config['SETTINGS'].get('Snapshot_file') or SNAPSHOT_FILE
+    started = time.monotonic()
+    database = ServerDB(database_path, keep_active=snapshot is not None)
+    logger.info('Database opened in %.1f ms', (time.monotonic() - started) * 1000)
+
+    stop_servers = []
+    # Текущая нагрузка есть только у сервера в этом процессе, у рабочих процессов - на их stats_port
+    live = None
+    if workers > 1:
+        # Рабочие процессы создаются до запуска Qt и потоков главного процесса.
+        # Метрики каждого рабочего процесса - на stats_port + 1 + номер процесса.
+        def make_server(worker: int, worker_database, router) -> Server:
+            # SIGUSR1 получают все процессы сразу, и отчёты с одной секундой в имени не должны затирать друг друга
+            worker_profiler = Profiler(PROFILE_DIR, mode=profile_mode, name=f'server-worker{worker}')
+            if profile:
+                worker_profiler.request(profile)
+            # TCP-адреса слушают все процессы, Unix-сокет - только первый: его путь нельзя разделить
+            worker_endpoints = [endpoint for endpoint in endpoints if worker == 0 or not isinstance(endpoint, str)]
+            # У каждого процесса свой журнал: сегменты дописывает только один писатель
+            worker_journal = None
+            if journal_path:
+                worker_journal = MessageJournal(os.path.join(journal_path, f'worker{worker}'), **journal_options)
+            worker_server = Server(listen_address, listen_port, worker_database, profiler=worker_profiler,
+                                   router=router, reuse_port=True, endpoints=worker_endpoints, journal=worker_journal,
+                                   **options)
+            if stats_port:
+                StatsExporter(worker_server.metrics, stats_address, stats_port + 1 + worker,
+                              live=worker_server.live.summary).start()
+            return worker_server
+
+        writer, processes = start_workers(workers, database, make_server)
+        metrics = writer.metrics
+
+        def request_profile():
+            for process in processes:
+                os.kill(process.pid, signal.SIGUSR1)
+    else:
+        profiler = Profiler(PROFILE_DIR, mode=profile_mode)
+        if profile:
+            profiler.request(profile)
+        router = None
+        if cluster_port:
+            router = ClusterRouter(config['SETTINGS'].get('Node_name') or f'{listen_address}:{listen_port}',
+                                   config['SETTINGS'].get('Cluster_address') or listen_address, cluster_port,
+                                   parse_peers(config['SETTINGS'].get('Peers') or ''))
+        journal = MessageJournal(journal_path, **journal_options) if journal_path else None
+        server = Server(listen_address, listen_port, database, profiler=profiler, router=router, endpoints=endpoints,
+                        snapshot=snapshot, journal=journal, **options)
+        server.daemon = True
+        server.start()
+        metrics = server.metrics
+        live = server.live
+        stop_servers.append(server)
 
-    database = ServerDB(os.path.join(config['SETTINGS']['Database_path'], config['SETTINGS']['Database_file']))
-    server = Server(listen_address, listen_port, database)
-    server.daemon = True
-    server.start()
+        def request_profile():
+            profiler.request()
+
+    # kill -USR1 <pid> открывает окно профилирования без перезапуска сервера
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: request_profile())
+
+    if stats_port:
+        exporter = StatsExporter(metrics, stats_address, stats_port, live=live.summary if live else None)
+        exporter.start()
 
     # PyQt5
     server_app = QApplication(sys.argv)
@@ -191,15 +1128,36 @@ def run(addr: Optional[str], port: Optional[int]) -> None:
     main_window.active_clients_table.resizeRowsToContents()
 
     # Update list of clients
+    registered = [metrics.value('server_registered_users')]
+
     def list_update():
         global new_connection
-        if new_connection:
+        main_window.statusBar().showMessage(status_text(metrics))
+        # В режиме рабочих процессов флаг new_connection не меняется, о входах говорит число пользователей
+        if new_connection or registered[0] != metrics.value('server_registered_users'):
+            registered[0] = metrics.value('server_registered_users')
             main_window.active_clients_table.setModel(gui_create_model(database))
             main_window.active_clients_table.resizeColumnsToContents()
             main_window.active_clients_table.resizeRowsToContents()
             with conflag_lock:
                 new_connection = False
 
+    # Текущая нагрузка: частота сообщений и входов, самые активные пользователи
+    live_window = [None]
+
+    def show_live_stats():
+        live_window[0] = LiveStatsWindow()
+        update_live_stats()
+
+    def update_live_stats():
+        window = live_window[0]
+        if window is None or not window.isVisible():
+            return
+        summary = live.summary()
+        window.rates_label.setText(live_stats_text(summary))
+        window.senders_table.setModel(create_top_model(summary['top_senders'], 'Отправитель'))
+        window.recipients_table.setModel(create_top_model(summary['top_recipients'], 'Получатель'))
+
     # Clients statistic
     def show_statistics():
         global stat_window
@@ -235,7 +1193,7 @@ def run(addr: Optional[str], port: Optional[int]) -> None:
             if 1023 < port < 65536:
                 config['SETTINGS']['Default_port'] = str(port)
                 print(port)
-                with open('server.ini', 'w') as conf:
+                with open(config_path, 'w') as conf:
                     config.write(conf)
                     message.information(config_window, 'OK', 'Settings saved successfully!')
             else:
@@ -243,13 +1201,23 @@ def run(addr: Optional[str], port: Optional[int]) -> None:
 
     timer = QTimer()
     timer.timeout.connect(list_update)
+    if live is not None:
+        timer.timeout.connect(update_live_stats)
     timer.start(1000)
 
     main_window.refresh_button.triggered.connect(list_update)
     main_window.show_history_button.triggered.connect(show_statistics)
+    main_window.live_stats_button.triggered.connect(show_live_stats)
+    main_window.live_stats_button.setEnabled(live is not None)
     main_window.config_btn.triggered.connect(server_config)
+    main_window.profile_button.triggered.connect(request_profile)
 
+    # SIGTERM закрывает окно так же, как пользователь, и сервер успевает записать снимок
+    signal.signal(signal.SIGTERM, lambda signum, frame: server_app.quit())
     server_app.exec_()
+    for server in stop_servers:
+        server.stop()
+        server.join(SERVER_POLL_INTERVAL * 4)
 
 
 if __name__ == '__main__':
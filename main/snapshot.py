@@ -0,0 +1,59 @@
+import logging
+import os
+import pickle
+import struct
+from typing import Optional
+
+logger = logging.getLogger('server')
+
+# Заголовок файла: сигнатура и версия формата. Снимок другой версии не читается, сервер стартует с нуля.
+SNAPSHOT_MAGIC = b'JIMS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('!4sH')
+
+BACKLOG = 'backlog'
+
+
+def save_snapshot(path: str, stamp: tuple, sessions: dict) -> int:
+    """Записывает снимок сессий {имя: {RESUME_TOKEN, LIST_INFO, BACKLOG}} вместе с отметкой состояния базы.
+
+    Файл пишется рядом и подменяется целиком, чтобы прерванная запись не оставила половину снимка.
+    Возвращает размер файла.
+    """
+    data = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION) + pickle.dumps(
+        {'stamp': stamp, 'sessions': sessions}, protocol=pickle.HIGHEST_PROTOCOL)
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    return len(data)
+
+
+def load_snapshot(path: str, stamp: tuple) -> Optional[dict]:
+    """Сессии из снимка или None, если снимка нет, он повреждён или база менялась после его записи.
+
+    Снимок читается один раз и удаляется: после аварийной остановки сервер не должен
+    поднять сессии, которые к тому времени уже устарели.
+    """
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+    except FileNotFoundError:
+        return None
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+    if len(data) < SNAPSHOT_HEADER.size or SNAPSHOT_HEADER.unpack_from(data) != (SNAPSHOT_MAGIC, SNAPSHOT_VERSION):
+        logger.warning('Snapshot %s has unknown format, starting cold', path)
+        return None
+    try:
+        snapshot = pickle.loads(data[SNAPSHOT_HEADER.size:])
+    except (pickle.UnpicklingError, EOFError, ValueError) as error:
+        logger.warning('Snapshot %s is damaged (%s), starting cold', path, error)
+        return None
+    if tuple(snapshot['stamp']) != tuple(stamp):
+        logger.warning('Database changed after snapshot %s was written, starting cold', path)
+        return None
+    return snapshot['sessions']
@@ -0,0 +1,53 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from typing import Callable, Optional
+
+from stats.metrics import Registry
+
+logger = logging.getLogger('server')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = None
+    live: Optional[Callable[[], dict]] = None
+
+    def do_GET(self) -> None:
+        if self.path == '/live' and self.live is not None:
+            # Текущая нагрузка в JSON: частоты за окна и топ отправителей и получателей
+            body = json.dumps(self.live(), ensure_ascii=False).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        elif self.path in ('/', '/metrics'):
+            body = self.registry.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+# Отдаёт метрики сервера в текстовом формате Prometheus по адресу http://<addr>:<port>/metrics,
+# а если задан live - текущую нагрузку в JSON по адресу /live
+class StatsExporter(threading.Thread):
+    def __init__(self, registry: Registry, addr: str, port: int, live: Optional[Callable[[], dict]] = None) -> None:
+        handler = type('BoundMetricsHandler', (MetricsHandler,), {'registry': registry, 'live': staticmethod(live)})
+        self.httpd = ThreadingHTTPServer((addr, port), handler)
+        self.httpd.daemon_threads = True
+        super().__init__(daemon=True)
+
+    def run(self) -> None:
+        logger.info('Stats endpoint listening on http://%s:%s/metrics', *self.httpd.server_address[:2])
+        self.httpd.serve_forever()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,132 @@
+import collections
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Optional
+
+logger = logging.getLogger('server')
+
+PROFILE_MODES = ('cprofile', 'sample')
+
+
+# Сэмплирующий профилировщик: раз в interval секунд снимает стек целевого потока
+# и копит их в "свёрнутом" виде (формат flamegraph.pl / speedscope)
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id: int, interval: float = 0.005) -> None:
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        super().__init__(daemon=True)
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+    def dump(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as out:
+            for stack, count in self.stacks.most_common():
+                out.write(f'{stack} {count}\n')
+
+
+# Профилирование потока сервера по запросу на фиксированное окно времени.
+# Запросить можно из любого потока (сигнал, GUI, CLI), а включается и выключается оно
+# в самом потоке сервера из poll(): cProfile видит только поток, в котором был включён.
+# Пока профилирование не запрошено, poll() - это одна проверка атрибута.
+# name - начало имён файлов отчёта: у процессов, профилируемых одновременно, оно должно различаться
+class Profiler:
+    def __init__(self, output_dir: str, duration: float = 30, mode: str = 'cprofile',
+                 trace_allocations: bool = True, name: str = 'server') -> None:
+        self.output_dir = output_dir
+        self.name = name
+        self.duration = duration
+        self.mode = mode
+        self.trace_allocations = trace_allocations
+        self.requested: Optional[float] = None
+        self.deadline: Optional[float] = None
+        self.profile = None
+        self.sampler = None
+        self.started_at = None
+        self.tracing = False
+        self.last_dump: Optional[str] = None
+
+    @property
+    def active(self) -> bool:
+        return self.deadline is not None
+
+    def request(self, duration: Optional[float] = None) -> None:
+        if not self.active:
+            self.requested = duration or self.duration
+
+    def poll(self) -> None:
+        if self.requested is None and self.deadline is None:
+            return
+        if self.deadline is None:
+            self.start(self.requested)
+        elif time.monotonic() >= self.deadline:
+            self.stop()
+
+    def start(self, duration: float) -> None:
+        self.requested = None
+        self.started_at = time.strftime('%Y%m%d-%H%M%S')
+        if self.mode == 'sample':
+            self.sampler = StackSampler(threading.get_ident())
+            self.sampler.start()
+        else:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self.tracing = True
+        self.deadline = time.monotonic() + duration
+        logger.info('Profiling server thread for %s seconds (%s)', duration, self.mode)
+
+    def stop(self) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f'{self.name}-{self.started_at}')
+
+        # Снимок памяти делается первым, чтобы в него не попали выделения самого сохранения отчётов
+        if self.tracing:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self.tracing = False
+            with open(f'{base}-alloc.txt', 'w', encoding='utf-8') as out:
+                for stat in snapshot.statistics('lineno')[:50]:
+                    out.write(f'{stat}\n')
+
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(f'{base}.prof')
+            report = io.StringIO()
+            pstats.Stats(self.profile, stream=report).sort_stats('cumulative').print_stats(50)
+            with open(f'{base}.txt', 'w', encoding='utf-8') as out:
+                out.write(report.getvalue())
+            self.profile = None
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.dump(f'{base}.folded')
+            self.sampler = None
+
+        self.deadline = None
+        self.last_dump = base
+        logger.info('Profile saved to %s.*', base)
@@ -0,0 +1,169 @@
+import heapq
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from variables import STATS_WINDOW, STATS_TOP_CAPACITY, STATS_TOP_EPOCH, STATS_TOP_SIZE
+
+
+class RollingCounter:
+    """События по секундам за последние window секунд в кольцевом буфере.
+
+    Память не зависит от числа событий: window целых чисел. Пишет один поток (цикл сервера),
+    читать можно из других: чтение буфер не меняет, а секунды, в которые событий не было,
+    отсекаются по номеру последней записанной секунды.
+    """
+
+    def __init__(self, window: int = STATS_WINDOW) -> None:
+        self.window = window
+        self.counts = [0] * window
+        self.last = int(time.monotonic())
+
+    def add(self, amount: int = 1, now: Optional[float] = None) -> None:
+        second = int(now if now is not None else time.monotonic())
+        if second > self.last:
+            # Ячейки пропущенных секунд обнуляются, но не больше одного оборота кольца
+            for stale in range(self.last + 1, min(second, self.last + self.window) + 1):
+                self.counts[stale % self.window] = 0
+            self.last = second
+        elif second <= self.last - self.window:
+            return
+        self.counts[second % self.window] += amount
+
+    # Значения за последние seconds секунд, от старых к новым
+    def series(self, seconds: int, now: Optional[float] = None) -> List[int]:
+        current = int(now if now is not None else time.monotonic())
+        seconds = min(seconds, self.window)
+        last, counts = self.last, self.counts
+        return [counts[second % self.window] if last - self.window < second <= last else 0
+                for second in range(current - seconds + 1, current + 1)]
+
+    def total(self, seconds: int, now: Optional[float] = None) -> int:
+        return sum(self.series(seconds, now))
+
+    def per_minute(self, seconds: int, now: Optional[float] = None) -> float:
+        return self.total(seconds, now) * 60 / min(seconds, self.window)
+
+
+class SpaceSaving:
+    """Самые частые элементы потока по алгоритму Space-Saving, не больше capacity счётчиков.
+
+    Новый элемент при заполненной таблице вытесняет элемент с наименьшим счётчиком и наследует
+    его значение как погрешность: счётчик элемента завышен не больше чем на error, и любой элемент,
+    встретившийся чаще n / capacity раз из n, в таблице есть.
+
+    Наименьший счётчик ищется по куче (счётчик, элемент), в которой у каждого элемента одна запись.
+    Прибавление кучу не трогает, поэтому запись может отставать от счётчика: при вытеснении отставшая
+    запись с вершины обновляется и опускается. Каждое прибавление дорожает не больше чем на одно такое
+    обновление, и вытеснение стоит O(log capacity), а не проход по всем счётчикам.
+    """
+
+    def __init__(self, capacity: int = STATS_TOP_CAPACITY) -> None:
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.heap: List[Tuple[int, str]] = []
+
+    def add(self, item: str, amount: int = 1) -> None:
+        if item in self.counts:
+            self.counts[item] += amount
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = amount
+            self.errors[item] = 0
+            heapq.heappush(self.heap, (amount, item))
+        else:
+            floor, evicted = self.heap[0]
+            while floor != self.counts[evicted]:
+                heapq.heapreplace(self.heap, (self.counts[evicted], evicted))
+                floor, evicted = self.heap[0]
+            # Запись вытесненного элемента на вершине кучи становится записью нового
+            heapq.heapreplace(self.heap, (floor + amount, item))
+            del self.counts[evicted]
+            del self.errors[evicted]
+            self.counts[item] = floor + amount
+            self.errors[item] = floor
+
+    # [(элемент, счётчик, погрешность), ...] по убыванию счётчика
+    def top(self, size: int = STATS_TOP_SIZE) -> List[Tuple[str, int, int]]:
+        counts, errors = dict(self.counts), dict(self.errors)
+        return [(item, count, errors.get(item, 0))
+                for item, count in sorted(counts.items(), key=lambda item: -item[1])[:size]]
+
+
+class WindowedTop:
+    """Частые элементы за последние epoch..2*epoch секунд: два скетча, текущий и предыдущий.
+
+    Каждые epoch секунд текущий скетч становится предыдущим, а старый предыдущий выбрасывается,
+    поэтому в топ попадает нагрузка "сейчас", а не за всё время работы сервера.
+    """
+
+    def __init__(self, capacity: int = STATS_TOP_CAPACITY, epoch: float = STATS_TOP_EPOCH) -> None:
+        self.capacity = capacity
+        self.epoch = epoch
+        self.current = SpaceSaving(capacity)
+        self.previous = SpaceSaving(capacity)
+        self.started = time.monotonic()
+
+    def add(self, item: str, amount: int = 1, now: Optional[float] = None) -> None:
+        now = now if now is not None else time.monotonic()
+        if now - self.started >= self.epoch:
+            # Пропущенная целиком эпоха оставляет пустой и предыдущий скетч
+            self.previous = self.current if now - self.started < 2 * self.epoch else SpaceSaving(self.capacity)
+            self.current = SpaceSaving(self.capacity)
+            self.started = now
+        self.current.add(item, amount)
+
+    def top(self, size: int = STATS_TOP_SIZE) -> List[Tuple[str, int, int]]:
+        merged: Dict[str, List[int]] = {}
+        for sketch in (self.previous, self.current):
+            for item, count, error in sketch.top(sketch.capacity):
+                totals = merged.setdefault(item, [0, 0])
+                totals[0] += count
+                totals[1] += error
+        ranked = sorted(merged.items(), key=lambda item: -item[1][0])[:size]
+        return [(item, count, error) for item, (count, error) in ranked]
+
+
+class LiveStats:
+    """Текущая нагрузка сервера без обращений к базе: сообщения и входы по секундам
+    за последний час и самые активные отправители и получатели за последние минуты.
+    """
+
+    # Окна, за которые показывается частота: подпись и длина в секундах
+    WINDOWS = (('1m', 60), ('5m', 300), ('60m', 3600))
+
+    def __init__(self, window: int = STATS_WINDOW) -> None:
+        self.messages = RollingCounter(window)
+        self.logins = RollingCounter(window)
+        self.logouts = RollingCounter(window)
+        self.senders = WindowedTop()
+        self.recipients = WindowedTop()
+
+    def message(self, sender: str, recipients: Iterable[str], now: Optional[float] = None) -> None:
+        self.messages.add(1, now)
+        self.senders.add(sender, 1, now)
+        for name in recipients:
+            self.recipients.add(name, 1, now)
+
+    def login(self, now: Optional[float] = None) -> None:
+        self.logins.add(1, now)
+
+    def logout(self, now: Optional[float] = None) -> None:
+        self.logouts.add(1, now)
+
+    def summary(self, now: Optional[float] = None, top: int = STATS_TOP_SIZE) -> dict:
+        now = now if now is not None else time.monotonic()
+        return {
+            'messages_per_minute': {name: self.messages.per_minute(seconds, now) for name, seconds in self.WINDOWS},
+            'logins_per_minute': {name: self.logins.per_minute(seconds, now) for name, seconds in self.WINDOWS},
+            'logouts_per_minute': {name: self.logouts.per_minute(seconds, now) for name, seconds in self.WINDOWS},
+            # Сообщений в минуту за последний час, по минутам от старых к новым
+            'messages_by_minute': per_minute_series(self.messages.series(self.messages.window, now)),
+            'top_senders': [{'name': name, 'count': count, 'error': error}
+                            for name, count, error in self.senders.top(top)],
+            'top_recipients': [{'name': name, 'count': count, 'error': error}
+                               for name, count, error in self.recipients.top(top)],
+        }
+
+
+def per_minute_series(series: List[int]) -> List[int]:
+    return [sum(series[start:start + 60]) for start in range(len(series) % 60, len(series), 60)]
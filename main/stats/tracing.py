@@ -0,0 +1,73 @@
+import logging
+import math
+import time
+import uuid
+from typing import List, Tuple
+
+from stats.metrics import Registry
+from variables import TRACE, TRACE_ID, TRACE_HOPS
+
+# Точки, в которых сообщение получает отметку времени, в порядке прохождения
+HOP_CLIENT_SEND = 'client_send'
+HOP_SERVER_RECV = 'server_recv'
+HOP_SERVER_DB = 'server_db'
+HOP_SERVER_SEND = 'server_send'
+HOP_CLIENT_RECV = 'client_recv'
+HOPS = (HOP_CLIENT_SEND, HOP_SERVER_RECV, HOP_SERVER_DB, HOP_SERVER_SEND, HOP_CLIENT_RECV)
+# Переход дольше этого - сбитые часы или выдуманная отметка, в гистограмму он попадает как MAX_HOP_SECONDS
+MAX_HOP_SECONDS = 3600.0
+
+logger = logging.getLogger('server')
+
+
+def start_trace(message: dict) -> dict:
+    message[TRACE] = {TRACE_ID: uuid.uuid4().hex[:16], TRACE_HOPS: [[HOP_CLIENT_SEND, time.time()]]}
+    return message
+
+
+def add_hop(message: dict, hop: str) -> None:
+    trace = message.get(TRACE)
+    if isinstance(trace, dict) and isinstance(trace.get(TRACE_HOPS), list):
+        trace[TRACE_HOPS].append([hop, time.time()])
+
+
+# Отметки трассы, которым можно верить: известная точка и конечное число. Остальные отбрасываются.
+def trace_hops(trace: dict) -> List[Tuple[str, float]]:
+    hops = trace.get(TRACE_HOPS)
+    if not isinstance(hops, list):
+        return []
+    result = []
+    for item in hops:
+        if not isinstance(item, (list, tuple)) or len(item) != 2:
+            continue
+        hop, stamp = item
+        if isinstance(hop, str) and hop in HOPS and isinstance(stamp, (int, float)) and not isinstance(stamp, bool) \
+                and math.isfinite(stamp):
+            result.append((hop, float(stamp)))
+    return result
+
+
+def clamp(seconds: float) -> float:
+    return min(max(seconds, 0.0), MAX_HOP_SECONDS)
+
+
+# Раскладывает отметки трассы по гистограммам: время каждого перехода и полный путь сообщения.
+# Отметки ставятся по time.time() разных машин, так что межхостовые переходы включают расхождение часов.
+# Учитываются только известные точки, чтобы клиент не мог размножить метки метрик. Трасса приходит
+# от клиента, поэтому ошибка здесь только пишется в лог и не мешает доставке сообщения.
+def record_trace(message: dict, registry: Registry, side: str) -> None:
+    trace = message.get(TRACE)
+    if not isinstance(trace, dict):
+        return
+    try:
+        hops = trace_hops(trace)
+        for (previous, start), (current, end) in zip(hops, hops[1:]):
+            registry.histogram(
+                f'{side}_trace_hop_seconds', 'Time between consecutive trace points', hop=f'{previous}->{current}'
+            ).record(clamp(end - start))
+        if len(hops) > 1:
+            registry.histogram(
+                f'{side}_trace_total_seconds', 'Time from the first to the last trace point', last=hops[-1][0]
+            ).record(clamp(hops[-1][1] - hops[0][1]))
+    except Exception:
+        logger.exception('Failed to record message trace')
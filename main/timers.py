@@ -0,0 +1,55 @@
+import math
+from typing import Any, Dict, Hashable, List
+
+
+# Хэшированное колесо таймеров: время делится на тики по tick секунд, каждый тик попадает
+# в одну из slots ячеек по кругу. Постановка и отмена таймера - операции со словарями за O(1),
+# а advance() просматривает только ячейки прошедших тиков, а не все таймеры сразу.
+# Таймер дальше одного оборота колеса хранит номер своего тика и пропускается, пока не наступит.
+class TimerWheel:
+    def __init__(self, tick: float = 1.0, slots: int = 64, now: float = 0.0) -> None:
+        self.tick = tick
+        self.slots: List[Dict[Hashable, int]] = [{} for _ in range(slots)]
+        self.where: Dict[Hashable, int] = {}
+        self.current = int(now / tick)
+
+    def __len__(self) -> int:
+        return len(self.where)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self.where
+
+    def schedule(self, key: Hashable, deadline: float) -> None:
+        """Ставит таймер key на момент deadline, заменяя уже стоящий."""
+        self.cancel(key)
+        # Тик округляется вверх, чтобы таймер не срабатывал раньше срока; таймер в прошлом сработает на следующем тике
+        tick = max(math.ceil(deadline / self.tick), self.current + 1)
+        index = tick % len(self.slots)
+        self.slots[index][key] = tick
+        self.where[key] = index
+
+    def cancel(self, key: Hashable) -> bool:
+        index = self.where.pop(key, None)
+        if index is None:
+            return False
+        del self.slots[index][key]
+        return True
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Продвигает колесо до момента now и возвращает ключи сработавших таймеров."""
+        target = int(now / self.tick)
+        if target <= self.current:
+            return []
+        expired = []
+        # После долгой паузы достаточно одного полного оборота: каждая ячейка проверяется один раз
+        for tick in range(self.current + 1, self.current + 1 + min(target - self.current, len(self.slots))):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            due = [key for key, key_tick in slot.items() if key_tick <= target]
+            for key in due:
+                del slot[key]
+                del self.where[key]
+            expired.extend(due)
+        self.current = target
+        return expired
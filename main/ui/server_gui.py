@@ -55,6 +55,48 @@ def create_stat_model(database):
     return list_table
 
 
+def create_top_model(rows, title):
+    list_table = QStandardItemModel()
+    list_table.setHorizontalHeaderLabels([title, 'Сообщений', 'Погрешность'])
+    for row in rows:
+        name = QStandardItem(row['name'])
+        name.setEditable(False)
+        count = QStandardItem(str(row['count']))
+        count.setEditable(False)
+        error = QStandardItem(str(row['error']))
+        error.setEditable(False)
+        list_table.appendRow([name, count, error])
+    return list_table
+
+
+def live_stats_text(summary):
+    messages = summary['messages_per_minute']
+    logins = summary['logins_per_minute']
+    by_minute = summary['messages_by_minute'][-10:]
+    return (
+        f'Сообщений в минуту: {messages["1m"]:.0f} (5 мин: {messages["5m"]:.1f}, час: {messages["60m"]:.1f})\n'
+        f'Входов в минуту: {logins["1m"]:.0f} (5 мин: {logins["5m"]:.1f}, час: {logins["60m"]:.1f})\n'
+        f'Сообщений по минутам: {" ".join(str(count) for count in by_minute)}'
+    )
+
+
+# В режиме рабочих процессов metrics - метрики главного процесса: сводку показателей ему присылают
+# рабочие (workers.STATUS_METRICS), а гистограммы задержек у него нет, есть готовый p99
+def status_text(metrics):
+    message_p99 = metrics.value('server_message_p99_seconds') or \
+        metrics.histogram('server_action_seconds', action='message').percentile(0.99)
+    profiling = ' | Профилирование...' if metrics.value('server_profiler_active') else ''
+    return (
+        f'Server Working | '
+        f'Подключено: {metrics.value("server_active_connections"):.0f} | '
+        f'Сообщений: {metrics.value("server_messages_routed_total"):.0f} | '
+        f'Вх/Исх: {metrics.value("server_bytes_in_total") / 1024:.1f}/'
+        f'{metrics.value("server_bytes_out_total") / 1024:.1f} КБ | '
+        f'p99 message: {message_p99 * 1000:.2f} мс | '
+        f'Отклонено: {metrics.total("server_rejected_total"):.0f}{profiling}'
+    )
+
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -68,6 +110,8 @@ class MainWindow(QMainWindow):
         self.refresh_button = QAction('Refresh list', self)
         self.show_history_button = QAction('Users history', self)
         self.config_btn = QAction('Server settings', self)
+        self.profile_button = QAction('Profile server', self)
+        self.live_stats_button = QAction('Live stats', self)
         self.statusBar()
 
         self.toolbar = self.addToolBar('MainBar')
@@ -75,6 +119,8 @@ class MainWindow(QMainWindow):
         self.toolbar.addAction(self.refresh_button)
         self.toolbar.addAction(self.show_history_button)
         self.toolbar.addAction(self.config_btn)
+        self.toolbar.addAction(self.profile_button)
+        self.toolbar.addAction(self.live_stats_button)
 
         self.setFixedSize(800, 600)
         self.setWindowTitle('Messaging Server alpha')
@@ -115,6 +161,37 @@ class HistoryWindow(QDialog):
         self.show()
 
 
+# Окно текущей нагрузки: данные из памяти сервера, обновляются раз в секунду
+class LiveStatsWindow(QDialog):
+    def __init__(self):
+        super().__init__()
+        self.initUI()
+
+    def initUI(self):
+        self.setWindowTitle('Текущая нагрузка')
+        self.setFixedSize(600, 560)
+
+        # Частота сообщений и входов за минуту, 5 минут и час
+        self.rates_label = QLabel(self)
+        self.rates_label.move(10, 10)
+        self.rates_label.setFixedSize(580, 60)
+
+        # Самые активные пользователи за последние минуты
+        self.senders_table = QTableView(self)
+        self.senders_table.move(10, 80)
+        self.senders_table.setFixedSize(285, 420)
+
+        self.recipients_table = QTableView(self)
+        self.recipients_table.move(305, 80)
+        self.recipients_table.setFixedSize(285, 420)
+
+        self.close_button = QPushButton('Закрыть', self)
+        self.close_button.move(250, 515)
+        self.close_button.clicked.connect(self.close)
+
+        self.show()
+
+
 # Класс окна настроек
 class ConfigWindow(QDialog):
     def __init__(self):
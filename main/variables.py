@@ -1,17 +1,35 @@
 import logging
+import os
 
 # Порт поумолчанию для сетевого ваимодействия
 DEFAULT_PORT = 7000
 # IP адрес по умолчанию для подключения клиента
 DEFAULT_IP_ADDRESS = '127.0.0.1'
-# Максимальная очередь подключений
-MAX_CONNECTIONS = 5
+# Максимальная очередь подключений (backlog слушающего сокета)
+MAX_CONNECTIONS = 128
+# Не больше стольких клиентов одновременно: select не работает с дескрипторами больше 1023
+MAX_CLIENTS = 1000
 # Максимальная длинна сообщения в байтах
 MAX_PACKAGE_LENGTH = 1024
+# Максимальный размер кадра после согласования кодека
+MAX_FRAME_LENGTH = 1024 * 1024
+# Начальный размер буфера приёма соединения, под большие кадры он растёт до MAX_FRAME_LENGTH
+RECV_BUFFER_SIZE = 4096
+# Кадры короче этого размера не сжимаются
+COMPRESSION_THRESHOLD = 512
+# Окно (2**N байт) и уровень памяти zlib на стороне сжатия: около 90 КБ на соединение вместо ~270 КБ
+# у настроек по умолчанию (15 и 8). Окно 16 КБ ещё вмещает повторный кадр со списком из 1000 имён.
+# Распаковщик читает окно из заголовка потока и подходит к любым.
+COMPRESSION_WBITS = 14
+COMPRESSION_MEMLEVEL = 5
 # Кодировка проекта
 ENCODING = 'utf-8'
 # Текущий уровень логирования
 LOGGING_LEVEL = logging.DEBUG
+# Не больше стольких записей в секунду о каждом соединении и сообщении (0 - без ограничения)
+TRAFFIC_LOG_RATE = 50
+# Записывать только каждое N-е событие о соединениях и сообщениях
+TRAFFIC_LOG_SAMPLE = 1
 
 # Прококол JIM основные ключи:
 ACTION = 'action'
@@ -33,6 +51,57 @@ LIST_INFO = 'data_list'
 REMOVE_CONTACT = 'remove'
 ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
+# Проверка живости соединения: сервер шлёт PING, клиент отвечает PONG
+PING = 'ping'
+PONG = 'pong'
+# Адресат MESSAGE - имя, список имён или BROADCAST (все подключённые пользователи)
+BROADCAST = '*'
+# Не больше стольких получателей в одном групповом сообщении
+MAX_RECIPIENTS = 1000
+# Пачка сообщений MESSAGE в одном кадре: сами сообщения в LIST_INFO, в ответе там же статус каждого
+BATCH = 'batch'
+# Не больше стольких сообщений в одной пачке
+MAX_BATCH_SIZE = 500
+# Ключ лимита для сообщений пачки: у них своя корзина, в которую помещается целая пачка
+BATCH_ITEM = 'batch_item'
+# Сервер сообщает пользователю о входе и выходе его контактов: {ACTION: CONTACT_STATUS, ONLINE: [...], OFFLINE: [...]}
+CONTACT_STATUS = 'contact_status'
+ONLINE = 'online'
+OFFLINE = 'offline'
+# Продолжение сессии: сервер выдаёт токен в ответе на PRESENCE, клиент присылает его в PRESENCE
+# после переподключения, и в ответе RESUMED говорит, что прежняя сессия продолжена
+RESUME_TOKEN = 'resume_token'
+RESUMED = 'resumed'
+# Необязательный идентификатор запроса, сервер возвращает его в ответе
+REQUEST_ID = 'request_id'
+# Необязательная трассировка доставки: {TRACE_ID: str, TRACE_HOPS: [[точка, время], ...]}
+TRACE = 'trace'
+TRACE_ID = 'id'
+TRACE_HOPS = 'hops'
+# Согласование кодека: клиент перечисляет поддерживаемые в PRESENCE, сервер отвечает выбранным
+WIRE_CODECS = 'codecs'
+WIRE_CODEC = 'codec'
+# Согласование сжатия кадров по той же схеме
+WIRE_COMPRESSION = 'compression'
+# Передача файлов: FILE_UPLOAD открывает загрузку, данные идут кадрами FILE_CHUNK,
+# получатели узнают о файле из FILE и забирают его через FILE_DOWNLOAD
+FILE_UPLOAD = 'file_upload'
+FILE_CHUNK = 'file_chunk'
+FILE_DOWNLOAD = 'file_download'
+FILE = 'file'
+FILE_ID = 'file_id'
+FILE_NAME = 'file_name'
+FILE_SIZE = 'file_size'
+# Смещение куска в файле; в ответе на FILE_UPLOAD - сколько байт сервер уже сохранил
+OFFSET = 'offset'
+# Сырые байты куска после разбора кадра с данными, в сообщение не кодируются
+FILE_DATA = 'file_data'
+# Статистика передачи в ответе на последний кусок загрузки
+TRANSFER = 'transfer'
+# Размер куска файла: меньше MAX_FRAME_LENGTH, чтобы одна передача не занимала цикл сервера надолго
+FILE_CHUNK_SIZE = 64 * 1024
+# Не больше стольких байт в одном файле
+MAX_FILE_SIZE = 100 * 1024 * 1024
 
 # Словари - ответы:
 # 200
@@ -41,5 +110,68 @@ RESPONSE_200 = {RESPONSE: 200}
 RESPONSE_202 = {RESPONSE: 202, LIST_INFO: None}
 # 400
 RESPONSE_400 = {RESPONSE: 400, ERROR: None}
+# 429 - превышен лимит запросов или сервер перегружен
+RESPONSE_429 = {RESPONSE: 429, ERROR: None}
+
+# Сколько секунд клиент ждёт ответа на запрос
+REQUEST_TIMEOUT = 10
+# Ограничения частоты запросов одного соединения: действие -> (запросов в секунду, всплеск), None - без ограничения
+RATE_LIMITS = {
+    MESSAGE: (20, 40),
+    PRESENCE: (1, 3),
+    PONG: None,
+    EXIT: None,
+    # Сама пачка не ограничивается, каждое её сообщение берёт жетон из корзины BATCH_ITEM:
+    # частота та же, что у MESSAGE, а всплеск - целая пачка MAX_BATCH_SIZE
+    BATCH: None,
+    BATCH_ITEM: (20, MAX_BATCH_SIZE),
+    # Куски файла ограничены размером файла, а не частотой
+    FILE_CHUNK: None,
+}
+# Лимит для остальных действий
+DEFAULT_RATE_LIMIT = (10, 20)
+# Сервер перегружен и отклоняет запросы, если столько сообщений ждут отправки
+MAX_PENDING_MESSAGES = 5000
+# или если предыдущий проход цикла сервера занял больше стольких секунд
+OVERLOAD_PASS_SECONDS = 1.0
+# Через столько секунд тишины сервер проверяет соединение через PING
+HEARTBEAT_INTERVAL = 30
+# Столько секунд сервер ждёт любого ответа на PING, прежде чем закрыть соединение
+HEARTBEAT_TIMEOUT = 10
+# Столько секунд сервер копит входы и выходы, прежде чем отправить их контактам одним сообщением
+PRESENCE_COALESCE_WINDOW = 0.25
+# Столько секунд сервер держит сессию оборвавшегося клиента, ожидая его с токеном
+RESUME_GRACE = 30
+# Не больше стольких сообщений копится для такой сессии
+RESUME_BACKLOG = 100
+# Пауза перед переподключением клиента растёт от CLIENT_RECONNECT_DELAY вдвое с каждой попыткой
+# до CLIENT_RECONNECT_MAX_DELAY, и из неё берётся случайная доля, чтобы клиенты не приходили разом
+CLIENT_RECONNECT_DELAY = 0.5
+CLIENT_RECONNECT_MAX_DELAY = 30
+# Не больше стольких сообщений клиент хранит, пока нет связи с сервером
+OFFLINE_QUEUE_SIZE = 1000
+# Сколько цикл сервера ждёт событий в select, прежде чем заняться таймерами, профилировщиком и связями кластера
+SERVER_POLL_INTERVAL = 0.5
 
 SERVER_DATABASE = 'sqlite:///server_base.db3'
+
+# Каталог для файлов профилирования сервера
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+# Каталог для файлов, переданных через сервер
+FILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files')
+# Снимок сессий, который сервер пишет при остановке и читает при следующем запуске
+SNAPSHOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db', 'server_state.snapshot')
+# Журнал сообщений: каталог, размер сегмента и как часто сбрасывать его на диск (секунды)
+JOURNAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'journal')
+JOURNAL_SEGMENT_SIZE = 64 * 1024 * 1024
+JOURNAL_FSYNC_INTERVAL = 1.0
+# Как часто commit проверяет срок хранения и размер журнала, секунды
+JOURNAL_RETENTION_INTERVAL = 60.0
+# Текущая нагрузка: секунд в кольцевых буферах, счётчиков в скетче частых отправителей и получателей,
+# длина эпохи скетча в секундах и сколько строк показывать в топе
+STATS_WINDOW = 3600
+STATS_TOP_CAPACITY = 100
+STATS_TOP_EPOCH = 300
+STATS_TOP_SIZE = 10
+# Строк истории входов на странице по умолчанию
+LOGIN_HISTORY_PAGE = 100
@@ -0,0 +1,369 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from codec import BinaryCodec
+from errors import IncorrectDataRecivedError
+from messages import Channel
+from stats.metrics import Registry
+from variables import *
+
+logger = logging.getLogger('server')
+
+# Служебные сообщения между процессами сервера, клиентам они не видны
+DB_CALL = 'db_call'
+CLAIM = 'claim'
+ROUTE = 'route'
+METHOD = 'method'
+ARGS = 'args'
+RESULT = 'result'
+WORKER = 'worker'
+STATUS = 'status'
+
+# Вызовы ServerDB, которые рабочий процесс отправляет не дожидаясь ответа
+DB_WRITES = ('user_login', 'user_logout', 'users_logout', 'process_message', 'process_group_message',
+             'process_messages', 'add_contact', 'remove_contact')
+# Вызовы, результат которых нужен сразу
+DB_READS = ('users_list', 'get_contacts', 'active_users_list', 'login_history', 'message_history')
+
+# Показатели строки состояния GUI, которые рабочие процессы раз в STATUS_INTERVAL секунд присылают
+# главному: у него самого нет ни соединений, ни трафика. Суммируются по процессам, кроме отмеченных
+# в STATUS_MAX, для которых берётся наибольшее значение.
+STATUS_METRICS = ('server_active_connections', 'server_messages_routed_total', 'server_bytes_in_total',
+                  'server_bytes_out_total', 'server_rejected_total', 'server_message_p99_seconds',
+                  'server_profiler_active')
+STATUS_MAX = ('server_message_p99_seconds', 'server_profiler_active')
+STATUS_INTERVAL = 1.0
+
+# Буферы сокетов между процессами с запасом, чтобы пики записи в базу не блокировали рабочие процессы
+IPC_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def ipc_pair() -> Tuple[Channel, Channel]:
+    left, right = socket.socketpair()
+    for sock in (left, right):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, IPC_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, IPC_BUFFER_SIZE)
+    return Channel(left, BinaryCodec()), Channel(right, BinaryCodec())
+
+
+# Результаты ServerDB (строки, даты) в виде, который понимает кодек
+def plain(value):
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return [plain(item) for item in value]
+
+
+class DatabaseWriter(threading.Thread):
+    """Единственный процесс, пишущий в ServerDB, и справочник присутствия.
+
+    Живёт в главном процессе. Рабочие процессы присылают сюда вызовы ServerDB и заявки
+    на имя (CLAIM). Справочник "имя -> рабочий процесс" хранится только здесь, а его
+    изменения рассылаются всем рабочим процессам сообщениями ROUTE.
+    """
+
+    def __init__(self, database, channels: List[Channel]) -> None:
+        self.database = database
+        self.channels = dict(enumerate(channels))
+        self.owners: Dict[str, int] = {}
+        self.queue: Deque[Tuple[int, Channel, dict]] = deque()
+        self.metrics = Registry()
+        self.metrics.gauge('server_registered_users', 'Clients that sent presence', func=lambda: len(self.owners))
+        self.metrics.gauge('server_workers', 'Running worker processes', func=lambda: len(self.channels))
+        self.metrics.gauge('server_db_queue', 'ServerDB calls waiting for the writer', func=lambda: len(self.queue))
+        self.calls_total = self.metrics.counter('server_db_calls_total', 'ServerDB calls from worker processes')
+        self.statuses: Dict[int, dict] = {}
+        super().__init__(daemon=True)
+
+    def run(self) -> None:
+        while self.channels:
+            # Пока очередь не пуста, select не ждёт: между вызовами базы успевают пройти заявки на имя
+            read, _, _ = select.select(list(self.channels.values()), [], [], 0 if self.queue else 1.0)
+            for channel in read:
+                worker = next(number for number, item in self.channels.items() if item is channel)
+                try:
+                    messages = channel.read_messages()
+                except (OSError, ConnectionError, IncorrectDataRecivedError):
+                    self.worker_lost(worker)
+                    continue
+                for message, _ in messages:
+                    self.handle(worker, channel, message)
+            if self.queue:
+                self.execute(*self.queue.popleft())
+
+    def handle(self, worker: int, channel: Channel, message: dict) -> None:
+        action = message.get(ACTION)
+        if action == CLAIM:
+            # Заявки обслуживаются сразу, не дожидаясь накопившейся записи в базу:
+            # от них зависит, сколько рабочий процесс простоит на входе клиента
+            name = message[ACCOUNT_NAME]
+            claimed = self.owners.setdefault(name, worker) == worker
+            if claimed:
+                self.broadcast({ACTION: ROUTE, ACCOUNT_NAME: name, WORKER: worker})
+            channel.write_message({RESPONSE: 200, REQUEST_ID: message[REQUEST_ID], RESULT: claimed})
+        elif action == STATUS and isinstance(message.get(RESULT), dict):
+            self.statuses[worker] = message[RESULT]
+            self.update_status()
+        elif action == DB_CALL and message.get(METHOD) in DB_WRITES + DB_READS:
+            # Имя освобождается сразу: повторный вход встанет в очередь после выхода
+            if message[METHOD] == 'user_logout':
+                self.release(worker, message[ARGS][:1])
+            elif message[METHOD] == 'users_logout':
+                self.release(worker, message[ARGS][0])
+            self.queue.append((worker, channel, message))
+        else:
+            logger.error('Unknown request from worker %s: %s', worker, message)
+
+    def execute(self, worker: int, channel: Channel, message: dict) -> None:
+        self.calls_total.inc()
+        try:
+            result = plain(getattr(self.database, message[METHOD])(*message[ARGS]))
+        except Exception as error:
+            logger.exception('ServerDB call %s from worker %s failed', message[METHOD], worker)
+            response = {RESPONSE: 500, ERROR: str(error)}
+        else:
+            response = {RESPONSE: 200, RESULT: result}
+        if REQUEST_ID in message and worker in self.channels:
+            response[REQUEST_ID] = message[REQUEST_ID]
+            try:
+                channel.write_message(response)
+            except OSError:
+                self.worker_lost(worker)
+
+    # Показатели рабочих процессов в метриках главного, откуда их читает строка состояния GUI
+    def update_status(self) -> None:
+        for name in STATUS_METRICS:
+            values = [status.get(name, 0) for status in self.statuses.values()]
+            aggregate = max if name in STATUS_MAX else sum
+            self.metrics.gauge(name).set(aggregate(values) if values else 0)
+
+    def release(self, worker: int, names: List[str]) -> None:
+        for name in names:
+            if self.owners.get(name) == worker:
+                del self.owners[name]
+                self.broadcast({ACTION: ROUTE, ACCOUNT_NAME: name, WORKER: None})
+
+    def broadcast(self, message: dict) -> None:
+        for worker, channel in list(self.channels.items()):
+            try:
+                channel.write_message(message)
+            except OSError:
+                self.worker_lost(worker)
+
+    def worker_lost(self, worker: int) -> None:
+        channel = self.channels.pop(worker, None)
+        if channel is None:
+            return
+        logger.critical('Worker process %s stopped', worker)
+        channel.close()
+        self.statuses.pop(worker, None)
+        self.update_status()
+        names = [name for name, owner in self.owners.items() if owner == worker]
+        if names:
+            # Выход встаёт в общую очередь, чтобы не обогнать ещё не записанные входы этих клиентов
+            self.queue.append((worker, channel, {ACTION: DB_CALL, METHOD: 'users_logout', ARGS: [names]}))
+            self.release(worker, names)
+
+
+class WorkerRouter:
+    """Связь рабочего процесса с главным и с соседями.
+
+    Кэш справочника routes обновляется сообщениями ROUTE от главного процесса, поэтому
+    пересылка сообщения соседу не требует обращения к главному. Сообщения, пришедшие
+    от соседей, копятся в received и доставляются сервером только локальным клиентам.
+    Входы и выходы клиентов соседей копятся в changes для уведомлений их контактам.
+    """
+
+    def __init__(self, worker: int, master: Channel, peers: Dict[int, Channel]) -> None:
+        self.worker = worker
+        self.master = master
+        self.peers = peers
+        self.routes: Dict[str, int] = {}
+        self.received: List[dict] = []
+        # (имя, в сети ли) для клиентов других рабочих процессов
+        self.changes: List[Tuple[str, bool]] = []
+        self.ids = itertools.count(1)
+        # Метрики сервера этого процесса, их сводка уходит главному процессу из tick
+        self.metrics: Optional[Registry] = None
+        self.status_at = 0.0
+
+    def channels(self) -> List[Channel]:
+        return [self.master] + list(self.peers.values())
+
+    def send(self, message: dict) -> None:
+        self.master.write_message(message)
+
+    def call(self, message: dict):
+        request_id = message[REQUEST_ID] = next(self.ids)
+        self.master.write_message(message)
+        while True:
+            reply = self.master.read_message()[0]
+            if reply.get(REQUEST_ID) == request_id:
+                break
+            self.apply(reply)
+        # Обновления, пришедшие в одном recv с ответом, select уже не покажет
+        for update, _ in self.master.buffered_messages():
+            self.apply(update)
+        if reply.get(RESPONSE) != 200:
+            raise RuntimeError(reply.get(ERROR))
+        return reply.get(RESULT)
+
+    def claim(self, name: str) -> bool:
+        return bool(self.call({ACTION: CLAIM, ACCOUNT_NAME: name}))
+
+    # Имена освобождает писатель базы, получив user_logout / users_logout
+    def release(self, names: List[str]) -> None:
+        pass
+
+    def tick(self, now: float) -> None:
+        if self.metrics is not None and now - self.status_at >= STATUS_INTERVAL:
+            self.status_at = now
+            self.send({ACTION: STATUS, RESULT: worker_status(self.metrics)})
+
+    def apply(self, update: dict) -> None:
+        if update.get(ACTION) != ROUTE:
+            return
+        name = update[ACCOUNT_NAME]
+        was_remote = self.routes.get(name, self.worker) != self.worker
+        if update[WORKER] is None:
+            self.routes.pop(name, None)
+        else:
+            self.routes[name] = update[WORKER]
+        if was_remote != (self.routes.get(name, self.worker) != self.worker):
+            self.changes.append((name, not was_remote))
+
+    def read(self, channel: Channel) -> None:
+        if channel is self.master:
+            # call() в том же проходе цикла мог уже вычитать всё, о чём сообщил select, и recv бы заблокировался.
+            # Без главного процесса работать нельзя: ошибка уходит в цикл сервера
+            if select.select([channel], [], [], 0)[0]:
+                for update, _ in channel.read_messages():
+                    self.apply(update)
+            return
+        try:
+            self.received.extend(message for message, _ in channel.read_messages())
+        except (OSError, ConnectionError, IncorrectDataRecivedError):
+            self.peer_lost(channel)
+
+    # Ошибка чтения: False, если оборвалась связь с главным процессом и воркеру пора завершаться
+    def channel_lost(self, channel: Channel) -> bool:
+        if channel is self.master:
+            return False
+        self.peer_lost(channel)
+        return True
+
+    def peer_lost(self, channel: Channel) -> None:
+        for worker, peer in list(self.peers.items()):
+            if peer is channel:
+                logger.error('Lost link with worker %s', worker)
+                del self.peers[worker]
+                channel.close()
+
+    # Пересылает сообщение соседям, у которых есть получатели из names.
+    # Возвращает имена, которых нет ни у кого.
+    def forward(self, message: dict, names: List[str]) -> List[str]:
+        by_worker: Dict[int, List[str]] = {}
+        unknown = []
+        for name in names:
+            worker = self.routes.get(name)
+            if worker is None or worker == self.worker or worker not in self.peers:
+                unknown.append(name)
+            else:
+                by_worker.setdefault(worker, []).append(name)
+        for worker, recipients in by_worker.items():
+            if isinstance(message[DESTINATION], str):
+                self.write_peer(worker, message)
+            else:
+                copy = dict(message)
+                copy[DESTINATION] = recipients
+                self.write_peer(worker, copy)
+        return unknown
+
+    def broadcast(self, message: dict) -> None:
+        for worker in list(self.peers):
+            self.write_peer(worker, message)
+
+    def write_peer(self, worker: int, message: dict) -> None:
+        try:
+            self.peers[worker].write_message(message)
+        except OSError:
+            self.peer_lost(self.peers[worker])
+
+
+def worker_status(metrics: Registry) -> dict:
+    status = {name: metrics.value(name) for name in STATUS_METRICS}
+    status['server_rejected_total'] = metrics.total('server_rejected_total')
+    status['server_message_p99_seconds'] = metrics.histogram('server_action_seconds', action=MESSAGE).percentile(0.99)
+    return status
+
+
+class DatabaseProxy:
+    """ServerDB в рабочем процессе: запись уходит единственному писателю без ожидания, чтение ждёт ответа."""
+
+    def __init__(self, router: WorkerRouter) -> None:
+        self.router = router
+
+    def __getattr__(self, name: str):
+        if name in DB_WRITES:
+            return lambda *args: self.router.send({ACTION: DB_CALL, METHOD: name, ARGS: list(args)})
+        if name in DB_READS:
+            return lambda *args: self.router.call({ACTION: DB_CALL, METHOD: name, ARGS: list(args)})
+        raise AttributeError(name)
+
+
+def run_worker(worker: int, master: Channel, peers: Dict[int, Channel], make_server: Callable,
+               foreign: List[Channel]) -> None:
+    # Концы каналов, принадлежащие другим процессам, закрываются, чтобы их смерть была видна как EOF
+    for channel in foreign:
+        channel.close()
+    router = WorkerRouter(worker, master, peers)
+    server = make_server(worker, DatabaseProxy(router), router)
+    router.metrics = server.metrics
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: server.profiler.request())
+    logger.info('Worker %s started, pid %s', worker, os.getpid())
+    server.run()
+
+
+def start_workers(count: int, database, make_server: Callable) -> Tuple[DatabaseWriter, list]:
+    """Запускает count рабочих процессов и писателя базы в текущем процессе.
+
+    make_server(worker, database, router) создаёт Server рабочего процесса; сокеты
+    рабочих процессов должны слушать один порт с SO_REUSEPORT.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('SO_REUSEPORT is not supported on this platform')
+    master_ends, worker_ends = zip(*(ipc_pair() for _ in range(count)))
+    mesh = {(left, right): ipc_pair() for left in range(count) for right in range(left + 1, count)}
+    all_channels = list(master_ends) + list(worker_ends) + [end for pair in mesh.values() for end in pair]
+
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for worker in range(count):
+        peers = {
+            other: mesh[(worker, other)][0] if worker < other else mesh[(other, worker)][1]
+            for other in range(count) if other != worker
+        }
+        own = [worker_ends[worker]] + list(peers.values())
+        foreign = [channel for channel in all_channels if all(channel is not item for item in own)]
+        process = context.Process(target=run_worker, args=(worker, worker_ends[worker], peers, make_server, foreign),
+                                  name=f'server-worker-{worker}', daemon=True)
+        process.start()
+        processes.append(process)
+
+    for channel in all_channels:
+        if all(channel is not item for item in master_ends):
+            channel.close()
+    writer = DatabaseWriter(database, list(master_ends))
+    writer.start()
+    return writer, processes